@@ -0,0 +1,155 @@
+# Apply an OsmChange (.osc) file to the sql database.
+
+# A change file lists the elements created, modified and deleted since the map extract:
+#
+#   <osmChange version="0.6">
+#     <create> <node id="..." version="1" ...> ... </node> </create>
+#     <modify> <way id="..." version="3" ...> ... </way> </modify>
+#     <delete> <node id="..." version="2" .../> </delete>
+#   </osmChange>
+#
+# Created and modified elements are cleaned with the same shape_element() as the full load
+# and replace the rows of that id in the element table and its tags / nodes tables. An
+# element is only replaced or deleted when the version in the change file is newer than the
+# one in the database, so applying the same change file twice does nothing the second time.
+# The ways_geometry rows of the changed ways, and of the ways using a changed node, are
+# rebuilt from the tables at the end, and so are the spatial index rows (see spatial.py) of
+# the changed nodes and ways. The tag counts of tag_stats.py lose the old tags of a changed
+# or deleted element and gain the new ones, and the user_contributions counts of osm_db.py
+# lose the user of the old element and gain the one of the new element.
+
+import xml.etree.cElementTree as ET
+import time
+import osm_db
+import way_geometry
+import spatial
+import tag_stats
+from data import shape_element
+
+DB_PATH = osm_db.DB_PATH
+
+ACTIONS = ('create', 'modify', 'delete')
+
+# For every element type: the table holding its version and the tables to replace, with
+# the key of their rows in the shaped element and their columns.
+ELEMENT_TABLES = {'node': ('nodes', [('nodes', 'node'), ('nodes_tags', 'node_tags')]),
+                  'way': ('ways', [('ways', 'way'), ('ways_nodes', 'way_nodes'),
+                                   ('ways_tags', 'way_tags')]),
+                  'relation': ('relations', [('relations', 'relation'),
+                                             ('relations_members', 'relation_members'),
+                                             ('relations_tags', 'relation_tags')])}
+
+FIELDS = {key: fields for _, key, fields in osm_db.TABLES}
+
+# Yield (action, element) for every node and way of the change file.
+def get_changes(osc_file):
+    action = None
+    context = ET.iterparse(osc_file, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if elem.tag in ACTIONS:
+            if event == 'start':
+                action = elem.tag
+            else:
+                root.clear()
+        elif event == 'end' and elem.tag in ELEMENT_TABLES:
+            yield action, elem
+            elem.clear()
+
+# The version of an element in the database, or None if it is not there.
+def stored_version(conn, table, element_id):
+    row = conn.execute('SELECT MAX(CAST(version AS integer)) FROM {} WHERE id = ?;'.format(table),
+                       (element_id,)).fetchone()
+    return row[0]
+
+# The (key, value, type) of the tags of an element in the database.
+def stored_tags(conn, tag_table, element_id):
+    return conn.execute('SELECT key, value, type FROM {} WHERE id = ?;'.format(tag_table),
+                        (element_id,)).fetchall()
+
+def delete_element(conn, tables, element_id):
+    for table, _ in tables:
+        conn.execute('DELETE FROM {} WHERE id = ?;'.format(table), (element_id,))
+
+def insert_element(conn, tables, el):
+    for table, key in tables:
+        rows = osm_db.element_rows(el, key, FIELDS[key])
+        if rows:
+            conn.executemany(osm_db.insert_sql(table, FIELDS[key]), rows)
+
+# The ways whose geometry changes with an element: the way itself, or the ways of a node.
+def changed_ways(conn, tag, element_id):
+    if tag == 'way':
+        return [element_id]
+    if tag == 'node':
+        return [row[0] for row in conn.execute('SELECT DISTINCT id FROM ways_nodes '
+                                               'WHERE node_id = ?;', (element_id,))]
+    return []
+
+def apply_change(osc_file, db_path=DB_PATH):
+    t0 = time.time()
+    conn = osm_db.connect(db_path)
+    # Both are no-ops on a database built by osm_db.load_map(). The id indexes make the
+    # per element lookups and deletes fast on a database built from the csv files.
+    osm_db.create_tables(conn)
+    osm_db.create_indexes(conn)
+    spatial.ensure_spatial_index(conn)
+    tag_stats.ensure_tag_stats(conn)
+    osm_db.ensure_user_contributions(conn)
+
+    counts = dict.fromkeys(ACTIONS + ('skipped',), 0)
+    geometry_ways = set()
+    changed_nodes = set()
+    stats = tag_stats.TagStats()
+    users = osm_db.UserContributions()
+    conn.execute('BEGIN')
+    try:
+        for action, element in get_changes(osc_file):
+            version_table, tables = ELEMENT_TABLES[element.tag]
+            element_id = int(element.attrib['id'])
+            version = int(element.attrib['version'])
+            current = stored_version(conn, version_table, element_id)
+            if current is not None and current >= version:
+                counts['skipped'] += 1
+                continue
+
+            if action == 'delete':
+                if current is None:
+                    counts['skipped'] += 1
+                    continue
+                geometry_ways.update(changed_ways(conn, element.tag, element_id))
+                stats.add(element.tag, stored_tags(conn, tables[-1][0], element_id), -1)
+                users.add_stored(conn, version_table, element_id, -1)
+                delete_element(conn, tables, element_id)
+            else:
+                el = shape_element(element)
+                stats.add(element.tag, stored_tags(conn, tables[-1][0], element_id), -1)
+                users.add_stored(conn, version_table, element_id, -1)
+                delete_element(conn, tables, element_id)
+                insert_element(conn, tables, el)
+                stats.add_shaped(el)
+                users.add_stored(conn, version_table, element_id)
+                geometry_ways.update(changed_ways(conn, element.tag, element_id))
+            if element.tag == 'node':
+                changed_nodes.add(element_id)
+            counts[action] += 1
+        way_geometry.refresh_way_geometry(conn, sorted(geometry_ways))
+        spatial.update_spatial_index(conn, sorted(changed_nodes), sorted(geometry_ways))
+        users.flush(conn)
+        stats.flush(conn)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    print("Applied {}: {} created, {} modified, {} deleted, {} skipped in {} s".format(
+        osc_file, counts['create'], counts['modify'], counts['delete'], counts['skipped'],
+        round(time.time() - t0, 3)))
+    return counts
+
+
+if __name__ == '__main__':
+    import sys
+    apply_change(sys.argv[1])
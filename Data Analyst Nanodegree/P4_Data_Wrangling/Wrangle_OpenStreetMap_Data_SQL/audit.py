@@ -0,0 +1,94 @@
+# Audit the data quality of the map in the same pass as the conversion to csv.
+
+# An auditor looks at the elements of the map and reports what it finds, e.g. the street
+# types which are not in 'expected'. It registers for:
+# - the tag "k" values it audits, in 'keys': audit_tag(audit, element, value) is called for
+#   every tag with one of these keys, and/or
+# - every element, with element_auditor = True: audit_element(audit, element) is called
+#   for every top level element.
+# It reports a finding with audit.add(self.name, finding, element). The Audit keeps the
+# count of every finding and the first MAX_EXAMPLES elements it was found in:
+#
+#   {'street_type': {'Ave': {'count': 12, 'examples': ['node/123', 'way/456']}}}
+#
+# process_map(..., audit=True) runs the auditors of data.py while shaping the elements (see
+# data.py); the report is printed at the end and written to a json file.
+
+import json
+from collections import defaultdict
+
+MAX_EXAMPLES = 5
+
+class Auditor(object):
+
+    name = None
+    keys = ()
+    element_auditor = False
+
+    def audit_tag(self, audit, element, value):
+        pass
+
+    def audit_element(self, audit, element):
+        pass
+
+class Audit(object):
+
+    def __init__(self, auditors, max_examples=MAX_EXAMPLES):
+        self.max_examples = max_examples
+        self.findings = {}
+        self.tag_auditors = defaultdict(list)
+        self.element_auditors = []
+        for auditor in auditors:
+            self.findings[auditor.name] = {}
+            for key in auditor.keys:
+                self.tag_auditors[key].append(auditor)
+            if auditor.element_auditor:
+                self.element_auditors.append(auditor)
+
+    def add(self, name, finding, element=None, count=1):
+        found = self.findings[name].get(finding)
+        if found is None:
+            found = self.findings[name][finding] = {'count': 0, 'examples': []}
+        found['count'] += count
+        if element is not None and len(found['examples']) < self.max_examples:
+            found['examples'].append('{}/{}'.format(element.tag, element.attrib.get('id')))
+
+    # Run the auditors on a top level element.
+    def element(self, element):
+        for auditor in self.element_auditors:
+            auditor.audit_element(self, element)
+        if self.tag_auditors:
+            for tag in element.iter('tag'):
+                auditors = self.tag_auditors.get(tag.attrib['k'])
+                if auditors:
+                    for auditor in auditors:
+                        auditor.audit_tag(self, element, tag.attrib['v'])
+
+    # Add the findings of another audit, e.g. of the next shard in the parallel mode. The
+    # examples of this audit come first.
+    def merge(self, findings):
+        for name, name_findings in findings.items():
+            for finding, found in name_findings.items():
+                mine = self.findings[name].get(finding)
+                if mine is None:
+                    mine = self.findings[name][finding] = {'count': 0, 'examples': []}
+                mine['count'] += found['count']
+                room = self.max_examples - len(mine['examples'])
+                if room > 0:
+                    mine['examples'].extend(found['examples'][:room])
+
+    def report(self):
+        print('')
+        print('Audit report')
+        for name, name_findings in self.findings.items():
+            total = sum(found['count'] for found in name_findings.values())
+            print('')
+            print('{}: {} found, {} distinct'.format(name, total, len(name_findings)))
+            ordered = sorted(name_findings.items(), key=lambda item: -item[1]['count'])
+            for finding, found in ordered:
+                print('    {:<30} {:>8}  {}'.format(finding, found['count'],
+                                                   ', '.join(found['examples'])).rstrip())
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.findings, f, indent=2, sort_keys=True)
@@ -0,0 +1,126 @@
+# Micro-benchmark of the tag cleaning in shape_element().
+
+# The elements of a sample osm file are parsed once and kept in memory, then shaped with the
+# previous implementation of shape_element() (kept below as shape_element_baseline) and with
+# the one of data.py. Both must give the same result; the script prints tags/sec for each.
+# The caches of data.py are emptied before each timed run, so the check doesn't warm them.
+#
+#   python bench_tags.py sample.osm
+
+import xml.etree.cElementTree as ET
+import re
+import sys
+import time
+import data
+from data import PROBLEMCHARS, LOWER_COLON, NODE_FIELDS, WAY_FIELDS, mapping, \
+    is_street_name, is_phone_number, is_postcode, update_name
+
+SAMPLE_FILE = "sample.osm"
+REPEAT = 5
+
+# The cleaning functions and shape_element() as they were before the fast path.
+def update_phone_baseline(phone):
+    phone = re.sub(r'\D', '', phone)
+    if len(phone) == 11:
+        phone = '+' + phone
+    if len(phone) == 10:
+        phone = '+1' + phone
+    if len(phone) == 12:
+        phone = phone[0:2] + ' ' + phone[2:5] + '-' + phone[5:8] + '-' + phone[8:12]
+    return phone
+
+def update_postcode_baseline(postcode):
+    if re.findall('CA ', postcode):
+        postcode = re.sub('CA ', '', postcode)
+    return postcode
+
+def shape_tag_baseline(element, child, tags):
+    tag = {}
+    if PROBLEMCHARS.match(child.attrib['k']):
+        return
+    if LOWER_COLON.match(child.attrib['k']):
+        tag['type'] = child.attrib['k'].split(':', 1)[0]
+        tag['key'] = child.attrib['k'].split(':', 1)[1]
+    else:
+        tag['type'] = 'regular'
+        tag['key'] = child.attrib['k']
+    tag['id'] = element.attrib['id']
+    tag['value'] = child.attrib['v']
+    tags.append(tag)
+    if is_street_name(child):
+        tag['value'] = update_name(child.attrib['v'], mapping)
+        tags.append(tag)
+    if is_phone_number(child):
+        tag['value'] = update_phone_baseline(child.attrib['v'])
+        tags.append(tag)
+    if is_postcode(child):
+        tag['value'] = update_postcode_baseline(child.attrib['v'])
+        tags.append(tag)
+
+def shape_element_baseline(element):
+    attribs = {}
+    way_nodes = []
+    tags = []
+    if element.tag == 'node':
+        for attrib in element.attrib:
+            if attrib in NODE_FIELDS:
+                attribs[attrib] = element.attrib[attrib]
+        for child in element:
+            if child.tag == 'tag':
+                shape_tag_baseline(element, child, tags)
+        return {'node': attribs, 'node_tags': tags}
+    elif element.tag == 'way':
+        for attrib in element.attrib:
+            if attrib in WAY_FIELDS:
+                attribs[attrib] = element.attrib[attrib]
+        position = 0
+        for child in element:
+            if child.tag == 'tag':
+                shape_tag_baseline(element, child, tags)
+            elif child.tag == 'nd':
+                way_nodes.append({'id': element.attrib['id'], 'node_id': child.attrib['ref'],
+                                  'position': position})
+                position += 1
+        return {'way': attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+
+# Empty the caches of data.py (cleaned values and tag keys), so every timed run of
+# data.shape_element() starts cold, like a run of process_map() without a cache_path.
+def clear_caches():
+    data.CLEAN_CACHE.entries.clear()
+    data.CLEAN_CACHE.reset_stats()
+    data.TAG_KEYS.clear()
+
+# Return the best time of 'repeat' runs of shape over all the elements, each one starting
+# with cold caches.
+def time_shape(shape, elements, repeat=REPEAT):
+    best = None
+    for _ in range(repeat):
+        clear_caches()
+        t0 = time.perf_counter()
+        for element in elements:
+            shape(element)
+        elapsed = time.perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(osm_file):
+    # get_element() clears the elements once they are consumed, so the tree is kept instead.
+    elements = [e for e in ET.parse(osm_file).getroot() if e.tag in ('node', 'way')]
+    n_tags = sum(1 for e in elements for child in e if child.tag == 'tag')
+
+    for element in elements:
+        if shape_element_baseline(element) != data.shape_element(element):
+            raise Exception("shape_element() differs for {} {}".format(element.tag,
+                                                                        element.attrib['id']))
+
+    before = time_shape(shape_element_baseline, elements)
+    after = time_shape(data.shape_element, elements)
+    print("{} elements, {} tags".format(len(elements), n_tags))
+    print("before: {:>12,.0f} tags/sec".format(n_tags / before))
+    print("after:  {:>12,.0f} tags/sec".format(n_tags / after))
+    print("speedup: {:.2f}x".format(before / after))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else SAMPLE_FILE)
@@ -0,0 +1,304 @@
+# Benchmark of the wrangling pipeline on a synthetic map.
+
+# generate_osm() writes a deterministic osm file: the same arguments and seed always give
+# the same bytes. The number of nodes and ways, the mean number of tags per element and the
+# share of dirty street names, phone numbers and postcodes (the values the cleaning of
+# data.py has to fix) can be set. Each stage of the pipeline is then timed on its own, the
+# best of 'repeat' runs:
+# - parse:    get_element() over the file
+# - shape:    shape_element() over the parsed elements, without the tag cleaning
+# - clean:    the cleaning functions over the street, phone and postcode values, through
+#             the normalisation cache as in shape_element()
+# - validate: the compiled validator of validation.py over the shaped elements
+# - write:    the csv writers over the shaped elements
+# - load:     create_db_from_csv.create_db() over the csv files
+# The results are written as json, with the rates of every stage, so that two runs, e.g.
+# before and after a commit, can be compared with --compare:
+#
+#   python benchmark.py --nodes 200000 --ways 40000 --out before.json
+#   python benchmark.py --nodes 200000 --ways 40000 --out after.json --compare before.json
+#
+# With --osm, an existing map is benchmarked instead of a synthetic one.
+
+import xml.etree.cElementTree as ET
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from xml.sax.saxutils import quoteattr
+import data
+import create_db_from_csv
+from iterative_parsing import get_element
+from validation import compile_schema
+from writers import open_writer
+
+NODES = 100000
+WAYS = 20000
+TAGS_PER_ELEMENT = 2
+DIRTY_SHARE = 0.3
+SEED = 1
+REPEAT = 3
+RESULTS_PATH = 'benchmark.json'
+
+STAGES = ('parse', 'shape', 'clean', 'validate', 'write', 'load')
+
+# ================================================== #
+#               Synthetic Map                        #
+# ================================================== #
+
+# The values of the tags the cleaning looks at, clean ones and dirty ones which
+# update_name(), update_phone() and update_postcode() have to fix.
+STREET_NAMES = ['Almaden', 'Bascom', 'Blossom Hill', 'Capitol', 'First', 'Hamilton', 'Meridian',
+                'Santa Teresa', 'Saratoga', 'Stevens Creek', 'Tully', 'Winchester']
+CLEAN_STREET_TYPES = ['Avenue', 'Boulevard', 'Court', 'Drive', 'Lane', 'Road', 'Street']
+DIRTY_STREET_TYPES = ['Ave', 'ave', 'Blvd', 'Ct', 'Dr', 'Ln', 'Rd', 'St', 'street']
+PHONE_FORMATS = ['({}) {}', '{}-{}', '{}.{}', '+1 {} {}', '{}{}']
+CLEAN_POSTCODES = ['95008', '95014', '95110', '95112', '95125', '95129']
+
+TAG_VALUES = {'amenity': ['restaurant', 'cafe', 'bank', 'school', 'fuel', 'parking'],
+              'cuisine': ['pizza', 'mexican', 'vietnamese', 'chinese'],
+              'name': ['Main', 'Corner', 'Valley', 'Plaza', 'Park'],
+              'building': ['yes', 'house', 'retail'],
+              'highway': ['residential', 'service', 'primary'],
+              'source': ['survey', 'Bing'],
+              'tiger:county': ['Santa Clara, CA'],
+              'name:en': ['Main', 'Corner']}
+DIRTY_KEYS = ('addr:street', 'phone', 'addr:postcode')
+USERS = ['bob', 'alice', 'Zoë', 'mapper & co', 'x"y']
+
+def street(r, dirty):
+    types = DIRTY_STREET_TYPES if dirty else CLEAN_STREET_TYPES
+    return '{} {}'.format(r.choice(STREET_NAMES), r.choice(types))
+
+def phone(r, dirty):
+    number = '408{:07d}'.format(r.randrange(10000000))
+    if not dirty:
+        return data.update_phone(number)
+    return r.choice(PHONE_FORMATS).format(number[:3], number[3:])
+
+def postcode(r, dirty):
+    code = r.choice(CLEAN_POSTCODES)
+    if not dirty:
+        return code
+    return r.choice(['CA ' + code, code + '-{:04d}'.format(r.randrange(10000))])
+
+VALUE_MAKERS = {'addr:street': street, 'phone': phone, 'addr:postcode': postcode}
+
+# The tags of an element: on average tags_per_element of them, about a third of which are
+# street names, phone numbers or postcodes, dirty with a probability of dirty_share.
+def random_tags(r, tags_per_element, dirty_share):
+    tags = []
+    for _ in range(r.randint(0, 2 * tags_per_element)):
+        if r.random() < 1.0 / 3:
+            k = r.choice(DIRTY_KEYS)
+            v = VALUE_MAKERS[k](r, r.random() < dirty_share)
+        else:
+            k = r.choice(list(TAG_VALUES))
+            v = r.choice(TAG_VALUES[k])
+        tags.append((k, v))
+    return tags
+
+def meta_attributes(r, element_id):
+    return 'id="{}" version="{}" timestamp="20{:02d}-{:02d}-{:02d}T12:00:00Z" ' \
+        'changeset="{}" uid="{}" user={}'.format(
+            element_id, r.randint(1, 9), r.randint(8, 17), r.randint(1, 12), r.randint(1, 28),
+            r.randint(1, 50000000), r.randint(1, 5000), quoteattr(r.choice(USERS)))
+
+def write_tags(f, tags):
+    for k, v in tags:
+        f.write('    <tag k={} v={}/>\n'.format(quoteattr(k), quoteattr(v)))
+
+# Write a synthetic map of the San Jose area. Each way has 2 to 10 of the nodes.
+def generate_osm(path, nodes=NODES, ways=WAYS, tags_per_element=TAGS_PER_ELEMENT,
+                 dirty_share=DIRTY_SHARE, seed=SEED):
+    r = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<osm version="0.6" generator="benchmark.py">\n')
+        f.write(' <bounds minlat="37.1" minlon="-122.1" maxlat="37.5" maxlon="-121.7"/>\n')
+        for i in range(nodes):
+            attributes = '{} lat="{:.7f}" lon="{:.7f}"'.format(
+                meta_attributes(r, i + 1), 37.1 + 0.4 * r.random(), -122.1 + 0.4 * r.random())
+            tags = random_tags(r, tags_per_element, dirty_share)
+            if not tags:
+                f.write(' <node {}/>\n'.format(attributes))
+                continue
+            f.write(' <node {}>\n'.format(attributes))
+            write_tags(f, tags)
+            f.write(' </node>\n')
+        for i in range(ways):
+            f.write(' <way {}>\n'.format(meta_attributes(r, nodes + i + 1)))
+            first = r.randrange(nodes)
+            for node_id in range(first, min(first + r.randint(2, 10), nodes)):
+                f.write('    <nd ref="{}"/>\n'.format(node_id + 1))
+            write_tags(f, random_tags(r, tags_per_element, dirty_share))
+            f.write(' </way>\n')
+        f.write('</osm>\n')
+
+# ================================================== #
+#               Stages                               #
+# ================================================== #
+
+# Return the best time of 'repeat' runs of run().
+def best_time(run, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def time_parse(osm_file, repeat):
+    def run():
+        for _ in get_element(osm_file):
+            pass
+    return best_time(run, repeat)
+
+# shape_element() with the cleaners switched off, so the cleaning is timed on its own.
+def time_shape(elements, repeat):
+    cleaners = dict(data.CLEANERS)
+    data.CLEANERS.clear()
+    data.TAG_KEYS.clear()
+    try:
+        return best_time(lambda: [data.shape_element(element) for element in elements], repeat)
+    finally:
+        data.CLEANERS.update(cleaners)
+        data.TAG_KEYS.clear()
+
+# The cleaned values, through an empty cache at each run.
+def time_clean(elements, repeat):
+    values = [(data.CLEANERS[tag.attrib['k']], tag.attrib['v'])
+              for element in elements for tag in element.iter('tag')
+              if tag.attrib['k'] in data.CLEANERS]
+
+    def run():
+        data.CLEAN_CACHE.entries.clear()
+        for (field, cleaner), value in values:
+            data.CLEAN_CACHE.get(field, value, cleaner)
+    return best_time(run, repeat), len(values)
+
+def time_validate(shaped, repeat):
+    validator = compile_schema(data.SCHEMA)
+    return best_time(lambda: [validator(el) for el in shaped], repeat)
+
+def write_csv(shaped, workdir):
+    writers = {key: open_writer('csv', os.path.join(workdir, path), fields, key)
+               for path, fields, key in data.OUTPUTS}
+    try:
+        for el in shaped:
+            for key, rows in el.items():
+                if isinstance(rows, dict):
+                    writers[key].writerow(rows)
+                else:
+                    writers[key].writerows(rows)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+# create_db() reads the csv files of the current directory. Its report is not printed.
+def load_db(workdir):
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            create_db_from_csv.create_db('benchmark.db')
+    finally:
+        os.chdir(cwd)
+
+def stage_result(seconds, count, unit):
+    return {'seconds': round(seconds, 4), unit: count,
+            unit + '_per_sec': round(count / seconds, 1) if seconds else None}
+
+# Time every stage of the pipeline on a map and return the results.
+def run_benchmark(osm_file, workdir, repeat=REPEAT):
+    # get_element() clears the elements once they are consumed, so the tree is kept for
+    # the stages after the parse.
+    elements = [e for e in ET.parse(osm_file).getroot() if e.tag in ('node', 'way', 'relation')]
+    data.CLEAN_CACHE.entries.clear()
+    shaped = [data.shape_element(element) for element in elements]
+    rows = sum(1 if isinstance(rows, dict) else len(rows)
+               for el in shaped for rows in el.values())
+
+    clean_seconds, values = time_clean(elements, repeat)
+    stages = {
+        'parse': stage_result(time_parse(osm_file, repeat), len(elements), 'elements'),
+        'shape': stage_result(time_shape(elements, repeat), len(elements), 'elements'),
+        'clean': stage_result(clean_seconds, values, 'values'),
+        'validate': stage_result(time_validate(shaped, repeat), len(shaped), 'elements'),
+        'write': stage_result(best_time(lambda: write_csv(shaped, workdir), repeat), rows,
+                              'rows'),
+        'load': stage_result(best_time(lambda: load_db(workdir), repeat), rows, 'rows'),
+    }
+    return stages
+
+# The commit of the code which was benchmarked.
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, previous=None):
+    print('{:<10} {:>10} {:>16}'.format('stage', 'seconds', 'rate') +
+          ('  {:>8}'.format('vs before') if previous else ''))
+    for stage in STAGES:
+        result = results['stages'][stage]
+        unit = [key for key in result if key.endswith('_per_sec')][0]
+        line = '{:<10} {:>10.3f} {:>12,.0f} {}'.format(stage, result['seconds'], result[unit],
+                                                     unit.split('_')[0] + '/s')
+        if previous and stage in previous['stages']:
+            before = previous['stages'][stage]['seconds']
+            line += '  {:>8.2f}x'.format(before / result['seconds'])
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the wrangling pipeline.')
+    parser.add_argument('--osm', help='benchmark this map instead of a synthetic one')
+    parser.add_argument('--nodes', type=int, default=NODES)
+    parser.add_argument('--ways', type=int, default=WAYS)
+    parser.add_argument('--tags', type=int, default=TAGS_PER_ELEMENT,
+                        help='mean number of tags per element')
+    parser.add_argument('--dirty', type=float, default=DIRTY_SHARE,
+                        help='share of dirty street names, phone numbers and postcodes')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--workdir', help='directory of the map, csv files and database')
+    parser.add_argument('--out', default=RESULTS_PATH)
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='osm_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    config = {'repeat': args.repeat}
+    if args.osm:
+        osm_file = args.osm
+        config['osm'] = os.path.abspath(osm_file)
+    else:
+        osm_file = os.path.join(workdir, 'synthetic.osm')
+        config.update(nodes=args.nodes, ways=args.ways, tags_per_element=args.tags,
+                      dirty_share=args.dirty, seed=args.seed)
+        generate_osm(osm_file, args.nodes, args.ways, args.tags, args.dirty, args.seed)
+
+    results = {'commit': git_commit(), 'python': platform.python_version(),
+               'config': config, 'osm_bytes': os.path.getsize(osm_file),
+               'stages': run_benchmark(osm_file, workdir, args.repeat)}
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+    print('Results written to {}'.format(args.out))
@@ -0,0 +1,69 @@
+# Checkpoints of a long process_map() run.
+
+# process_map(..., checkpoint_path=...) shapes the file in segments of about
+# CHECKPOINT_EVERY bytes, each starting at a top level element. After each segment the
+# output files are synced to disk and a checkpoint is written, as json:
+#
+#   {"file": "san-jose_california.osm", "file_size": ..., "file_mtime_ns": ...,
+#    "offset": 671088871, "last_id": "4321",
+#    "outputs": {"nodes.csv": {"size": 104857601, "rows": 1234567}, ...},
+#    "rejected": 0, "audit": {...}}
+#
+# offset is the byte offset of the first element which has not been shaped yet and last_id
+# the id of the last one which has. The checkpoint is written to a temporary file which
+# then replaces the previous one, so a crash leaves either the old or the new checkpoint.
+# With resume=True the outputs are cut back to the sizes of the checkpoint, dropping the
+# rows of the unfinished segment, and the run goes on from its offset.
+
+import json
+import os
+
+CHECKPOINT_EVERY = 64 * 1024 * 1024
+
+# Flush a file to disk, so a checkpoint never counts bytes which are not on disk yet.
+def sync_file(path):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+def output_state(paths, rows):
+    state = {}
+    for path, count in zip(paths, rows):
+        sync_file(path)
+        state[path] = {'size': os.path.getsize(path), 'rows': count}
+    return state
+
+def write_checkpoint(checkpoint_path, checkpoint):
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+# Return the checkpoint of a run over file_in, or None if there is none. A checkpoint of
+# another file, or of the same file since changed, is an error.
+def read_checkpoint(checkpoint_path, file_in):
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    stat = os.stat(file_in)
+    if checkpoint['file'] != os.path.abspath(file_in) or \
+            checkpoint['file_size'] != stat.st_size or \
+            checkpoint['file_mtime_ns'] != stat.st_mtime_ns:
+        raise ValueError("checkpoint {} is not one of {} as it is now".format(checkpoint_path,
+                                                                               file_in))
+    return checkpoint
+
+def new_checkpoint(file_in):
+    stat = os.stat(file_in)
+    return {'file': os.path.abspath(file_in), 'file_size': stat.st_size,
+            'file_mtime_ns': stat.st_mtime_ns}
+
+# Cut the output files back to their size at the checkpoint.
+def truncate_outputs(outputs):
+    for path, state in outputs.items():
+        if not os.path.exists(path) or os.path.getsize(path) < state['size']:
+            raise ValueError("{} is shorter than at the checkpoint, it can't be resumed"
+                             .format(path))
+        os.truncate(path, state['size'])
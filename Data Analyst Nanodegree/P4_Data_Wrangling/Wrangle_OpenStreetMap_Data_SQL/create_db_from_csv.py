@@ -1,101 +1,103 @@
 # Import csv files into sql database.
 
-import csv
-import sqlite3
-
-# Create the database.
-db = sqlite3.connect('san-jose_california.db')
-c = db.cursor()
-
-# Create nodes table.
-c.execute("""CREATE TABLE nodes (
-                id integer, 
-                lat real, 
-                lon real, 
-                user text, 
-                uid integer, 
-                version text, 
-                changeset integer, 
-                timestamp text);"""
-         )
-
-with open('nodes.csv','rt') as f:
-    dr = csv.DictReader(f) # comma is default delimiter
-    to_db = [(i['id'], i['lat'], i['lon'], i['user'], i['uid'], i['version'], i['changeset'], i['timestamp'])              for i in dr]
-
-c.executemany("""INSERT INTO nodes (id, lat, lon, user, uid, version, changeset, timestamp)                     VALUES (?, ?, ?, ?, ?, ?, ?, ?);""", to_db)
-
-db.commit()
-
-
-# Create nodes_tags table.
-c.execute("""CREATE TABLE nodes_tags (
-                    id integer, 
-                    key text, 
-                    value text, 
-                    type text);"""
-         )
-
-with open('nodes_tags.csv','rt') as f:
-    dr = csv.DictReader(f) 
-    to_db = [(i['id'], i['key'], i['value'], i['type']) for i in dr]
-
-c.executemany("""INSERT INTO nodes_tags (id, key, value, type) VALUES (?, ?, ?, ?);""", to_db)
-
-db.commit()
-
-
-# Create ways table.
-c.execute("""CREATE TABLE ways (
-                    id integer, 
-                    user text, 
-                    uid integer, 
-                    version text, 
-                    changeset integer, 
-                    timestamp text);"""
-         )
-
-with open('ways.csv','rt') as f:
-    dr = csv.DictReader(f) 
-    to_db = [(i['id'], i['user'], i['uid'], i['version'], i['changeset'], i['timestamp']) for i in dr]
-
-c.executemany("""INSERT INTO ways (id, user, uid, version, changeset, timestamp)                     VALUES (?, ?, ?, ?, ?, ?);""", to_db)
-
-db.commit()
-
-
-# Create ways_nodes table.
-c.execute("""CREATE TABLE ways_nodes (
-                    id integer, 
-                    node_id integer, 
-                    position integer);"""
-         )
-
-with open('ways_nodes.csv','rt') as f:
-    dr = csv.DictReader(f) 
-    to_db = [(i['id'], i['node_id'], i['position']) for i in dr]
-
-c.executemany("""INSERT INTO ways_nodes (id, node_id, position) VALUES (?, ?, ?);""", to_db)
-
-db.commit()
-
-
-# Create ways_tags table.
-c.execute("""CREATE TABLE ways_tags (
-                    id integer, 
-                    key text, 
-                    value text, 
-                    type text);"""
-         )
-
-with open('ways_tags.csv','rt') as f:
-    dr = csv.DictReader(f) 
-    to_db = [(i['id'], i['key'], i['value'], i['type']) for i in dr]
-
-c.executemany("""INSERT INTO ways_tags (id, key, value, type) VALUES (?, ?, ?, ?);""", to_db)
-
-db.commit()
-
-
-db.close()
+# The rows of each csv file are read one at a time and inserted in chunks of CHUNK_SIZE
+# rows, so the memory used does not depend on the size of the files. All the tables are
+# loaded in one transaction, with the bulk settings of osm_db.py. The tables are created
+# with the column types of schema.py (integer, real, text), so the numbers of the csv files
+# are stored as numbers. The indexes, and the unique indexes on the element ids which stand
+# in for primary keys, are created after the load (see osm_db.finish_load()). The tag counts
+# of tag_stats.py are taken from the tag tables at the end of the same transaction.
 
+import csv
+import os
+import sys
+import time
+from itertools import islice
+import osm_db
+import tag_stats
+import way_geometry
+from data import OUTPUTS
+
+DB_PATH = 'san-jose_california.db'
+
+CHUNK_SIZE = 10000
+
+# The csv file of each table.
+CSV_PATHS = {key: path for path, _, key in OUTPUTS}
+
+# Peak memory of the process in MB. ru_maxrss is in KB on Linux and in bytes on macOS.
+def peak_memory():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0 / 1024.0 if sys.platform == 'darwin' else peak / 1024.0
+
+# Yield the rows of a csv file as lists, with the columns in the order of 'fields'.
+# With empty_as_null, empty values are inserted as NULL instead of ''.
+def read_rows(path, fields, empty_as_null=False):
+    with open(path, 'rt') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        order = [header.index(field) for field in fields]
+        if order == list(range(len(header))) and not empty_as_null:
+            for row in reader:
+                yield row
+        else:
+            for row in reader:
+                row = [row[i] for i in order]
+                if empty_as_null:
+                    row = [value if value != '' else None for value in row]
+                yield row
+
+# Insert the rows of a csv file in chunks and return the number of rows.
+def import_table(conn, table, path, fields, empty_as_null=False):
+    sql = osm_db.insert_sql(table, fields)
+    rows = read_rows(path, fields, empty_as_null)
+    count = 0
+    while True:
+        chunk = list(islice(rows, CHUNK_SIZE))
+        if not chunk:
+            return count
+        conn.executemany(sql, chunk)
+        count += len(chunk)
+
+def report(table, count, elapsed):
+    print("{:<18} {:>10,} rows {:>8.2f} s {:>12,.0f} rows/sec   peak memory {:.1f} MB".format(
+        table, count, elapsed, count / elapsed if elapsed else 0, peak_memory()))
+
+# The ways_geometry table is only filled when way_geometry.py has written its csv file. Its
+# empty values are the missing bounding boxes.
+def create_db(db_path=DB_PATH):
+    t0 = time.time()
+    db = osm_db.connect(db_path, bulk=True)
+    # Drop the tables first, so the script can be run again.
+    osm_db.create_tables(db, drop=True)
+
+    tables = [(table, CSV_PATHS[key], fields, False) for table, key, fields in osm_db.TABLES]
+    if os.path.exists(way_geometry.WAYS_GEOMETRY_PATH):
+        tables.append(('ways_geometry', way_geometry.WAYS_GEOMETRY_PATH,
+                       way_geometry.WAY_GEOMETRY_FIELDS, True))
+
+    db.execute('BEGIN')
+    try:
+        for table, path, fields, empty_as_null in tables:
+            t1 = time.time()
+            count = import_table(db, table, path, fields, empty_as_null)
+            report(table, count, time.time() - t1)
+        # The rows are inserted as they are, so the tag counts are taken from the tables.
+        t1 = time.time()
+        tag_stats.rebuild_tag_stats(db)
+        print("tag statistics in {:.2f} s".format(time.time() - t1))
+        db.execute('COMMIT')
+    except:
+        db.execute('ROLLBACK')
+        raise
+
+    # Create the indexes and the user_contributions table used by queries.py.
+    t1 = time.time()
+    osm_db.finish_load(db)
+    db.close()
+    print("indexes in {:.2f} s, total {:.2f} s".format(time.time() - t1, time.time() - t0))
+
+
+if __name__ == '__main__':
+    create_db()
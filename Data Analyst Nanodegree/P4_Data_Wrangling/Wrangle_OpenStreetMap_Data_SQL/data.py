@@ -149,20 +149,42 @@
 #                'type': 'chicago',
 #                'value': '366409'}]}
 
-import xml.etree.cElementTree as ET
+# ### If the element top level tag is "relation":
+# The dictionary should have the format {"relation": ..., "relation_members": ...,
+# "relation_tags": ...}, with the same top level attributes as a way, the tags following the
+# same rules as "node_tags" and one dictionary per member child tag in "relation_members":
+# - id: the top level element (relation) id
+# - member_type: the type attribute value of the member tag (node, way or relation)
+# - member_id: the ref attribute value of the member tag
+# - role: the role attribute value of the member tag, which can be empty
+# - position: the index starting at 0 of the member tag within the relation element
+
 import re
 from collections import defaultdict
-import csv
-import codecs
-import cerberus
+import hashlib
+import inspect
 import os
+import shutil
+import pprint
+from multiprocessing import Pool
 import schema
+import checkpoint
+import iterative_parsing as ip
+from iterative_parsing import get_element
+from normalisation_cache import NormalisationCache
+from audit import Audit, Auditor
+from validation import ValidationError, compile_rows, compile_schema, error_message, write_reject
+from writers import open_writer, merge_parts, output_path
 
 NODES_PATH = "nodes.csv"
 NODE_TAGS_PATH = "nodes_tags.csv"
 WAYS_PATH = "ways.csv"
 WAY_NODES_PATH = "ways_nodes.csv"
 WAY_TAGS_PATH = "ways_tags.csv"
+AUDIT_PATH = "audit.json"
+RELATIONS_PATH = "relations.csv"
+RELATION_MEMBERS_PATH = "relations_members.csv"
+RELATION_TAGS_PATH = "relations_tags.csv"
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
@@ -173,6 +195,9 @@ NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
 WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 WAY_NODES_FIELDS = ['id', 'node_id', 'position']
+RELATION_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
+RELATION_MEMBERS_FIELDS = ['id', 'member_type', 'member_id', 'role', 'position']
+RELATION_TAGS_FIELDS = ['id', 'key', 'value', 'type']
 
 SCHEMA = schema.schema
 
@@ -215,9 +240,11 @@ def update_name(name, mapping):
             pass
     return name
 
+NON_DIGITS = re.compile(r'\D')
+
 def update_phone(phone):
     # Remove non number characters, such as "(".
-    phone = re.sub('\D', '', phone)
+    phone = NON_DIGITS.sub('', phone)
     # Add USA phone code "+1".
     if len(phone) == 11:
         phone = '+' + phone
@@ -231,188 +258,503 @@ def update_phone(phone):
 
 def update_postcode(postcode):
     # Remove "CA".
-    if re.findall('CA ', postcode):
-        postcode = re.sub('CA ', '', postcode)
+    if 'CA ' in postcode:
+        postcode = postcode.replace('CA ', '')
     return postcode
-        
+
+# ================================================== #
+#               Auditors                             #
+# ================================================== #
+
+# The auditors run by process_map(..., audit=True), see audit.py. They replace the separate
+# passes of audit(), audit_street_type() and count_tags() over the whole file.
+
+PHONE_FORMAT = re.compile(r'^\+1 \d{3}-\d{3}-\d{4}$')
+POSTCODE_FORMAT = re.compile(r'^\d{5}$')
+DIGITS = re.compile(r'\d')
+
+class StreetTypeAuditor(Auditor):
+
+    # The street types which are not in 'expected', before cleaning.
+    name = 'street_type'
+    keys = ('addr:street',)
+
+    def audit_tag(self, audit, element, value):
+        m = street_type_re.search(value)
+        if m and m.group() not in expected:
+            audit.add(self.name, m.group(), element)
+
+class PhoneAuditor(Auditor):
+
+    # The phone numbers update_phone() can't bring to the "+1 408-555-1234" format, by
+    # their format, with every digit shown as 9.
+    name = 'phone'
+    keys = ('phone',)
+
+    def audit_tag(self, audit, element, value):
+        if not PHONE_FORMAT.match(update_phone(value)):
+            audit.add(self.name, DIGITS.sub('9', value), element)
+
+class PostcodeAuditor(Auditor):
+
+    # The postcodes which are still not 5 digits after update_postcode(), by their format,
+    # with every digit shown as 9 (e.g. 99999-9999).
+    name = 'postcode'
+    keys = ('addr:postcode',)
+
+    def audit_tag(self, audit, element, value):
+        postcode = update_postcode(value)
+        if not POSTCODE_FORMAT.match(postcode):
+            audit.add(self.name, DIGITS.sub('9', postcode), element)
+
+class TagCountAuditor(Auditor):
+
+    # The number of elements of each tag, the top level ones and their children.
+    name = 'tags'
+    element_auditor = True
+
+    def audit_element(self, audit, element):
+        audit.add(self.name, element.tag)
+        counts = defaultdict(int)
+        for child in element:
+            counts[child.tag] += 1
+        for tag, count in counts.items():
+            audit.add(self.name, tag, count=count)
+
+DEFAULT_AUDITORS = [StreetTypeAuditor(), PhoneAuditor(), PostcodeAuditor(), TagCountAuditor()]
+
+# ================================================== #
+#               Tag Cleaning Fast Path               #
+# ================================================== #
+
+# The same street names, phone numbers and postcodes come up again and again in a map,
+# so the cleaned values are kept in a bounded LRU cache, see normalisation_cache.py.
+CLEAN_CACHE_SIZE = 100000
+CLEAN_CACHE = NormalisationCache(CLEAN_CACHE_SIZE)
+
+def clean_street(name):
+    return update_name(name, mapping)
+
+# The (field, cleaning function) of each tag "k" value, see is_street_name(),
+# is_phone_number() and is_postcode().
+CLEANERS = {'addr:street': ('street', clean_street),
+            'phone': ('phone', update_phone),
+            'addr:postcode': ('postcode', update_postcode)}
+
+# Bump when the cleaned values change in a way the code of the cleaners does not show, e.g.
+# through a module they use.
+CLEANERS_VERSION = 1
+
+# The code the cleaned values depend on: the cleaners, the functions they call and the
+# patterns and lists they use.
+def cleaners_source():
+    functions = [update_name, update_phone, update_postcode, clean_street]
+    parts = [(k, field, cleaner.__name__) for k, (field, cleaner) in sorted(CLEANERS.items())]
+    for function in functions:
+        try:
+            parts.append(inspect.getsource(function))
+        except (OSError, TypeError):
+            parts.append(function.__code__.co_code)
+    parts += [expected, street_type_re.pattern, NON_DIGITS.pattern]
+    return repr(parts).encode('utf-8')
+
+# A saved cache is only loaded back if it was cleaned by the same code, with the same street
+# mapping.
+def cache_version():
+    return (CLEANERS_VERSION, hashlib.sha1(cleaners_source()).hexdigest(),
+            sorted(mapping.items()))
+
+# Dispatch table of the tag "k" values found so far. It maps the full "k" value to the
+# (type, key, cleaner) of its tags, or to None if the tag is ignored, so the regular
+# expressions and the split run once per distinct "k" instead of once per tag.
+TAG_KEYS = {}
+
+def tag_key(k):
+    if PROBLEMCHARS.match(k):
+        info = None
+    elif LOWER_COLON.match(k):
+        tag_type, key = k.split(':', 1)
+        info = (tag_type, key, CLEANERS.get(k))
+    else:
+        info = ('regular', k, CLEANERS.get(k))
+    TAG_KEYS[k] = info
+    return info
+
+# Shape the "tag" children of a node, way or relation into 'tags', for a way its "nd"
+# children into 'way_nodes' and for a relation its "member" children into 'members'.
+# Note: a cleaned tag is appended a second time after its value is updated, so it shows
+# up twice in the csv files. This is how the cleaned data was produced for the report.
+def shape_children(element, tags, way_nodes=None, members=None):
+    attrib = element.attrib
+    position = 0
+    for child in element:
+        if child.tag == 'tag':
+            k = child.attrib['k']
+            try:
+                info = TAG_KEYS[k]
+            except KeyError:
+                info = tag_key(k)
+            if info is None:
+                continue
+            tag_type, key, cleaner = info
+            tag = {'type': tag_type, 'key': key, 'id': attrib['id'], 'value': child.attrib['v']}
+            tags.append(tag)
+            if cleaner is not None:
+                tag['value'] = CLEAN_CACHE.get(cleaner[0], tag['value'], cleaner[1])
+                tags.append(tag)
+        elif child.tag == 'nd' and way_nodes is not None:
+            way_nodes.append({'id': attrib['id'], 'node_id': child.attrib['ref'],
+                              'position': position})
+            position += 1
+        elif child.tag == 'member' and members is not None:
+            member = child.attrib
+            members.append({'id': attrib['id'], 'member_type': member['type'],
+                            'member_id': member['ref'], 'role': member.get('role', ''),
+                            'position': position})
+            position += 1
+
+NODE_FIELDS_SET = frozenset(NODE_FIELDS)
+WAY_FIELDS_SET = frozenset(WAY_FIELDS)
+RELATION_FIELDS_SET = frozenset(RELATION_FIELDS)
+
 # Create a function which takes as input an iterparse Element object and return a dictionary.
 def shape_element(element, node_attr_fields=NODE_FIELDS, way_attr_fields=WAY_FIELDS,
                   problem_chars=PROBLEMCHARS, default_tag_type='regular'):
     
     # Clean and shape node or way XML element to Python dict
-    node_attribs = {}
-    way_attribs = {}
-    way_nodes = []
     tags = []  # Handle secondary tags the same way for both node and way elements
 
     if element.tag == 'node':
-        for attrib in element.attrib:
-            if attrib in NODE_FIELDS:
-                node_attribs[attrib] = element.attrib[attrib]
-        
-        for child in element:
-            node_tag = {}
-            if child.tag == 'tag':
-                if PROBLEMCHARS.match(child.attrib['k']):
-                    continue
-                else:
-                    if LOWER_COLON.match(child.attrib['k']):
-                        node_tag['type'] = child.attrib['k'].split(':',1)[0]
-                        node_tag['key'] = child.attrib['k'].split(':',1)[1]
-                        node_tag['id'] = element.attrib['id']
-                        node_tag['value'] = child.attrib['v']
-                        tags.append(node_tag)
-                    else:
-                        node_tag['type'] = 'regular'
-                        node_tag['key'] = child.attrib['k']
-                        node_tag['id'] = element.attrib['id']
-                        node_tag['value'] = child.attrib['v']
-                        tags.append(node_tag)
-                    if is_street_name(child):
-                        street_name = update_name(child.attrib['v'], mapping)
-                        node_tag['value'] = street_name
-                        tags.append(node_tag)
-                    if is_phone_number(child):
-                        phone = update_phone(child.attrib['v'])
-                        node_tag['value'] = phone
-                        tags.append(node_tag)
-                    if is_postcode(child):
-                        postcode = update_postcode(child.attrib['v'])
-                        node_tag['value'] = postcode
-                        tags.append(node_tag)
-        
+        node_attribs = {k: v for k, v in element.attrib.items() if k in NODE_FIELDS_SET}
+        shape_children(element, tags)
         return {'node': node_attribs, 'node_tags': tags}
         
     elif element.tag == 'way':
-        for attrib in element.attrib:
-            if attrib in WAY_FIELDS:
-                way_attribs[attrib] = element.attrib[attrib]
-        
-        position = 0
-        for child in element:
-            way_tag = {}
-            way_node = {}
-            if child.tag == 'tag':
-                if PROBLEMCHARS.match(child.attrib['k']):
-                    continue
-                else:
-                    if LOWER_COLON.match(child.attrib['k']):
-                        way_tag['type'] = child.attrib['k'].split(':',1)[0]
-                        way_tag['key'] = child.attrib['k'].split(':',1)[1]
-                        way_tag['id'] = element.attrib['id']
-                        way_tag['value'] = child.attrib['v']
-                        tags.append(way_tag)
-                    else:
-                        way_tag['type'] = 'regular'
-                        way_tag['key'] = child.attrib['k']
-                        way_tag['id'] = element.attrib['id']
-                        way_tag['value'] = child.attrib['v']
-                        tags.append(way_tag)
-                    if is_street_name(child):
-                        street_name = update_name(child.attrib['v'], mapping)
-                        way_tag['value'] = street_name
-                        tags.append(way_tag)
-                    if is_phone_number(child):
-                        phone = update_phone(child.attrib['v'])
-                        way_tag['value'] = phone
-                        tags.append(way_tag)
-                    if is_postcode(child):
-                        postcode = update_postcode(child.attrib['v'])
-                        way_tag['value'] = postcode
-                        tags.append(way_tag)
-            elif child.tag == 'nd':
-                way_node['id'] = element.attrib['id']
-                way_node['node_id'] = child.attrib['ref']
-                way_node['position'] = position
-                position += 1
-                way_nodes.append(way_node)
-        
+        way_attribs = {k: v for k, v in element.attrib.items() if k in WAY_FIELDS_SET}
+        way_nodes = []
+        shape_children(element, tags, way_nodes)
         return {'way': way_attribs, 'way_nodes': way_nodes, 'way_tags': tags}
+
+    elif element.tag == 'relation':
+        relation_attribs = {k: v for k, v in element.attrib.items() if k in RELATION_FIELDS_SET}
+        members = []
+        shape_children(element, tags, members=members)
+        return {'relation': relation_attribs, 'relation_members': members,
+                'relation_tags': tags}
         
+# The same rows as shape_element(), as tuples with the values in the order of the *_FIELDS
+# lists, for the csv writers (see writers.py). A missing attribute is ''.
+def shape_children_rows(element, tags, way_nodes=None, members=None):
+    element_id = element.attrib['id']
+    position = 0
+    for child in element:
+        if child.tag == 'tag':
+            k = child.attrib['k']
+            try:
+                info = TAG_KEYS[k]
+            except KeyError:
+                info = tag_key(k)
+            if info is None:
+                continue
+            tag_type, key, cleaner = info
+            value = child.attrib['v']
+            if cleaner is not None:
+                # The cleaned tag shows up twice, see shape_children().
+                value = CLEAN_CACHE.get(cleaner[0], value, cleaner[1])
+                tags.append((element_id, key, value, tag_type))
+            tags.append((element_id, key, value, tag_type))
+        elif child.tag == 'nd' and way_nodes is not None:
+            way_nodes.append((element_id, child.attrib['ref'], position))
+            position += 1
+        elif child.tag == 'member' and members is not None:
+            member = child.attrib
+            members.append((element_id, member['type'], member['ref'], member.get('role', ''),
+                            position))
+            position += 1
+
+def shape_element_rows(element):
+    tags = []
+    attrib = element.attrib
+    if element.tag == 'node':
+        shape_children_rows(element, tags)
+        return {'node': tuple([attrib.get(field, '') for field in NODE_FIELDS]),
+                'node_tags': tags}
+    elif element.tag == 'way':
+        way_nodes = []
+        shape_children_rows(element, tags, way_nodes)
+        return {'way': tuple([attrib.get(field, '') for field in WAY_FIELDS]),
+                'way_nodes': way_nodes, 'way_tags': tags}
+    elif element.tag == 'relation':
+        members = []
+        shape_children_rows(element, tags, members=members)
+        return {'relation': tuple([attrib.get(field, '') for field in RELATION_FIELDS]),
+                'relation_members': members, 'relation_tags': tags}
+
 # ================================================== #
 #               Helper Functions                     #
 # ================================================== #
 
-# '.iterparse()' not only iterates through (and parses) each element of a xml file,
-# but it also builds the complete 'tree' in memory.
-# There are very few computers that can hold a 2GB file in memory.
-# The following get_element() function stops the '.iterparse()' method from building the complete tree in memory.
-# Instead, once it has finished processing an element, it removes each element from memory with 'root.clear()' method.
-# Essentially it creates a generator, yield (which in this code is each of the individual elements of the osm file).
-# The important part is that the values for 'yield' are not stored in memory, they are generated in each iteration.
-
-def get_element(osm_file): 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end':
-            yield elem
-            root.clear()
-
+# Validate with a cerberus.Validator. process_map() uses the faster compiled validator of
+# validation.py, this one is kept as the reference implementation.
 def validate_element(element, validator, schema=SCHEMA):
     # Raise ValidationError if element does not match schema
     if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
+        field, errors = next(iter(validator.errors.items()))
         message_string = "\nElement of type '{0}' has the following errors:\n{1}"
         error_string = pprint.pformat(errors)
         
-        raise Exception(message_string.format(field, error_string))
-        
-class UnicodeDictWriter(csv.DictWriter, object):
-    
-    # Extend csv.DictWriter to handle Unicode input
-    def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: v for k, v in row.items()
-        })
-
-    def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+        raise ValidationError(message_string.format(field, error_string))
         
 # ================================================== #
 #               Main Function                        #
 # ================================================== #
 
-def process_map(file_in, validate):
-    
-    # Iteratively process each XML element and write to csv(s)
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-        codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-        codecs.open(WAYS_PATH, 'w') as ways_file, \
-        codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-        codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+# The output files, their columns and the key of their rows in the shaped element, in
+# the order process_map() writes them.
+OUTPUTS = [(NODES_PATH, NODE_FIELDS, 'node'),
+           (NODE_TAGS_PATH, NODE_TAGS_FIELDS, 'node_tags'),
+           (WAYS_PATH, WAY_FIELDS, 'way'),
+           (WAY_NODES_PATH, WAY_NODES_FIELDS, 'way_nodes'),
+           (WAY_TAGS_PATH, WAY_TAGS_FIELDS, 'way_tags'),
+           (RELATIONS_PATH, RELATION_FIELDS, 'relation'),
+           (RELATION_MEMBERS_PATH, RELATION_MEMBERS_FIELDS, 'relation_members'),
+           (RELATION_TAGS_PATH, RELATION_TAGS_FIELDS, 'relation_tags')]
+
+# Shape each element of 'source' and write it to the files in 'paths' in the given format
+# (see writers.py).
+# With a reject_path the elements that do not match the schema are written to that file
+# instead of raising a ValidationError. With an Audit, the auditors see every element.
+# With append=True the rows are added to the end of the files. With a 'progress' dict the
+# rows written to each file and the id of the last element are counted in it.
+# The csv rows are shaped as tuples by shape_element_rows(), which the csv writers take as
+# they are. With validation they are checked as tuples (see validation.compile_rows()), and
+# only the elements failing that check are shaped as dicts again to find their errors.
+# With writer_threads=True each csv file is written by a
+# background thread.
+# Return the number of rejected elements.
+def write_outputs(source, paths, validate, header=True, reject_path=None, output_format='csv',
+                  audit=None, append=False, progress=None, writer_threads=False):
+    rejected = 0
+    writers = [open_writer(output_format, path, fields, key, header, append, writer_threads)
+               for path, (_, fields, key) in zip(paths, OUTPUTS)]
+    try:
+        # The writer of each key of the shaped elements.
+        key_writers = {key: writer for (_, _, key), writer in zip(OUTPUTS, writers)}
+        rows = output_format == 'csv'
+        if rows:
+            key_writers = {key: (writer.write_tuple, writer.write_tuples)
+                           for key, writer in key_writers.items()}
+            shape = shape_element_rows
+        else:
+            key_writers = {key: (writer.writerow, writer.writerows)
+                           for key, writer in key_writers.items()}
+            shape = shape_element
+
+        with open(reject_path or os.devnull, 'a' if append else 'w') as reject_file:
+            validator = compile_schema(SCHEMA)
+            valid_rows = compile_rows({key: fields for _, fields, key in OUTPUTS}, SCHEMA) \
+                if rows else None
+
+            for element in get_element(source):
+                if audit is not None:
+                    audit.element(element)
+                el = shape(element)
+                if el:
+                    if validate is True and not (valid_rows and valid_rows(el)):
+                        shaped = shape_element(element) if rows else el
+                        errors = validator(shaped)
+                        if errors:
+                            if not reject_path:
+                                raise ValidationError(error_message(errors))
+                            write_reject(reject_file, shaped, errors)
+                            rejected += 1
+                            continue
+
+                    # The element itself is one row, its children a list of rows.
+                    for key, key_rows in el.items():
+                        writerow, writerows = key_writers[key]
+                        if isinstance(key_rows, list):
+                            writerows(key_rows)
+                        else:
+                            writerow(key_rows)
+                    if progress is not None:
+                        count_rows(progress, el)
+                if progress is not None:
+                    progress['last_id'] = element.attrib.get('id')
+    finally:
+        for writer in writers:
+            writer.close()
+    return rejected
+
+def count_rows(progress, el):
+    rows = progress['rows']
+    for key, key_rows in el.items():
+        rows[key] += len(key_rows) if isinstance(key_rows, list) else 1
+
+# Shape the file in segments of about checkpoint_every bytes and write a checkpoint after
+# each one, see checkpoint.py. With resume=True and a checkpoint of this file, the outputs
+# are cut back to the checkpoint and the run goes on from there.
+def write_outputs_checkpointed(file_in, paths, validate, reject_path, audit, checkpoint_path,
+                               checkpoint_every, resume, writer_threads=False):
+    state = checkpoint.read_checkpoint(checkpoint_path, file_in) if resume else None
+    outputs = list(paths) + ([reject_path] if reject_path else [])
+    progress = {'rows': {key: 0 for _, _, key in OUTPUTS}, 'last_id': None}
+    with open(file_in, 'rb') as f:
+        end = ip.find_osm_end(f)
+        if state is None:
+            state = checkpoint.new_checkpoint(file_in)
+            offset = ip.find_element_start(f, 0, end)
+            rejected = 0
+            append = False
+        else:
+            checkpoint.truncate_outputs(state['outputs'])
+            offset = state['offset']
+            rejected = state['rejected']
+            progress['rows'] = {key: state['outputs'][path]['rows']
+                                for path, (_, _, key) in zip(paths, OUTPUTS)}
+            progress['last_id'] = state['last_id']
+            if audit is not None:
+                audit.merge(state['audit'])
+            append = True
+            print("Resuming {} at byte {}, after element {}".format(file_in, offset,
+                                                                   state['last_id']))
+
+        while offset < end:
+            stop = ip.find_element_start(f, min(offset + checkpoint_every, end), end)
+            with ip.ShardReader(file_in, offset, stop) as segment:
+                rejected += write_outputs(segment, paths, validate, header=not append,
+                                          reject_path=reject_path, audit=audit, append=append,
+                                          progress=progress, writer_threads=writer_threads)
+            append = True
+            offset = stop
+
+            rows = [progress['rows'][key] for _, _, key in OUTPUTS] + [rejected]
+            state.update({'offset': offset, 'last_id': progress['last_id'],
+                          'outputs': checkpoint.output_state(outputs, rows),
+                          'rejected': rejected,
+                          'audit': audit.findings if audit is not None else None})
+            checkpoint.write_checkpoint(checkpoint_path, state)
+    return rejected
+
+# Worker of the parallel mode: shape one byte range of the osm file into its own part files.
+# The counters of the worker's cache are sent back to be added up. When the cache is saved
+# to disk the worker starts from the loaded entries and sends its own entries back too.
+def process_shard(args):
+    file_in, start, end, paths, validate, reject_path, output_format, cache_entries, \
+        auditors = args
+    if cache_entries is not None:
+        CLEAN_CACHE.merge(cache_entries)
+    CLEAN_CACHE.reset_stats()
+    audit = Audit(auditors) if auditors else None
+    with ip.ShardReader(file_in, start, end) as shard:
+        rejected = write_outputs(shard, paths, validate, header=False, reject_path=reject_path,
+                                 output_format=output_format, audit=audit)
+    entries = list(CLEAN_CACHE.entries.items()) if cache_entries is not None else []
+    findings = audit.findings if audit is not None else None
+    return rejected, entries, CLEAN_CACHE.stats(), findings
+
+# With workers > 1 the file is split at top level element boundaries into byte ranges
+# which are shaped in a pool of processes and then merged, so the output files are the
+# same as the ones of the serial run. There are a few shards per worker to balance the load.
+# cache_size is the capacity of the normalisation cache. With a cache_path the cache is
+# loaded from that file before the run and saved to it afterwards.
+# With validate=True and a reject_path, invalid elements are written to the reject file as
+# json lines with their errors and the run goes on, instead of stopping at the first one.
+# output_format is 'csv', 'parquet' or 'arrow'; the columnar files are named like the csv
+# files with their own extension (nodes.parquet, ...).
+# With audit=True the auditors of DEFAULT_AUDITORS (or the list of auditors given) run in the
+# same pass; the report is printed and written to audit_path as json.
+# With a checkpoint_path (serial mode and csv output only) a checkpoint is written every
+# checkpoint_every bytes of input. After a crash, the same call with resume=True goes on
+# from the last checkpoint instead of from the start of the file, see checkpoint.py.
+# With writer_threads=True the csv files of the serial mode are written by background
+# threads, see writers.py.
+def process_map(file_in, validate, workers=1, cache_size=CLEAN_CACHE_SIZE, cache_path=None,
+                reject_path=None, output_format='csv', audit=False, audit_path=AUDIT_PATH,
+                checkpoint_path=None, checkpoint_every=checkpoint.CHECKPOINT_EVERY,
+                resume=False, writer_threads=False):
+    if checkpoint_path and (workers > 1 or output_format != 'csv'):
+        raise ValueError("checkpoints are only written in the serial mode, to csv files")
+    # A compressed file (.bz2, .gz, .zst) is decompressed while it is parsed, see
+    # iterative_parsing.open_osm(). It can't be split by byte offsets for the workers or
+    # the checkpoints.
+    if ip.is_compressed(file_in):
+        if checkpoint_path:
+            raise ValueError("checkpoints need an uncompressed file")
+        if workers > 1:
+            print("{} is compressed, it is shaped by a single process".format(file_in))
+            workers = 1
+    # A pbf file is decoded blob by blob, by the workers (see pbf.py), and shaped by this
+    # process.
+    source = file_in
+    if ip.is_pbf(file_in):
+        if checkpoint_path:
+            raise ValueError("checkpoints need an xml file")
+        import pbf
+        source = pbf.PbfFile(file_in, workers)
+        workers = 1
+    auditors = DEFAULT_AUDITORS if audit is True else list(audit or [])
+    map_audit = Audit(auditors) if auditors else None
+    CLEAN_CACHE.resize(cache_size)
+    CLEAN_CACHE.reset_stats()
+    if cache_path:
+        CLEAN_CACHE.load(cache_path, cache_version())
+
+    paths = [output_path(path, output_format) for path, _, _ in OUTPUTS]
+    if checkpoint_path:
+        rejected = write_outputs_checkpointed(file_in, paths, validate, reject_path, map_audit,
+                                              checkpoint_path, checkpoint_every, resume,
+                                              writer_threads)
+    elif workers <= 1:
+        rejected = write_outputs(source, paths, validate, reject_path=reject_path,
+                                 output_format=output_format, audit=map_audit,
+                                 writer_threads=writer_threads)
+    else:
+        shards = ip.shard_offsets(file_in, workers * 4)
+        part_paths = [['{}.part{}'.format(path, i) for path in paths] for i in range(len(shards))]
+        reject_parts = ['{}.part{}'.format(reject_path, i) if reject_path else None
+                        for i in range(len(shards))]
+        cache_entries = list(CLEAN_CACHE.entries.items()) if cache_path else None
+        jobs = [(file_in, start, end, part_paths[i], validate, reject_parts[i], output_format,
+                 cache_entries, auditors) for i, (start, end) in enumerate(shards)]
+        pool = Pool(workers)
+        try:
+            results = pool.map(process_shard, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for n, (path, (_, fields, key)) in enumerate(zip(paths, OUTPUTS)):
+            merge_parts(output_format, path, fields, key, [parts[n] for parts in part_paths])
+        if reject_path:
+            with open(reject_path, 'wb') as f:
+                for reject_part in reject_parts:
+                    with open(reject_part, 'rb') as part:
+                        shutil.copyfileobj(part, f)
+                    os.remove(reject_part)
+        rejected = 0
+        for shard_rejected, entries, stats, findings in results:
+            rejected += shard_rejected
+            CLEAN_CACHE.merge(entries, stats)
+            if map_audit is not None:
+                map_audit.merge(findings)
+
+    # Without a cache_path the workers don't send their entries back, only their counters.
+    print(CLEAN_CACHE.report(entries=workers <= 1 or bool(cache_path)))
+    if cache_path:
+        CLEAN_CACHE.save(cache_path, cache_version())
+    if rejected:
+        print("{} elements did not match the schema, see {}".format(rejected, reject_path))
+    if map_audit is not None:
+        map_audit.report()
+        map_audit.save(audit_path)
+    return rejected
 
 
 if __name__ == '__main__':
-    # Note: Validation is ~ 10X slower. For the project consider using a small
-    # sample of the map when validating or turn validate to False.
-    process_map('san-jose_california.osm', validate=False)
\ No newline at end of file
+    # Note: Validation used to be ~ 10X slower with cerberus. The compiled validator of
+    # validation.py only adds a small fraction to the run time.
+    # Pass workers=os.cpu_count() to shape the file on all the cores.
+    process_map('san-jose_california.osm', validate=False)
+    # Second pass: the coordinates and bounding box of every way, see way_geometry.py.
+    import way_geometry
+    way_geometry.write_way_geometry('san-jose_california.osm')
\ No newline at end of file
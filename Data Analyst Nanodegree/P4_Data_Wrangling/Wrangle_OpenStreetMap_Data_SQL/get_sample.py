@@ -1,19 +1,106 @@
+import argparse
+import numpy as np
+import re
 import iterative_parsing as ip
-import xml.etree.cElementTree as ET
 
 OSM_FILE = "san-jose_california.osm"
 SAMPLE_FILE = "sample.osm"
 
 k = 10 # Parameter: take every k-th top level element
-    
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write(bytes('<?xml version="1.0" encoding="UTF-8"?>\n', 'UTF-8'))
-    output.write(bytes('<osm>\n  ', 'UTF-8'))
 
-    # Write every 10th top level element
-    for i, element in enumerate(ip.get_element(OSM_FILE)):
-        if i % 10 == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
+# The samples are taken from the byte offset index of the map (see iterative_parsing.py),
+# which is built with one scan of the file the first time and then reused. The sampled
+# elements are copied byte for byte from their offsets, the rest of the file is not parsed.
+# The map can be compressed (.bz2, .gz, .zst): the offsets are then the ones of the
+# decompressed xml and the elements are read in file order, decompressing on the way.
+#
+#   python get_sample.py stride -k 10
+#   python get_sample.py uniform -n 50000 --seed 1
+#   python get_sample.py bbox 37.30 -121.92 37.35 -121.85
 
-    output.write(bytes('</osm>', 'UTF-8'))
+NODE, WAY, RELATION = ip.ELEMENT_TYPES[b'node'], ip.ELEMENT_TYPES[b'way'], \
+    ip.ELEMENT_TYPES[b'relation']
 
+REF_RE = re.compile(br'<nd\s[^>]*?ref=["\'](-?\d+)')
+
+# Every k-th top level element.
+def stride_sample(index, k):
+    return np.arange(0, len(index['types']), k)
+
+# n top level elements drawn uniformly at random without replacement, the same distribution
+# as a reservoir sample of size n over the whole file.
+def uniform_sample(index, n, seed=None):
+    total = len(index['types'])
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(total, size=min(n, total), replace=False))
+
+def read_element(f, index, i):
+    f.seek(int(index['offsets'][i]))
+    return f.read(int(index['offsets'][i + 1] - index['offsets'][i]))
+
+# The nodes inside the bounding box, the ways with at least one of them and all the nodes of
+# those ways, so that every sampled way is complete. Only the bytes of the ways are read,
+# to find their node references. Relations are left out.
+def bbox_sample(index, osm_file, min_lat, min_lon, max_lat, max_lon):
+    types, ids = index['types'], index['ids']
+    is_node = types == NODE
+    inside = is_node & (index['lat'] >= min_lat) & (index['lat'] <= max_lat) & \
+        (index['lon'] >= min_lon) & (index['lon'] <= max_lon)
+    inside_ids = set(ids[inside].tolist())
+
+    # Positions of the nodes sorted by id, to find the nodes a way refers to.
+    node_positions = np.flatnonzero(is_node)
+    node_positions = node_positions[np.argsort(ids[node_positions], kind='stable')]
+    sorted_node_ids = ids[node_positions]
+
+    selected = inside.copy()
+    with ip.open_osm(osm_file) as f:
+        for i in np.flatnonzero(types == WAY):
+            refs = [int(ref) for ref in REF_RE.findall(read_element(f, index, i))]
+            if any(ref in inside_ids for ref in refs):
+                selected[i] = True
+                refs = np.array(refs, dtype=np.int64)
+                found = np.searchsorted(sorted_node_ids, refs)
+                in_range = found < len(sorted_node_ids)
+                found, refs = found[in_range], refs[in_range]
+                found = found[sorted_node_ids[found] == refs]
+                selected[node_positions[found]] = True
+    return np.flatnonzero(selected)
+
+# Write the selected elements, in file order, into a new osm file.
+def write_sample(osm_file, sample_file, index, selected):
+    with ip.open_osm(osm_file) as f, open(sample_file, 'wb') as output:
+        output.write(bytes('<?xml version="1.0" encoding="UTF-8"?>\n', 'UTF-8'))
+        output.write(bytes('<osm>\n  ', 'UTF-8'))
+
+        for i in selected:
+            output.write(read_element(f, index, i).rstrip() + b'\n  ')
+
+        output.write(bytes('</osm>', 'UTF-8'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a sample of an osm file.')
+    parser.add_argument('--osm', default=OSM_FILE)
+    parser.add_argument('--out', default=SAMPLE_FILE)
+    modes = parser.add_subparsers(dest='mode')
+    stride = modes.add_parser('stride', help='every k-th top level element')
+    stride.add_argument('-k', type=int, default=k)
+    uniform = modes.add_parser('uniform', help='n elements drawn uniformly at random')
+    uniform.add_argument('-n', type=int, required=True)
+    uniform.add_argument('--seed', type=int, default=None)
+    bbox = modes.add_parser('bbox', help='the nodes and ways inside a bounding box')
+    for name in ('min_lat', 'min_lon', 'max_lat', 'max_lon'):
+        bbox.add_argument(name, type=float)
+    args = parser.parse_args()
+
+    index = ip.load_offset_index(args.osm)
+    if args.mode == 'uniform':
+        selected = uniform_sample(index, args.n, args.seed)
+    elif args.mode == 'bbox':
+        selected = bbox_sample(index, args.osm, args.min_lat, args.min_lon, args.max_lat,
+                               args.max_lon)
+    else:
+        selected = stride_sample(index, getattr(args, 'k', k))
+    write_sample(args.osm, args.out, index, selected)
+    print("Wrote {} of {} elements to {}".format(len(selected), len(index['types']), args.out))
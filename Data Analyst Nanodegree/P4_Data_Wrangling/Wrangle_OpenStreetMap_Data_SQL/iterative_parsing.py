@@ -1,4 +1,8 @@
 import xml.etree.cElementTree as ET
+import os
+import re
+import sys
+import threading
 
 # '.iterparse()' not only iterates through (and parses) each element of a xml file,
 # but it also builds the complete 'tree' in memory.
@@ -7,12 +11,380 @@ import xml.etree.cElementTree as ET
 # Instead, once it has finished processing an element, it removes each element from memory with 'root.clear()' method.
 # Essentially it creates a generator, yield (which in this code is each of the individual elements of the osm file).
 # The important part is that the values for 'yield' are not stored in memory, they are generated in each iteration.
+#
+# Only the 'end' events are asked for and only the top level elements in 'tags' are yielded,
+# not their 'tag' / 'nd' / 'member' children. Tags in a namespace are given as '{uri}node'.
+# Once the consumer is done with an element, the element and its preceding siblings are
+# cleared, so the memory used stays the same whatever the size of the file.
+# With backend='lxml' the file is parsed by lxml, which filters the tags while parsing.
+# Compressed files (.bz2, .gz, .zst) are decompressed on the fly, see open_osm().
+# PBF files (.pbf) are decoded by pbf.py, into the same elements. A pbf.PbfFile, e.g. one
+# decoded by several processes, can be passed instead of a path.
 
-def get_element(osm_file): 
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end':
+ELEMENT_TAGS = ('node', 'way', 'relation')
+
+def get_element(osm_file, tags=ELEMENT_TAGS, backend='etree'):
+    if is_pbf(osm_file):
+        import pbf
+        osm_file = pbf.PbfFile(osm_file)
+    if hasattr(osm_file, 'iter_elements'):
+        return osm_file.iter_elements(tags)
+    if isinstance(osm_file, str) and is_compressed(osm_file):
+        return get_element_compressed(osm_file, tags, backend)
+    if backend == 'lxml':
+        return get_element_lxml(osm_file, tags)
+    if backend != 'etree':
+        raise ValueError("unknown backend: {}".format(backend))
+    return get_element_etree(osm_file, tags)
+
+def get_element_etree(osm_file, tags):
+    # ElementTree elements don't know their parent, so the root is kept when the tree
+    # builder creates it, the first element of the file.
+    roots = []
+    def element_factory(tag, attrib):
+        element = ET.Element(tag, attrib)
+        if not roots:
+            roots.append(element)
+        return element
+
+    parser = ET.XMLParser(target=ET.TreeBuilder(element_factory=element_factory))
+    tags = frozenset(tags)
+    for _, elem in ET.iterparse(osm_file, events=('end',), parser=parser):
+        if elem.tag in tags:
+            yield elem
+            elem.clear()
+            roots[0].clear()
+
+def get_element_lxml(osm_file, tags):
+    from lxml import etree
+    for _, elem in etree.iterparse(osm_file, events=('end',), tag=tags):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+# The file is decompressed in a background thread while the elements are parsed and shaped.
+def get_element_compressed(osm_file, tags, backend):
+    with ThreadedReader(open_osm(osm_file)) as source:
+        for elem in get_element(source, tags, backend):
             yield elem
-            root.clear()
 
+def is_pbf(osm_file):
+    return isinstance(osm_file, str) and osm_file.endswith('.pbf')
+
+# ================================================== #
+#               Compressed Files                     #
+# ================================================== #
+
+# Map extracts are shipped as .osm.bz2 (or .gz, or .zst), which are read here without being
+# decompressed to disk first. zstd needs the zstandard package, only imported for .zst files.
+# Python's bz2 reader handles multistream files, which is how the large extracts and the
+# planet file are compressed.
+COMPRESSED_SUFFIXES = ('.bz2', '.gz', '.zst')
+
+def is_compressed(osm_file):
+    return osm_file.endswith(COMPRESSED_SUFFIXES)
+
+# Open an osm file, compressed or not, as a binary file of its xml. The compressed ones can
+# only seek forward in reasonable time.
+def open_osm(osm_file):
+    if osm_file.endswith('.bz2'):
+        import bz2
+        return bz2.open(osm_file, 'rb')
+    if osm_file.endswith('.gz'):
+        import gzip
+        return gzip.open(osm_file, 'rb')
+    if osm_file.endswith('.zst'):
+        import zstandard
+        return zstandard.open(osm_file, 'rb')
+    return open(osm_file, 'rb')
+
+class ThreadedReader(object):
+
+    # File like object reading another one in a background thread, BLOCK_SIZE at a time and
+    # at most 'ahead' blocks ahead of the consumer. bz2, zlib and zstd release the GIL while
+    # they decompress, so the decompression runs alongside the parsing in the main thread.
+    def __init__(self, f, block_size=None, ahead=8):
+        import queue
+        self.f = f
+        self.block_size = block_size or BLOCK_SIZE
+        self.blocks = queue.Queue(ahead)
+        self.buffer = b''
+        self.pos = 0
+        self.done = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fill(self):
+        try:
+            while True:
+                block = self.f.read(self.block_size)
+                if not self.put(block) or not block:
+                    return
+        except Exception as e:
+            # Handed over to the consumer, which raises it.
+            self.put(e)
+
+    # Wait for room in the queue, unless the reader is closed. Return False if it is.
+    def put(self, item):
+        import queue
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Like a raw file, a read can return less than 'size' bytes; b'' is the end of the file.
+    def read(self, size=-1):
+        if size < 0:
+            return b''.join(iter(lambda: self.read(self.block_size), b''))
+        if self.pos >= len(self.buffer):
+            if self.done:
+                return b''
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                self.done = True
+                raise block
+            if not block:
+                self.done = True
+                return b''
+            self.buffer, self.pos = block, 0
+        data = self.buffer[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# The resident memory of the process in MB, or None where /proc is not available.
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+
+# Iterate through a file and print elements/sec, the peak memory of the process and the
+# memory every 'every' elements, which stays flat when nothing is kept.
+def measure(osm_file, backend='etree', every=100000):
+    import resource
+    import time
+    t0 = time.time()
+    n = 0
+    samples = []
+    for _ in get_element(osm_file, backend=backend):
+        n += 1
+        if n % every == 0:
+            samples.append(current_rss())
+    elapsed = time.time() - t0
+    # ru_maxrss is in KB on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak / 1024.0 / 1024.0 if sys.platform == 'darwin' else peak / 1024.0
+
+    print("{}: {} elements in {:.2f} s, {:,.0f} elements/sec ({})".format(
+        osm_file, n, elapsed, n / elapsed if elapsed else 0, backend))
+    print("peak RSS: {:.1f} MB".format(peak))
+    if samples and samples[0] is not None:
+        print("RSS every {:,} elements: {} MB".format(
+            every, ', '.join('{:.1f}'.format(rss) for rss in samples)))
+    return n, elapsed, peak
+
+# ================================================== #
+#               Byte Level Helpers                   #
+# ================================================== #
+
+# The top level elements of an osm file start with one of these tags. Their children are
+# '<tag', '<nd' and '<member' and a literal '<' is always escaped inside attribute values,
+# so every match in the raw bytes is the start of a top level element.
+ELEMENT_START_RE = re.compile(br'<(node|way|relation)[\s/>]')
+OSM_END = b'</osm>'
+
+BLOCK_SIZE = 1024 * 1024
+
+# Return the byte offset of the first top level element starting at or after 'offset'.
+# If there is none, the offset of the closing '</osm>' tag is returned.
+def find_element_start(f, offset, end):
+    # Overlap the blocks so a tag split between two reads is still found.
+    overlap = 16
+    f.seek(offset)
+    while offset < end:
+        block = f.read(BLOCK_SIZE)
+        if not block:
+            break
+        m = ELEMENT_START_RE.search(block)
+        if m:
+            return min(offset + m.start(), end)
+        if len(block) <= overlap:
+            break
+        offset += len(block) - overlap
+        f.seek(offset)
+    return end
+
+# Return the byte offset of the closing '</osm>' tag.
+def find_osm_end(f):
+    size = f.seek(0, os.SEEK_END)
+    f.seek(max(0, size - 4096))
+    tail = f.read()
+    i = tail.rfind(OSM_END)
+    if i < 0:
+        raise ValueError("no closing </osm> tag found")
+    return size - len(tail) + i
+
+# Split an osm file into (at most) n byte ranges of about the same size, each one
+# starting at a top level element boundary. The ranges cover all the top level elements
+# in file order, so processing them in order is the same as processing the whole file.
+def shard_offsets(osm_file, n):
+    with open(osm_file, 'rb') as f:
+        end = find_osm_end(f)
+        starts = []
+        for i in range(n):
+            start = find_element_start(f, end * i // n, end)
+            if start < end and start not in starts:
+                starts.append(start)
+    return list(zip(starts, starts[1:] + [end]))
+
+class ShardReader(object):
+
+    # File like view of the bytes [start, end) of an osm file wrapped in an '<osm>' root
+    # element, so that a shard can be passed to get_element() like a complete file.
+    def __init__(self, osm_file, start, end):
+        self.f = open(osm_file, 'rb')
+        self.f.seek(start)
+        self.remaining = end - start
+        self.head = b'<osm>\n'
+        self.tail = OSM_END
+
+    def read(self, size=-1):
+        if self.head:
+            data, self.head = self.head, b''
+            return data
+        if self.remaining > 0:
+            if size < 0 or size > self.remaining:
+                size = self.remaining
+            data = self.f.read(size)
+            self.remaining -= len(data)
+            if data:
+                return data
+            self.remaining = 0
+        data, self.tail = self.tail, b''
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# ================================================== #
+#               Byte Offset Index                    #
+# ================================================== #
+
+# The offset index of an osm file lists, for every top level element in file order, its
+# byte offset, its type (see ELEMENT_TYPES), its id and, for nodes, its lat and lon. Element
+# i is the bytes from offsets[i] to offsets[i + 1]; the last offset is the one of '</osm>'.
+# It is built with one scan of the raw bytes, without parsing the xml, and saved next to the
+# file, so that samples can seek straight to the elements they need.
+ELEMENT_TYPES = {b'node': 0, b'way': 1, b'relation': 2}
+
+ID_RE = re.compile(br'\sid=["\'](-?\d+)')
+LAT_RE = re.compile(br'\slat=["\']([^"\']+)')
+LON_RE = re.compile(br'\slon=["\']([^"\']+)')
+
+# The start tags of the top level elements and the closing '</osm>' tag.
+INDEX_TAG_RE = re.compile(br'<(node|way|relation)[\s/>]|</osm>')
+
+# Yield (offset, tag, start tag bytes) for every top level element of the file, and last
+# (offset, None, None) for the closing '</osm>' tag. The file is read once from the start,
+# so it can be a compressed one.
+def iter_start_tags(osm_file):
+    with open_osm(osm_file) as f:
+        offset = 0  # file offset of buf[0]
+        buf = b''
+        while True:
+            block = f.read(BLOCK_SIZE)
+            buf += block
+            pos = 0
+            while True:
+                m = INDEX_TAG_RE.search(buf, pos)
+                if m is None:
+                    break
+                if m.group(1) is None:
+                    yield offset + m.start(), None, None
+                    return
+                close = buf.find(b'>', m.end() - 1)
+                if close < 0:
+                    # The start tag goes on in the next block.
+                    break
+                yield offset + m.start(), m.group(1), buf[m.start():close]
+                pos = close
+            if not block:
+                raise ValueError("no closing </osm> tag found")
+            # Keep what has not been scanned yet, or a tag name cut by the end of the block.
+            keep = max(pos, len(buf) - 16 if m is None else m.start())
+            offset += keep
+            buf = buf[keep:]
+
+def index_path_for(osm_file):
+    return osm_file + '.idx.npz'
+
+def build_offset_index(osm_file, index_path=None):
+    import numpy as np
+    from array import array
+
+    offsets, types, ids = array('q'), array('b'), array('q')
+    lats, lons = array('d'), array('d')
+    nan = float('nan')
+    for offset, tag, start_tag in iter_start_tags(osm_file):
+        offsets.append(offset)
+        if tag is None:
+            break
+        types.append(ELEMENT_TYPES[tag])
+        m = ID_RE.search(start_tag)
+        ids.append(int(m.group(1)) if m else -1)
+        lat = LAT_RE.search(start_tag)
+        lon = LON_RE.search(start_tag)
+        lats.append(float(lat.group(1)) if lat else nan)
+        lons.append(float(lon.group(1)) if lon else nan)
+
+    stat = os.stat(osm_file)
+    index = {'offsets': np.frombuffer(offsets, dtype=np.int64),
+             'types': np.frombuffer(types, dtype=np.int8),
+             'ids': np.frombuffer(ids, dtype=np.int64),
+             'lat': np.frombuffer(lats, dtype=np.float64),
+             'lon': np.frombuffer(lons, dtype=np.float64),
+             'file_stat': np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)}
+    np.savez(index_path or index_path_for(osm_file), **index)
+    return index
+
+# Load the offset index of a file, building it if it is missing or the file has changed.
+def load_offset_index(osm_file, index_path=None):
+    import numpy as np
+    index_path = index_path or index_path_for(osm_file)
+    if os.path.exists(index_path):
+        stat = os.stat(osm_file)
+        with np.load(index_path) as saved:
+            index = dict(saved)
+        if list(index['file_stat']) == [stat.st_size, stat.st_mtime_ns]:
+            return index
+    return build_offset_index(osm_file, index_path)
+
+
+if __name__ == '__main__':
+    # python iterative_parsing.py san-jose_california.osm [etree|lxml]
+    measure(sys.argv[1], *sys.argv[2:3])
@@ -0,0 +1,95 @@
+# A bounded LRU cache for the cleaned street names, phone numbers and postcodes.
+
+# A map extract repeats the same values thousands of times, so data.py keeps the cleaned
+# value of each (field, raw value) pair. When the cache is full the least recently used
+# entry is evicted. The cache can be saved to disk at the end of a run and loaded at the
+# start of the next one on the same region, so it starts warm.
+
+import os
+import pickle
+from collections import OrderedDict
+
+CAPACITY = 100000
+
+class NormalisationCache(object):
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Return the cleaned value of 'value', calling clean(value) if it is not cached.
+    def get(self, field, value, clean):
+        key = (field, value)
+        try:
+            result = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            result = clean(value)
+            self.put(key, result)
+            return result
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, capacity):
+        self.capacity = capacity
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    # Add the entries and the counters of another cache, e.g. the one of a worker process.
+    def merge(self, entries, stats=None):
+        evictions = self.evictions
+        for key, result in entries:
+            self.put(key, result)
+        self.evictions = evictions
+        if stats:
+            self.hits += stats['hits']
+            self.misses += stats['misses']
+            self.evictions += stats['evictions']
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'capacity': self.capacity}
+
+    # With entries=False the number of entries is left out, e.g. when the entries are in
+    # the caches of worker processes and only their counters were merged into this one.
+    def report(self, entries=True):
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        report = "Normalisation cache: {} hits, {} misses ({:.1f}% hit rate), {} evictions".format(
+            self.hits, self.misses, hit_rate, self.evictions)
+        if entries:
+            report += ", {}/{} entries".format(len(self.entries), self.capacity)
+        return report
+
+    # 'version' identifies the cleaning rules the values were cleaned with (e.g. the street
+    # mapping). A saved cache with another version is stale and is not loaded.
+    def save(self, path, version=None):
+        with open(path, 'wb') as f:
+            pickle.dump({'version': version, 'entries': list(self.entries.items())}, f)
+
+    def load(self, path, version=None):
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if saved['version'] != version:
+            return False
+        # Keep the most recently used entries if the capacity is smaller than the saved cache.
+        entries = saved['entries']
+        for key, result in entries[max(0, len(entries) - self.capacity):]:
+            self.entries[key] = result
+        return True
@@ -0,0 +1,257 @@
+# Load an osm file straight into the sql database.
+
+# data.py and create_db_from_csv.py go through the csv files: every row is written to disk,
+# read back and kept in a list until the table is inserted. Here the dictionaries returned
+# by shape_element() are inserted as they come, in batches of a fixed size, each batch in
+# its own transaction, so the memory used does not depend on the size of the map.
+
+import sqlite3
+import time
+from collections import Counter
+import schema
+from data import get_element, shape_element, \
+    NODE_FIELDS, NODE_TAGS_FIELDS, WAY_FIELDS, WAY_NODES_FIELDS, WAY_TAGS_FIELDS, \
+    RELATION_FIELDS, RELATION_MEMBERS_FIELDS, RELATION_TAGS_FIELDS
+from validation import ValidationError, compile_schema, error_message
+import way_geometry
+import spatial
+import tag_stats
+
+DB_PATH = 'san-jose_california.db'
+
+# The tables of the database, the key of their rows in the shaped element and their columns.
+TABLES = [('nodes', 'node', NODE_FIELDS),
+          ('nodes_tags', 'node_tags', NODE_TAGS_FIELDS),
+          ('ways', 'way', WAY_FIELDS),
+          ('ways_nodes', 'way_nodes', WAY_NODES_FIELDS),
+          ('ways_tags', 'way_tags', WAY_TAGS_FIELDS),
+          ('relations', 'relation', RELATION_FIELDS),
+          ('relations_members', 'relation_members', RELATION_MEMBERS_FIELDS),
+          ('relations_tags', 'relation_tags', RELATION_TAGS_FIELDS)]
+
+# Map the cerberus types of schema.py to sqlite column types.
+SQL_TYPES = {'integer': 'integer', 'float': 'real', 'string': 'text'}
+
+# Indexes are created after the load, it is much faster than updating them on every insert.
+# The (key, value, id), (value, id) and (id, key, value) indexes cover the tag queries of
+# queries.py, e.g. key="amenity", the ids with value="restaurant" and the "cuisine" of those
+# ids, so they never read the tag tables.
+INDEXES = [('nodes_id', 'nodes', 'id'),
+           ('ways_id', 'ways', 'id'),
+           ('nodes_tags_id', 'nodes_tags', 'id, key, value'),
+           ('ways_tags_id', 'ways_tags', 'id, key, value'),
+           ('ways_nodes_id', 'ways_nodes', 'id, position'),
+           ('ways_nodes_node_id', 'ways_nodes', 'node_id'),
+           ('nodes_tags_key_value', 'nodes_tags', 'key, value, id'),
+           ('nodes_tags_value', 'nodes_tags', 'value, id'),
+           ('ways_tags_key_value', 'ways_tags', 'key, value, id'),
+           ('ways_tags_value', 'ways_tags', 'value, id'),
+           ('nodes_uid_user', 'nodes', 'uid, user'),
+           ('ways_uid_user', 'ways', 'uid, user'),
+           ('relations_id', 'relations', 'id'),
+           ('relations_members_id', 'relations_members', 'id, position'),
+           ('relations_members_member', 'relations_members', 'member_type, member_id'),
+           ('relations_tags_id', 'relations_tags', 'id, key, value'),
+           ('relations_tags_key_value', 'relations_tags', 'key, value, id'),
+           ('ways_geometry_id', 'ways_geometry', 'id')]
+
+# SQLite can't add a primary key to a table once it is filled, so the ids of the elements
+# get unique indexes instead, which also catch an element loaded twice.
+UNIQUE_INDEXES = frozenset(['nodes_id', 'ways_id', 'relations_id', 'ways_geometry_id'])
+
+# Number of nodes and ways of every user, so the user statistics of queries.py do not have
+# to count the rows of the nodes and ways tables every time. It is grouped by uid and user,
+# as a uid can have more than one user name.
+USER_CONTRIBUTIONS_SQL = [
+    'CREATE TABLE IF NOT EXISTS user_contributions '
+    '(uid integer, user text, nodes integer, ways integer, num integer);',
+    'DELETE FROM user_contributions;',
+    'INSERT INTO user_contributions (uid, user, nodes, ways, num) '
+    'SELECT uid, user, SUM(nodes), SUM(ways), SUM(nodes) + SUM(ways) FROM '
+    '(SELECT uid, user, COUNT(*) AS nodes, 0 AS ways FROM nodes GROUP BY uid, user '
+    'UNION ALL SELECT uid, user, 0, COUNT(*) FROM ways GROUP BY uid, user) '
+    'GROUP BY uid, user;',
+    'CREATE INDEX IF NOT EXISTS user_contributions_user ON user_contributions (user, num);',
+    'CREATE INDEX IF NOT EXISTS user_contributions_uid ON user_contributions (uid, user);']
+
+# Settings for the bulk load. The journal is kept in memory and the data is not synced to
+# disk on every commit: if the load crashes the database has to be built again anyway.
+BULK_PRAGMAS = ['PRAGMA journal_mode = MEMORY',
+                'PRAGMA synchronous = OFF',
+                'PRAGMA cache_size = -200000',
+                'PRAGMA temp_store = MEMORY']
+
+BATCH_SIZE = 50000
+
+# Return the CREATE TABLE statement of a table, with the column types of schema.py.
+def create_table_sql(table, key, fields):
+    columns = schema.schema[key]['schema']
+    if schema.schema[key]['type'] == 'list':
+        columns = columns['schema']
+    definitions = ['{} {}'.format(field, SQL_TYPES[columns[field]['type']]) for field in fields]
+    return 'CREATE TABLE IF NOT EXISTS {} ({});'.format(table, ', '.join(definitions))
+
+def insert_sql(table, fields):
+    return 'INSERT INTO {} ({}) VALUES ({});'.format(table, ', '.join(fields),
+                                                      ', '.join('?' * len(fields)))
+
+def create_tables(conn, drop=False):
+    for table, key, fields in TABLES:
+        if drop:
+            conn.execute('DROP TABLE IF EXISTS {};'.format(table))
+        conn.execute(create_table_sql(table, key, fields))
+    # The geometry of the ways is not part of the shaped elements, see way_geometry.py.
+    if drop:
+        conn.execute('DROP TABLE IF EXISTS ways_geometry;')
+    conn.execute(way_geometry.GEOMETRY_TABLE_SQL)
+    # The tag counts of tag_stats.py.
+    tag_stats.create_tag_stats(conn, drop)
+
+def create_indexes(conn):
+    for name, table, columns in INDEXES:
+        unique = 'UNIQUE ' if name in UNIQUE_INDEXES else ''
+        conn.execute('CREATE {}INDEX IF NOT EXISTS {} ON {} ({});'.format(unique, name, table,
+                                                                          columns))
+
+def refresh_user_contributions(conn):
+    for sql in USER_CONTRIBUTIONS_SQL:
+        conn.execute(sql)
+
+# Build the table of a database which does not have it yet, and the uid index the updates of
+# UserContributions use.
+def ensure_user_contributions(conn):
+    if not conn.execute('SELECT 1 FROM sqlite_master '
+                        'WHERE name = "user_contributions";').fetchone():
+        refresh_user_contributions(conn)
+    conn.execute(USER_CONTRIBUTIONS_SQL[-1])
+
+# The changes to user_contributions while the database is changed, e.g. by apply_osc.py, so
+# the table is updated for the users of the changed elements instead of counted again.
+class UserContributions(object):
+
+    # The change to the number of nodes and ways, by (uid, user).
+    def __init__(self):
+        self.counts = {'nodes': Counter(), 'ways': Counter()}
+
+    # Count the element with the given uid and user, or with sign=-1 uncount it.
+    def add(self, table, uid, user, sign=1):
+        if table in self.counts:
+            self.counts[table][(uid, user)] += sign
+
+    # Count the element of the table with that id as it is in the database.
+    def add_stored(self, conn, table, element_id, sign=1):
+        if table in self.counts:
+            for uid, user in conn.execute('SELECT uid, user FROM {} WHERE id = ?;'.format(table),
+                                          (element_id,)):
+                self.add(table, uid, user, sign)
+
+    # Add the changes to the table, in the transaction of the caller, and start over. The
+    # users are matched with IS, as the uid and user of anonymous edits can be NULL.
+    def flush(self, conn):
+        nodes, ways = self.counts['nodes'], self.counts['ways']
+        removed = False
+        for group in set(nodes) | set(ways):
+            delta = (nodes[group], ways[group])
+            if not any(delta):
+                continue
+            removed = removed or min(delta) < 0
+            updated = conn.execute('UPDATE user_contributions SET nodes = nodes + ?, '
+                                   'ways = ways + ?, num = num + ? WHERE uid IS ? AND user IS ?;',
+                                   delta + (sum(delta),) + group).rowcount
+            if not updated:
+                conn.execute('INSERT INTO user_contributions (uid, user, nodes, ways, num) '
+                             'VALUES (?, ?, ?, ?, ?);', group + delta + (sum(delta),))
+        if removed:
+            conn.execute('DELETE FROM user_contributions WHERE num <= 0;')
+        nodes.clear()
+        ways.clear()
+
+# Run once the tables are loaded: create the indexes and the spatial index (see spatial.py),
+# fill the user_contributions table and gather the statistics the query planner uses to
+# pick the indexes.
+def finish_load(conn):
+    create_indexes(conn)
+    spatial.build_spatial_index(conn)
+    refresh_user_contributions(conn)
+    conn.execute('ANALYZE;')
+    conn.commit()
+
+def connect(db_path=DB_PATH, bulk=False):
+    # isolation_level=None lets us open and close the transactions ourselves.
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    if bulk:
+        for pragma in BULK_PRAGMAS:
+            conn.execute(pragma)
+    return conn
+
+# Insert the pending rows of every table in one transaction and empty the batch. The tag
+# counts of the batch are added to the tables of tag_stats.py in the same transaction.
+def flush(conn, batch, stats=None):
+    conn.execute('BEGIN')
+    for table, key, fields in TABLES:
+        if batch[key]:
+            conn.executemany(insert_sql(table, fields), batch[key])
+            del batch[key][:]
+    if stats is not None:
+        stats.flush(conn)
+    conn.execute('COMMIT')
+
+# Missing attributes are stored as empty strings, the same as the csv files would have them.
+def element_rows(el, key, fields):
+    rows = el[key]
+    if isinstance(rows, dict):
+        rows = [rows]
+    return [tuple(row.get(field, '') for field in fields) for row in rows]
+
+# Insert the rows of way_geometry.iter_way_geometry() in batches, each in its own transaction.
+def load_way_geometry(conn, file_in, batch_size=BATCH_SIZE):
+    sql = insert_sql('ways_geometry', way_geometry.WAY_GEOMETRY_FIELDS)
+    batch = []
+    for row in way_geometry.iter_way_geometry(file_in):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            conn.execute('BEGIN')
+            conn.executemany(sql, batch)
+            conn.execute('COMMIT')
+            batch = []
+    conn.execute('BEGIN')
+    conn.executemany(sql, batch)
+    conn.execute('COMMIT')
+
+# With geometry=True a second pass over the file fills the ways_geometry table.
+def load_map(file_in, db_path=DB_PATH, validate=False, batch_size=BATCH_SIZE, geometry=True):
+    t0 = time.time()
+    conn = connect(db_path, bulk=True)
+    create_tables(conn, drop=True)
+
+    validator = compile_schema()
+    batch = {key: [] for _, key, _ in TABLES}
+    fields = {key: table_fields for _, key, table_fields in TABLES}
+    stats = tag_stats.TagStats()
+    pending = 0
+    for element in get_element(file_in):
+        el = shape_element(element)
+        if el:
+            if validate is True:
+                errors = validator(el)
+                if errors:
+                    raise ValidationError(error_message(errors))
+            stats.add_shaped(el)
+            for key in el:
+                rows = element_rows(el, key, fields[key])
+                batch[key].extend(rows)
+                pending += len(rows)
+            if pending >= batch_size:
+                flush(conn, batch, stats)
+                pending = 0
+    flush(conn, batch, stats)
+    if geometry:
+        load_way_geometry(conn, file_in, batch_size)
+
+    finish_load(conn)
+    conn.close()
+    print("Loaded {} into {} in {} s".format(file_in, db_path, round(time.time() - t0, 3)))
+
+
+if __name__ == '__main__':
+    load_map('san-jose_california.osm')
@@ -0,0 +1,424 @@
+# Read OpenStreetMap PBF files (.osm.pbf).
+
+# The same extracts are shipped as .osm.pbf, which is several times smaller than the xml
+# and much faster to decode than it is to parse the xml. A pbf file is a sequence of blobs,
+# each one a zlib compressed protobuf message holding up to 8000 elements:
+#
+#   [4 bytes: length of the BlobHeader][BlobHeader][Blob]
+#
+# This module decodes the messages with plain Python, see
+# https://wiki.openstreetmap.org/wiki/PBF_Format, and yields the elements as the same
+# ElementTree elements iterparse gives for the xml of the file, so get_element() and
+# shape_element() take a pbf file like any other (see iterative_parsing.get_element()):
+#
+#   <node id=".." lat=".." lon=".." version=".." timestamp=".." changeset=".." uid=".."
+#         user=".."><tag k=".." v=".."/></node>
+#
+# The coordinates are written with 7 decimals, as the OSM API writes them in the xml.
+# With workers > 1 the blobs are decompressed and decoded in a pool of processes, in
+# order, at most a few blobs per worker ahead of the consumer.
+
+import struct
+import time
+import zlib
+import numpy as np
+import xml.etree.cElementTree as ET
+from multiprocessing import Pool
+
+ELEMENT_TAGS = ('node', 'way', 'relation')
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+BLOBS_AHEAD = 4
+
+# ================================================== #
+#               Protobuf Decoding                    #
+# ================================================== #
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+# Yield (field number, value) for every field of a message. The value is an int for the
+# varints and bytes for the length delimited fields (strings, messages, packed lists).
+def iter_fields(buf):
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        # Field keys and small values are a single byte.
+        key = buf[pos]
+        if key < 0x80:
+            pos += 1
+        else:
+            key, pos = read_varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value = buf[pos]
+            if value < 0x80:
+                pos += 1
+            else:
+                value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            size, pos = read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("unsupported protobuf wire type {}".format(wire_type))
+        yield key >> 3, value
+
+# Packed lists shorter than this are decoded in Python, the longer ones with numpy.
+PACKED_NUMPY_SIZE = 64
+
+# A packed list of varints.
+def packed(buf):
+    if len(buf) >= PACKED_NUMPY_SIZE:
+        return packed_array(buf).tolist()
+    values = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        result = 0
+        shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            result |= (b & 0x7f) << shift
+            if not b & 0x80:
+                break
+            shift += 7
+        values.append(result)
+    return values
+
+# The same as an uint64 array: the last byte of each varint is the one below 0x80, and the
+# 7 bit groups of a varint are shifted into place and summed.
+def packed_array(buf):
+    data = np.frombuffer(buf, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    if not len(ends):
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    shifts = (np.arange(ends[-1] + 1) - np.repeat(starts, ends - starts + 1)) * 7
+    groups = (data[:ends[-1] + 1] & 0x7f).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(groups, starts)
+
+def zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+# A packed list of sint64 (zigzag encoded), each value a delta from the previous one.
+def packed_delta(buf):
+    if len(buf) >= PACKED_NUMPY_SIZE:
+        return packed_delta_array(buf).tolist()
+    values = []
+    last = 0
+    for n in packed(buf):
+        last += (n >> 1) ^ -(n & 1)
+        values.append(last)
+    return values
+
+# The same as an int64 array.
+def packed_delta_array(buf):
+    values = packed_array(buf)
+    deltas = (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+    return np.cumsum(deltas)
+
+# int32 / int64 fields are varints of the 64 bit two's complement.
+def signed(n):
+    return n - (1 << 64) if n >= 1 << 63 else n
+
+# ================================================== #
+#               Blocks                               #
+# ================================================== #
+
+def blob_data(blob):
+    for field, value in iter_fields(blob):
+        if field == 1:
+            return value
+        if field == 3:
+            return zlib.decompress(value)
+        if field == 4:
+            import lzma
+            return lzma.decompress(value)
+        if field == 7:
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(value)
+    raise ValueError("unsupported blob compression")
+
+# 1e-9 degrees to the xml text, with 7 decimals.
+def format_coordinate(nano):
+    units = (abs(nano) + 50) // 100
+    sign = '-' if nano < 0 and units else ''
+    return '{}{}.{:07d}'.format(sign, units // 10000000, units % 10000000)
+
+# The same for an array of them.
+def format_coordinates(nano):
+    units = (np.abs(nano) + 50) // 100
+    signs = np.where((nano < 0) & (units > 0), '-', '')
+    return ['{}{}.{:07d}'.format(sign, degrees, fraction) for sign, degrees, fraction in
+            zip(signs, (units // 10000000).tolist(), (units % 10000000).tolist())]
+
+class Block(object):
+
+    # The string table and the settings of a PrimitiveBlock.
+    def __init__(self, data):
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        for field, value in iter_fields(data):
+            if field == 1:
+                self.strings = [s.decode('utf-8') for f, s in iter_fields(value) if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = signed(value)
+            elif field == 18:
+                self.date_granularity = signed(value)
+            elif field == 19:
+                self.lat_offset = signed(value)
+            elif field == 20:
+                self.lon_offset = signed(value)
+
+    def lat(self, lat):
+        return format_coordinate(self.lat_offset + self.granularity * lat)
+
+    def lon(self, lon):
+        return format_coordinate(self.lon_offset + self.granularity * lon)
+
+    def timestamp(self, timestamp):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                             time.gmtime(timestamp * self.date_granularity // 1000))
+
+    # The attributes of an Info message.
+    def info(self, data, attrib):
+        for field, value in iter_fields(data):
+            if field == 1:
+                attrib['version'] = str(signed(value))
+            elif field == 2:
+                attrib['timestamp'] = self.timestamp(signed(value))
+            elif field == 3:
+                attrib['changeset'] = str(signed(value))
+            elif field == 4:
+                attrib['uid'] = str(signed(value))
+            elif field == 5:
+                attrib['user'] = self.strings[value]
+
+    def tags(self, keys, values):
+        strings = self.strings
+        return [('tag', {'k': strings[k], 'v': strings[v]}) for k, v in zip(keys, values)]
+
+    # Decode the elements of every PrimitiveGroup of the block into (tag, attrib, children)
+    # tuples, children being (tag, attrib) tuples. Only the elements in 'tags' are kept.
+    def elements(self, tags):
+        elements = []
+        for group in self.groups:
+            for field, value in iter_fields(group):
+                if field == 2 and 'node' in tags:
+                    elements.extend(self.dense_nodes(value))
+                elif field == 1 and 'node' in tags:
+                    elements.append(self.node(value))
+                elif field == 3 and 'way' in tags:
+                    elements.append(self.way(value))
+                elif field == 4 and 'relation' in tags:
+                    elements.append(self.relation(value))
+        return elements
+
+    def node(self, data):
+        attrib = {}
+        keys, values = [], []
+        lat = lon = 0
+        for field, value in iter_fields(data):
+            if field == 1:
+                attrib['id'] = str(zigzag(value))
+            elif field == 2:
+                keys = packed(value)
+            elif field == 3:
+                values = packed(value)
+            elif field == 4:
+                self.info(value, attrib)
+            elif field == 8:
+                lat = zigzag(value)
+            elif field == 9:
+                lon = zigzag(value)
+        attrib['lat'] = self.lat(lat)
+        attrib['lon'] = self.lon(lon)
+        return 'node', attrib, self.tags(keys, values)
+
+    def dense_nodes(self, data):
+        ids = lats = lons = np.zeros(0, dtype=np.int64)
+        keys_vals = []
+        info = {}
+        for field, value in iter_fields(data):
+            if field == 1:
+                ids = packed_delta_array(value)
+            elif field == 5:
+                info = self.dense_info(value)
+            elif field == 8:
+                lats = packed_delta_array(value)
+            elif field == 9:
+                lons = packed_delta_array(value)
+            elif field == 10:
+                keys_vals = packed(value)
+
+        ids = [str(node_id) for node_id in ids.tolist()]
+        lats = format_coordinates(self.lat_offset + self.granularity * lats)
+        lons = format_coordinates(self.lon_offset + self.granularity * lons)
+        info = list(info.items())
+        strings = self.strings
+        nodes = []
+        kv = 0
+        for i, node_id in enumerate(ids):
+            attrib = {'id': node_id, 'lat': lats[i], 'lon': lons[i]}
+            for name, column in info:
+                attrib[name] = column[i]
+            children = []
+            # The tags of the nodes, as key, value, ..., 0 for each node.
+            if keys_vals:
+                while keys_vals[kv] != 0:
+                    children.append(('tag', {'k': strings[keys_vals[kv]],
+                                             'v': strings[keys_vals[kv + 1]]}))
+                    kv += 2
+                kv += 1
+            nodes.append(('node', attrib, children))
+        return nodes
+
+    # The attributes of the dense nodes, as columns of strings.
+    def dense_info(self, data):
+        info = {}
+        for field, value in iter_fields(data):
+            if field == 1:
+                info['version'] = [str(v) for v in packed(value)]
+            elif field == 2:
+                timestamps = packed_delta(value)
+                formatted = {t: self.timestamp(t) for t in set(timestamps)}
+                info['timestamp'] = [formatted[t] for t in timestamps]
+            elif field == 3:
+                info['changeset'] = [str(c) for c in packed_delta(value)]
+            elif field == 4:
+                info['uid'] = [str(u) for u in packed_delta(value)]
+            elif field == 5:
+                strings = self.strings
+                info['user'] = [strings[u] for u in packed_delta(value)]
+        return info
+
+    def way(self, data):
+        attrib = {}
+        keys, values, refs = [], [], []
+        for field, value in iter_fields(data):
+            if field == 1:
+                attrib['id'] = str(signed(value))
+            elif field == 2:
+                keys = packed(value)
+            elif field == 3:
+                values = packed(value)
+            elif field == 4:
+                self.info(value, attrib)
+            elif field == 8:
+                refs = packed_delta(value)
+        children = [('nd', {'ref': str(ref)}) for ref in refs]
+        return 'way', attrib, children + self.tags(keys, values)
+
+    def relation(self, data):
+        attrib = {}
+        keys, values, roles, member_ids, member_types = [], [], [], [], []
+        for field, value in iter_fields(data):
+            if field == 1:
+                attrib['id'] = str(signed(value))
+            elif field == 2:
+                keys = packed(value)
+            elif field == 3:
+                values = packed(value)
+            elif field == 4:
+                self.info(value, attrib)
+            elif field == 8:
+                roles = packed(value)
+            elif field == 9:
+                member_ids = packed_delta(value)
+            elif field == 10:
+                member_types = packed(value)
+        children = [('member', {'type': MEMBER_TYPES[member_type], 'ref': str(member_id),
+                                'role': self.strings[role]})
+                    for member_type, member_id, role in zip(member_types, member_ids, roles)]
+        return 'relation', attrib, children + self.tags(keys, values)
+
+# Decompress and decode one OSMData blob. Runs in the workers of the parallel mode.
+def decode_blob(args):
+    blob, tags = args
+    return Block(blob_data(blob)).elements(tags)
+
+# ================================================== #
+#               Files                                #
+# ================================================== #
+
+# Yield the OSMData blobs of a file, still compressed.
+def iter_blobs(pbf_file):
+    with open(pbf_file, 'rb') as f:
+        while True:
+            head = f.read(4)
+            if not head:
+                return
+            header = f.read(struct.unpack('>I', head)[0])
+            blob_type, size = None, 0
+            for field, value in iter_fields(header):
+                if field == 1:
+                    blob_type = value.decode('utf-8')
+                elif field == 3:
+                    size = value
+            blob = f.read(size)
+            if blob_type == 'OSMData':
+                yield blob
+
+def build_element(tag, attrib, children):
+    element = ET.Element(tag, attrib)
+    for child_tag, child_attrib in children:
+        ET.SubElement(element, child_tag, child_attrib)
+    return element
+
+class PbfFile(object):
+
+    # A pbf file, read with 'workers' processes. get_element() takes it like a path.
+    def __init__(self, path, workers=1):
+        self.path = path
+        self.workers = workers
+
+    def iter_elements(self, tags=ELEMENT_TAGS):
+        tags = frozenset(tags)
+        for elements in self.iter_blocks(tags):
+            for tag, attrib, children in elements:
+                yield build_element(tag, attrib, children)
+
+    # The decoded elements of every blob, in file order.
+    def iter_blocks(self, tags):
+        if self.workers <= 1:
+            for blob in iter_blobs(self.path):
+                yield decode_blob((blob, tags))
+            return
+
+        pool = Pool(self.workers)
+        try:
+            pending = []
+            for blob in iter_blobs(self.path):
+                pending.append(pool.apply_async(decode_blob, ((blob, tags),)))
+                if len(pending) >= self.workers * BLOBS_AHEAD:
+                    yield pending.pop(0).get()
+            for result in pending:
+                yield result.get()
+        finally:
+            pool.terminate()
+            pool.join()
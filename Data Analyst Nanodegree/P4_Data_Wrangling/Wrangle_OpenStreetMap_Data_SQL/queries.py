@@ -1,88 +1,101 @@
 import sqlite3
+import sys
+import time
 import pandas as pd
 
+# Run with --explain to print the query plan and the time of every query:
+#   python queries.py --explain
+# The queries rely on the indexes, the user_contributions table and the tag counts created
+# when the database is built (see osm_db.finish_load() and tag_stats.py), so none of them
+# scans a whole table.
+EXPLAIN = '--explain' in sys.argv
+
 # Connect to db.
 db = sqlite3.connect("san-jose_california.db")
 c = db.cursor()
 
-# Create a function to show quries as pandas dataframes.
-def query_to_pandas(query, Title):
+# Execute a query and return its rows. In --explain mode print its plan and time too.
+def run_query(query, Title):
+    if EXPLAIN:
+        print('')
+        print('Query plan: {}'.format(Title))
+        for row in c.execute('EXPLAIN QUERY PLAN ' + query):
+            print('    ' + row[-1])
+    t0 = time.time()
     c.execute(query)
     rows = c.fetchall()
+    if EXPLAIN:
+        print('    time: {:.2f} ms'.format((time.time() - t0) * 1000))
+    return rows
+
+# Create a function to show quries as pandas dataframes.
+def query_to_pandas(query, Title):
+    rows = run_query(query, Title)
     df = pd.DataFrame(rows)
     print('')
     print(Title)
     print(df.head(8))
 
-query_to_pandas('select * from nodes', 'Nodes')
-query_to_pandas('select * from ways', 'Ways')
-query_to_pandas('select * from nodes_tags', 'Nodes tags')
-query_to_pandas('select * from ways_tags', 'Ways tags')
+query_to_pandas('select * from nodes limit 8', 'Nodes')
+query_to_pandas('select * from ways limit 8', 'Ways')
+query_to_pandas('select * from nodes_tags limit 8', 'Nodes tags')
+query_to_pandas('select * from ways_tags limit 8', 'Ways tags')
 
 # Create a function which executes queries and prints output.
 def query_func(query, Title):
     # Execute query and print output.
-    c.execute(query)
-    rows = c.fetchall()
+    rows = run_query(query, Title)
 
     # Loop over data.
     print('')
     print(Title)
     for row in rows:
         print(row[0])
-        
-query_func('SELECT COUNT(*) FROM nodes;', 'Number of nodes')
 
-query_func('SELECT COUNT(*) FROM ways;', 'Number of ways')
+query_func('SELECT SUM(nodes) FROM user_contributions;', 'Number of nodes')
 
-query_func('SELECT COUNT(DISTINCT(e.uid)) FROM (SELECT uid FROM nodes \
-            UNION ALL SELECT uid FROM ways) as e;', 'Number of unique users')
+query_func('SELECT SUM(ways) FROM user_contributions;', 'Number of ways')
 
-query_func('SELECT COUNT(*) FROM (SELECT e.user, COUNT(*) as num \
-            FROM (SELECT user FROM nodes UNION ALL SELECT user FROM ways) as e \
-            GROUP BY e.user HAVING num=1)  u;', 'Number of users appearing only once')
+query_func('SELECT COUNT(DISTINCT(uid)) FROM user_contributions;', 'Number of unique users')
 
-query_func('SELECT e.user, COUNT(*) as num FROM \
-            (SELECT user FROM nodes UNION ALL SELECT user FROM ways) as e \
-            GROUP BY e.user ORDER BY num DESC LIMIT 5;', 'Top 5 contributing users')
+query_func('SELECT COUNT(*) FROM (SELECT user, SUM(num) as num FROM user_contributions \
+            GROUP BY user HAVING num=1)  u;', 'Number of users appearing only once')
 
-query_func('SELECT value, COUNT(*) as num FROM nodes_tags \
-           WHERE key="amenity" GROUP BY value ORDER BY num DESC LIMIT 5;', 'Top 5 amenities')
+query_func('SELECT user, SUM(num) as num FROM user_contributions \
+            GROUP BY user ORDER BY num DESC LIMIT 5;', 'Top 5 contributing users')
+
+# The tag counts are kept in the tables of tag_stats.py while the database is loaded, so
+# the top N tag values are read from a few rows of those tables instead of being counted
+# over nodes_tags.
+query_func('SELECT value, num FROM tag_value_counts \
+           WHERE element="node" AND key="amenity" ORDER BY num DESC LIMIT 5;', 'Top 5 amenities')
 
-query_func('SELECT nodes_tags.value, COUNT(*) as num FROM nodes_tags \
-           JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value ="restaurant") as i \
-           ON nodes_tags.id = i.id WHERE nodes_tags.key ="cuisine" \
-           GROUP BY nodes_tags.value ORDER BY num DESC LIMIT 5;', 'Top 5 cuisine')
+# The cuisine, cafe, bank and religion questions count the tags of the nodes with the given
+# value under any key (e.g. a cuisine tag of a node with building="restaurant" counts too),
+# which amenity_tag_counts, limited to amenity=<value>, doesn't answer. The ids of those
+# nodes come from the (value, id) index and their tags of the key from the (id, key, value)
+# index, so these queries only read the two covering indexes.
+query_func('SELECT value, COUNT(*) as num FROM nodes_tags \
+           WHERE key ="cuisine" AND id IN (SELECT id FROM nodes_tags WHERE value ="restaurant") \
+           GROUP BY value ORDER BY num DESC LIMIT 5;', 'Top 5 cuisine')
 
-query_func('SELECT nodes_tags.value, COUNT(*) as num FROM nodes_tags \
-           JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value ="cafe") as i \
-           ON nodes_tags.id = i.id WHERE nodes_tags.key ="name" \
-           GROUP BY nodes_tags.value ORDER BY num DESC LIMIT 5;', 'Top 5 cafes')
+query_func('SELECT value, COUNT(*) as num FROM nodes_tags \
+           WHERE key ="name" AND id IN (SELECT id FROM nodes_tags WHERE value ="cafe") \
+           GROUP BY value ORDER BY num DESC LIMIT 5;', 'Top 5 cafes')
 
-query_func('SELECT nodes_tags.value, COUNT(*) as num FROM nodes_tags \
-           JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value ="bank") as i \
-           ON nodes_tags.id = i.id WHERE nodes_tags.key ="name" \
-           GROUP BY nodes_tags.value ORDER BY num DESC LIMIT 3;', 'Top 3 banks')
+query_func('SELECT value, COUNT(*) as num FROM nodes_tags \
+           WHERE key ="name" AND id IN (SELECT id FROM nodes_tags WHERE value ="bank") \
+           GROUP BY value ORDER BY num DESC LIMIT 3;', 'Top 3 banks')
 
-query_func('SELECT nodes_tags.value, COUNT(*) as num FROM nodes_tags \
-           JOIN (SELECT DISTINCT(id) FROM nodes_tags WHERE value ="place_of_worship") as i \
-           ON nodes_tags.id = i.id WHERE nodes_tags.key ="religion" \
-           GROUP BY nodes_tags.value ORDER BY num DESC LIMIT 2;', 'Top 2 religions')
+query_func('SELECT value, COUNT(*) as num FROM nodes_tags \
+           WHERE key ="religion" AND id IN (SELECT id FROM nodes_tags WHERE value ="place_of_worship") \
+           GROUP BY value ORDER BY num DESC LIMIT 2;', 'Top 2 religions')
 
 # Find the top 10 users contribution percentage.
-query1 = 'SELECT SUM(num) FROM (SELECT e.user, COUNT(*) as num FROM \
-        (SELECT user FROM nodes UNION ALL SELECT user FROM ways) as e \
-        GROUP BY e.user ORDER BY num DESC LIMIT 10);'
+query = 'SELECT (SELECT SUM(num) FROM (SELECT user, SUM(num) as num FROM user_contributions \
+        GROUP BY user ORDER BY num DESC LIMIT 10)), (SELECT SUM(num) FROM user_contributions);'
 
-query2 = 'SELECT SUM(num) FROM (SELECT e.user, COUNT(*) as num FROM \
-        (SELECT user FROM nodes UNION ALL SELECT user FROM ways) as e \
-        GROUP BY e.user);'
-
-c.execute(query1)
-top10 = c.fetchone()[0]
-    
-c.execute(query2)
-total = c.fetchone()[0]
+top10, total = run_query(query, 'Top 10 users contribution')[0]
 
 percentage = round(top10*100/total, 0)
 print()
@@ -90,4 +103,3 @@ print('Top 10 users contribution percentage: {}%'.format(percentage))
 
 
 db.close()
-
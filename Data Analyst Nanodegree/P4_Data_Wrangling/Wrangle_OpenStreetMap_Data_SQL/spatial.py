@@ -0,0 +1,164 @@
+# Spatial index and queries over the sql database.
+
+# Finding the nodes around a point with "WHERE lat BETWEEN ... AND lon BETWEEN ..." scans the
+# whole nodes table, as an index on lat only narrows it down to a band around the earth.
+# The database build fills two SQLite R*Tree tables (see osm_db.finish_load()):
+# - nodes_rtree: one point box per node, from nodes.lat / lon
+# - ways_rtree: the bounding box of every way, from ways_geometry (see way_geometry.py)
+# An R*Tree answers "which boxes overlap this box" by reading only a few pages.
+#
+# The R*Tree stores the coordinates as 32 bit floats, rounded outwards, so it is only used
+# to find the candidates; the exact lat / lon and distances come from the nodes table.
+#
+#   python spatial.py 37.3337 -121.8907 restaurant 1
+#
+# prints the restaurants within 1 km of the point, the 5 nearest nodes and the ways around it.
+
+import math
+import sqlite3
+import time
+
+DB_PATH = 'san-jose_california.db'
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Length of a degree of latitude.
+KM_PER_DEGREE = 2 * math.pi * EARTH_RADIUS_KM / 360
+
+RTREE_SQL = ['CREATE VIRTUAL TABLE IF NOT EXISTS nodes_rtree '
+             'USING rtree(id, min_lat, max_lat, min_lon, max_lon);',
+             'CREATE VIRTUAL TABLE IF NOT EXISTS ways_rtree '
+             'USING rtree(id, min_lat, max_lat, min_lon, max_lon);']
+
+FILL_NODES_SQL = ('INSERT OR REPLACE INTO nodes_rtree (id, min_lat, max_lat, min_lon, max_lon) '
+                  'SELECT id, lat, lat, lon, lon FROM nodes '
+                  'WHERE typeof(lat) = "real" AND typeof(lon) = "real"{};')
+
+FILL_WAYS_SQL = ('INSERT OR REPLACE INTO ways_rtree (id, min_lat, max_lat, min_lon, max_lon) '
+                 'SELECT id, min_lat, max_lat, min_lon, max_lon FROM ways_geometry '
+                 'WHERE min_lat IS NOT NULL{};')
+
+# (Re)build the R*Tree tables from the nodes and ways_geometry tables.
+def build_spatial_index(conn):
+    for table in ('nodes_rtree', 'ways_rtree'):
+        conn.execute('DROP TABLE IF EXISTS {};'.format(table))
+    for sql in RTREE_SQL:
+        conn.execute(sql)
+    conn.execute(FILL_NODES_SQL.format(''))
+    if conn.execute('SELECT 1 FROM sqlite_master WHERE name = "ways_geometry";').fetchone():
+        conn.execute(FILL_WAYS_SQL.format(''))
+
+# Build the R*Tree tables of a database which does not have them yet.
+def ensure_spatial_index(conn):
+    if not conn.execute('SELECT 1 FROM sqlite_master WHERE name = "nodes_rtree";').fetchone():
+        build_spatial_index(conn)
+
+# Update the R*Tree rows of changed nodes and ways, e.g. after applying a change file.
+def update_spatial_index(conn, node_ids=(), way_ids=()):
+    for node_id in node_ids:
+        conn.execute('DELETE FROM nodes_rtree WHERE id = ?;', (node_id,))
+        conn.execute(FILL_NODES_SQL.format(' AND id = ?'), (node_id,))
+    for way_id in way_ids:
+        conn.execute('DELETE FROM ways_rtree WHERE id = ?;', (way_id,))
+        conn.execute(FILL_WAYS_SQL.format(' AND id = ?'), (way_id,))
+
+# Great circle distance in km.
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+# The (min_lat, min_lon, max_lat, max_lon) box holding the circle of radius_km around a point.
+def radius_box(lat, lon, radius_km):
+    d_lat = radius_km / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(lat))
+    d_lon = 180.0 if cos_lat < 1e-9 else min(180.0, d_lat / cos_lat)
+    return (max(-90.0, lat - d_lat), lon - d_lon, min(90.0, lat + d_lat), lon + d_lon)
+
+BBOX_NODES_SQL = ('SELECT nodes.id, nodes.lat, nodes.lon FROM nodes_rtree '
+                  'JOIN nodes ON nodes.id = nodes_rtree.id '
+                  'WHERE nodes_rtree.max_lat >= ? AND nodes_rtree.min_lat <= ? '
+                  'AND nodes_rtree.max_lon >= ? AND nodes_rtree.min_lon <= ? '
+                  'AND nodes.lat BETWEEN ? AND ? AND nodes.lon BETWEEN ? AND ?')
+
+# The (id, lat, lon) of the nodes inside a bounding box.
+def bbox_nodes(conn, min_lat, min_lon, max_lat, max_lon):
+    return conn.execute(BBOX_NODES_SQL + ';', (min_lat, max_lat, min_lon, max_lon,
+                                               min_lat, max_lat, min_lon, max_lon)).fetchall()
+
+# The ids of the ways whose bounding box overlaps a bounding box.
+def bbox_ways(conn, min_lat, min_lon, max_lat, max_lon):
+    rows = conn.execute('SELECT id FROM ways_rtree WHERE max_lat >= ? AND min_lat <= ? '
+                        'AND max_lon >= ? AND min_lon <= ?;',
+                        (min_lat, max_lat, min_lon, max_lon))
+    return [row[0] for row in rows]
+
+# The (id, lat, lon, distance in km) of the nodes within radius_km of a point, nearest first.
+def radius_nodes(conn, lat, lon, radius_km):
+    min_lat, min_lon, max_lat, max_lon = radius_box(lat, lon, radius_km)
+    found = []
+    for node_id, node_lat, node_lon in bbox_nodes(conn, min_lat, min_lon, max_lat, max_lon):
+        distance = haversine(lat, lon, node_lat, node_lon)
+        if distance <= radius_km:
+            found.append((node_id, node_lat, node_lon, distance))
+    found.sort(key=lambda node: node[3])
+    return found
+
+# The k nodes nearest to a point, as in radius_nodes(). The radius is doubled until the
+# circle holds k nodes, starting from start_km.
+def nearest_nodes(conn, lat, lon, k=5, start_km=0.1):
+    radius_km = start_km
+    while True:
+        found = radius_nodes(conn, lat, lon, radius_km)
+        if len(found) >= k or radius_km > math.pi * EARTH_RADIUS_KM:
+            return found[:k]
+        radius_km *= 2
+
+# CROSS JOIN keeps the R*Tree as the outer loop. Otherwise the planner starts from all the
+# nodes with that amenity and looks each one up in the R*Tree, ~ 10 times slower.
+AMENITIES_SQL = ('SELECT nodes.id, nodes.lat, nodes.lon, names.value FROM nodes_rtree '
+                 'CROSS JOIN nodes ON nodes.id = nodes_rtree.id '
+                 'JOIN nodes_tags amenities ON amenities.id = nodes.id '
+                 'AND amenities.key = "amenity" AND amenities.value = ? '
+                 'LEFT JOIN nodes_tags names ON names.id = nodes.id AND names.key = "name" '
+                 'WHERE nodes_rtree.max_lat >= ? AND nodes_rtree.min_lat <= ? '
+                 'AND nodes_rtree.max_lon >= ? AND nodes_rtree.min_lon <= ?;')
+
+# The (id, lat, lon, name, distance in km) of the nodes with amenity=<amenity> within
+# radius_km of a point, nearest first. A node with more than one name shows up once per name.
+def amenities_within(conn, amenity, lat, lon, radius_km):
+    min_lat, min_lon, max_lat, max_lon = radius_box(lat, lon, radius_km)
+    found = []
+    for node_id, node_lat, node_lon, name in conn.execute(
+            AMENITIES_SQL, (amenity, min_lat, max_lat, min_lon, max_lon)):
+        distance = haversine(lat, lon, node_lat, node_lon)
+        if distance <= radius_km:
+            found.append((node_id, node_lat, node_lon, name, distance))
+    found.sort(key=lambda node: node[4])
+    return found
+
+# Print the result of a query and the time it took.
+def timed(title, query, *args):
+    t0 = time.time()
+    rows = query(*args)
+    print('')
+    print('{} ({} rows, {:.2f} ms)'.format(title, len(rows), (time.time() - t0) * 1000))
+    for row in rows[:10]:
+        print(row)
+    return rows
+
+
+if __name__ == '__main__':
+    import sys
+    lat, lon = float(sys.argv[1]), float(sys.argv[2])
+    amenity = sys.argv[3] if len(sys.argv) > 3 else 'restaurant'
+    radius_km = float(sys.argv[4]) if len(sys.argv) > 4 else 1.0
+
+    db = sqlite3.connect(DB_PATH)
+    ensure_spatial_index(db)
+    timed('{} within {} km'.format(amenity, radius_km), amenities_within, db, amenity, lat,
+          lon, radius_km)
+    timed('5 nearest nodes', nearest_nodes, db, lat, lon, 5)
+    timed('Ways within {} km'.format(radius_km), bbox_ways, db, *radius_box(lat, lon, radius_km))
+    db.close()
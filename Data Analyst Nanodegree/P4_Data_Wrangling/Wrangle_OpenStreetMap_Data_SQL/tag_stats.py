@@ -0,0 +1,120 @@
+# Tag statistics of the sql database, kept up to date while it is loaded.
+
+# The analytics of queries.py are top N frequency questions over the tag tables ("top 5
+# amenities", "top cuisines of the restaurants"). Instead of a GROUP BY over the whole of
+# nodes_tags for each one, the loader keeps the counts in three small tables:
+# - tag_key_counts (element, type, key, num): the tags of each (type, key), for each element
+#   type (node, way, relation)
+# - tag_value_counts (element, key, value, num): the tags of each (key, value)
+# - amenity_tag_counts (amenity, key, value, num): the cuisine, name and religion tags of the
+#   nodes with amenity=<amenity>, e.g. ('restaurant', 'cuisine', 'pizza', 42). The cuisine
+#   questions of queries.py match the value under any key, so they read the indexes of
+#   nodes_tags instead.
+# num counts the rows of the tag tables, so a tag the cleaning doubled (see data.py) counts
+# twice, the same as a GROUP BY over the table would.
+#
+# osm_db.load_map() adds the tags of every batch it inserts, apply_osc.py subtracts the old
+# tags of a changed element and adds the new ones, and create_db_from_csv.py, which inserts
+# the csv files as they are, builds the tables from the tag tables at the end of the load.
+
+from collections import Counter
+
+# The element type, its tag table and the key of the tags in the shaped element.
+TAG_TABLES = [('node', 'nodes_tags', 'node_tags'),
+              ('way', 'ways_tags', 'way_tags'),
+              ('relation', 'relations_tags', 'relation_tags')]
+
+# The keys counted for every amenity in amenity_tag_counts.
+COOCCURRENCE_KEYS = ('cuisine', 'name', 'religion')
+
+# The tables, the columns the counts are grouped by and their types.
+STATS_TABLES = [('tag_key_counts', ['element', 'type', 'key']),
+                ('tag_value_counts', ['element', 'key', 'value']),
+                ('amenity_tag_counts', ['amenity', 'key', 'value'])]
+
+# The unique indexes make the updates of the counts fast and answer the top N queries, e.g.
+# element = "node" AND key = "amenity", without reading the other rows.
+def create_tag_stats(conn, drop=False):
+    for table, columns in STATS_TABLES:
+        if drop:
+            conn.execute('DROP TABLE IF EXISTS {};'.format(table))
+        conn.execute('CREATE TABLE IF NOT EXISTS {} ({}, num integer);'.format(
+            table, ', '.join('{} text'.format(column) for column in columns)))
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS {0}_index ON {0} ({1});'.format(
+            table, ', '.join(columns)))
+
+REBUILD_SQL = [
+    'INSERT INTO tag_key_counts (element, type, key, num) '
+    'SELECT "{element}", type, key, COUNT(*) FROM {table} GROUP BY type, key;',
+    'INSERT INTO tag_value_counts (element, key, value, num) '
+    'SELECT "{element}", key, value, COUNT(*) FROM {table} GROUP BY key, value;']
+
+REBUILD_AMENITIES_SQL = (
+    'INSERT INTO amenity_tag_counts (amenity, key, value, num) '
+    'SELECT amenities.value, tags.key, tags.value, COUNT(*) '
+    'FROM (SELECT DISTINCT id, value FROM nodes_tags WHERE key = "amenity") amenities '
+    'JOIN nodes_tags tags ON tags.id = amenities.id '
+    'WHERE tags.key IN ({}) '
+    'GROUP BY amenities.value, tags.key, tags.value;'.format(
+        ', '.join('"{}"'.format(key) for key in COOCCURRENCE_KEYS)))
+
+# Count the tags of the tag tables from scratch, e.g. after the csv files are imported.
+def rebuild_tag_stats(conn):
+    create_tag_stats(conn)
+    for table, _ in STATS_TABLES:
+        conn.execute('DELETE FROM {};'.format(table))
+    for element, table, _ in TAG_TABLES:
+        for sql in REBUILD_SQL:
+            conn.execute(sql.format(element=element, table=table))
+    conn.execute(REBUILD_AMENITIES_SQL)
+
+# Build the tables of a database which does not have them yet.
+def ensure_tag_stats(conn):
+    if not conn.execute('SELECT 1 FROM sqlite_master WHERE name = "tag_key_counts";').fetchone():
+        rebuild_tag_stats(conn)
+
+class TagStats(object):
+
+    # The changes to the counts since the last flush(), by table and grouping columns.
+    def __init__(self):
+        self.counts = {table: Counter() for table, _ in STATS_TABLES}
+
+    # Count the (key, value, type) tags of an element, or with sign=-1 uncount them.
+    def add(self, element, tags, sign=1):
+        keys = self.counts['tag_key_counts']
+        values = self.counts['tag_value_counts']
+        for key, value, tag_type in tags:
+            keys[(element, tag_type, key)] += sign
+            values[(element, key, value)] += sign
+        if element == 'node':
+            amenities = set(value for key, value, _ in tags if key == 'amenity')
+            if amenities:
+                cooccurrences = self.counts['amenity_tag_counts']
+                for key, value, _ in tags:
+                    if key in COOCCURRENCE_KEYS:
+                        for amenity in amenities:
+                            cooccurrences[(amenity, key, value)] += sign
+
+    # Count the tags of an element shaped by shape_element().
+    def add_shaped(self, el, sign=1):
+        for element, _, key in TAG_TABLES:
+            if key in el:
+                self.add(element, [(tag['key'], tag['value'], tag['type']) for tag in el[key]],
+                         sign)
+                return
+
+    # Add the changes to the tables, in the transaction of the caller, and start over.
+    def flush(self, conn):
+        for table, columns in STATS_TABLES:
+            counts = self.counts[table]
+            rows = [group for group, num in counts.items() if num]
+            if not rows:
+                continue
+            where = ' AND '.join('{} = ?'.format(column) for column in columns)
+            conn.executemany('INSERT OR IGNORE INTO {} ({}, num) VALUES ({}, 0);'.format(
+                table, ', '.join(columns), ', '.join('?' * len(columns))), rows)
+            conn.executemany('UPDATE {} SET num = num + ? WHERE {};'.format(table, where),
+                             [(counts[group],) + group for group in rows])
+            if any(counts[group] < 0 for group in rows):
+                conn.execute('DELETE FROM {} WHERE num <= 0;'.format(table))
+            counts.clear()
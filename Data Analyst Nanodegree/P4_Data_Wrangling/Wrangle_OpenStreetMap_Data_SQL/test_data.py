@@ -0,0 +1,152 @@
+# Regression tests of process_map() on a small fixture map.
+
+# The csv files of a plain serial run are the reference. The parallel (sharded) run, the runs
+# over the compressed and pbf versions of the map and a run resumed from a checkpoint after a
+# crash must write the same files, byte for byte.
+#
+#   python -m pytest test_data.py
+
+import bz2
+import gzip
+import os
+from xml.sax.saxutils import quoteattr
+
+import pytest
+
+import checkpoint
+import data
+
+STREETS = ['Main St', 'First Street', 'Park Ave', 'Almaden Expy', 'Oak Rd']
+PHONES = ['+1 408 9745050', '(408) 555-1234', '408.555.9876', '+1-408-654-9860']
+POSTCODES = ['95112', 'CA 95110', '95014-1234', 'CA95050']
+AMENITIES = ['restaurant', 'cafe', 'bank', 'place_of_worship']
+
+def element_xml(tag, attrib, children):
+    attrs = ' '.join('{}={}'.format(k, quoteattr(str(v))) for k, v in attrib)
+    if not children:
+        return '  <{} {}/>'.format(tag, attrs)
+    lines = ['  <{} {}>'.format(tag, attrs)]
+    for child_tag, child_attrib in children:
+        lines.append('    <{} {}/>'.format(child_tag, ' '.join(
+            '{}={}'.format(k, quoteattr(str(v))) for k, v in child_attrib)))
+    lines.append('  </{}>'.format(tag))
+    return '\n'.join(lines)
+
+def tag(k, v):
+    return ('tag', [('k', k), ('v', v)])
+
+def meta(i):
+    return [('version', i % 5 + 1), ('timestamp', '2015-0{}-01T00:00:00Z'.format(i % 9 + 1)),
+            ('changeset', 1000 + i), ('uid', i % 7), ('user', ['bob', 'Zoë', 'x"y'][i % 3])]
+
+# Nodes, ways and relations with the street names, phone numbers and postcodes data.py
+# cleans, in the order of an extract.
+def write_fixture_map(path, nodes=60, ways=15, relations=4):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6" generator="test">']
+    for i in range(nodes):
+        tags = []
+        if i % 2 == 0:
+            tags.append(tag('addr:street', STREETS[i % len(STREETS)]))
+        if i % 3 == 0:
+            tags.append(tag('phone', PHONES[i % len(PHONES)]))
+        if i % 4 == 0:
+            tags.append(tag('addr:postcode', POSTCODES[i % len(POSTCODES)]))
+        if i % 5 == 0:
+            tags.append(tag('amenity', AMENITIES[i % len(AMENITIES)]))
+            tags.append(tag('name', 'Place <{}> & co'.format(i)))
+        attrib = [('id', 100 + i), ('lat', '{:.7f}'.format(37.1 + i * 0.0012345)),
+                  ('lon', '{:.7f}'.format(-121.9 - i * 0.0023456))] + meta(i)
+        lines.append(element_xml('node', attrib, tags))
+    for i in range(ways):
+        children = [('nd', [('ref', 100 + (i + j) % nodes)]) for j in range(i % 4 + 2)]
+        children.append(tag('highway', 'residential'))
+        children.append(tag('name', STREETS[i % len(STREETS)]))
+        lines.append(element_xml('way', [('id', 1000 + i)] + meta(i), children))
+    for i in range(relations):
+        children = [('member', [('type', 'node'), ('ref', 100 + i), ('role', 'via')]),
+                    ('member', [('type', 'way'), ('ref', 1000 + i), ('role', 'from')]),
+                    tag('type', 'restriction')]
+        lines.append(element_xml('relation', [('id', 5000 + i)] + meta(i), children))
+    lines.append('</osm>')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+@pytest.fixture
+def fixture_map(tmp_path):
+    return write_fixture_map(str(tmp_path / 'fixture.osm'))
+
+# Run process_map() in a directory of its own and return the content of the csv files.
+def shaped_csv(tmp_path, monkeypatch, name, file_in, validate=False, **kwargs):
+    out = tmp_path / name
+    out.mkdir()
+    monkeypatch.chdir(out)
+    data.process_map(file_in, validate, **kwargs)
+    return {path: (out / path).read_bytes() for path, _, _ in data.OUTPUTS}
+
+def test_serial_validated(tmp_path, monkeypatch, fixture_map):
+    reference = shaped_csv(tmp_path, monkeypatch, 'serial', fixture_map)
+    assert reference[data.NODES_PATH].count(b'\n') == 61
+    assert shaped_csv(tmp_path, monkeypatch, 'validated', fixture_map, validate=True) == \
+        reference
+
+def test_parallel(tmp_path, monkeypatch, fixture_map):
+    reference = shaped_csv(tmp_path, monkeypatch, 'serial', fixture_map)
+    assert shaped_csv(tmp_path, monkeypatch, 'parallel', fixture_map, workers=3) == reference
+
+@pytest.mark.parametrize('suffix', ['.gz', '.bz2', '.zst'])
+def test_compressed(tmp_path, monkeypatch, fixture_map, suffix):
+    reference = shaped_csv(tmp_path, monkeypatch, 'serial', fixture_map)
+    with open(fixture_map, 'rb') as f:
+        content = f.read()
+    if suffix == '.gz':
+        compressed = gzip.compress(content)
+    elif suffix == '.bz2':
+        compressed = bz2.compress(content)
+    else:
+        zstandard = pytest.importorskip('zstandard')
+        compressed = zstandard.ZstdCompressor().compress(content)
+    with open(fixture_map + suffix, 'wb') as f:
+        f.write(compressed)
+    assert shaped_csv(tmp_path, monkeypatch, 'compressed', fixture_map + suffix,
+                      workers=2) == reference
+
+def test_pbf(tmp_path, monkeypatch, fixture_map):
+    osmium = pytest.importorskip('osmium')
+    reference = shaped_csv(tmp_path, monkeypatch, 'serial', fixture_map)
+    pbf_path = str(tmp_path / 'fixture.osm.pbf')
+    writer = osmium.SimpleWriter(pbf_path)
+    try:
+        for obj in osmium.FileProcessor(fixture_map):
+            writer.add(obj)
+    finally:
+        writer.close()
+    assert shaped_csv(tmp_path, monkeypatch, 'pbf', pbf_path) == reference
+    assert shaped_csv(tmp_path, monkeypatch, 'pbf_workers', pbf_path, workers=2) == reference
+
+def test_resume(tmp_path, monkeypatch, fixture_map):
+    reference = shaped_csv(tmp_path, monkeypatch, 'serial', fixture_map)
+    checkpoint_path = str(tmp_path / 'fixture.checkpoint')
+    write_checkpoint = checkpoint.write_checkpoint
+    written = []
+
+    # The run stops after shaping its third segment, before its checkpoint is written, so
+    # the resumed run has to drop the rows of that segment.
+    def crash_on_third(path, state):
+        if len(written) == 2:
+            raise RuntimeError('crash')
+        written.append(state['offset'])
+        write_checkpoint(path, state)
+
+    monkeypatch.setattr(checkpoint, 'write_checkpoint', crash_on_third)
+    with pytest.raises(RuntimeError):
+        shaped_csv(tmp_path, monkeypatch, 'resumed', fixture_map,
+                   checkpoint_path=checkpoint_path, checkpoint_every=2000)
+    monkeypatch.setattr(checkpoint, 'write_checkpoint', write_checkpoint)
+    assert checkpoint.read_checkpoint(checkpoint_path, fixture_map)['offset'] == written[-1]
+
+    out = tmp_path / 'resumed'
+    monkeypatch.chdir(out)
+    data.process_map(fixture_map, False, checkpoint_path=checkpoint_path,
+                     checkpoint_every=2000, resume=True)
+    assert {path: (out / path).read_bytes() for path, _, _ in data.OUTPUTS} == reference
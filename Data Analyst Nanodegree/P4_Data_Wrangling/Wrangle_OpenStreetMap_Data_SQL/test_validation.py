@@ -0,0 +1,146 @@
+# Tests of the compiled validator of validation.py against cerberus, and of the reject file.
+#
+#   python -m pytest test_validation.py
+
+import copy
+import json
+import xml.etree.cElementTree as ET
+
+import pytest
+
+import data
+import schema
+import validation
+from test_data import write_fixture_map
+
+SCHEMA = schema.schema
+
+# Ways of breaking a shaped element: (description, function changing the element in place).
+def set_field(key, field, value):
+    def change(el):
+        target = el[key][0] if isinstance(el[key], list) else el[key]
+        target[field] = value
+    return change
+
+def del_field(key, field):
+    def change(el):
+        target = el[key][0] if isinstance(el[key], list) else el[key]
+        del target[field]
+    return change
+
+def set_key(key, value):
+    def change(el):
+        el[key] = value
+    return change
+
+MUTATIONS = {
+    'node': [set_field('node', 'id', 'x1'), set_field('node', 'lat', 'north'),
+             set_field('node', 'lat', ''), set_field('node', 'uid', '1.5'),
+             set_field('node', 'user', 42), set_field('node', 'user', ''),
+             set_field('node', 'version', None), set_field('node', 'changeset', True),
+             set_field('node', 'extra', 'x'), del_field('node', 'uid'),
+             del_field('node', 'user'), set_key('node', []), set_key('node', 'x'),
+             set_key('unknown', {})],
+    'node_tags': [set_field('node_tags', 'id', 'abc'), set_field('node_tags', 'value', 1),
+                  del_field('node_tags', 'type'), set_field('node_tags', 'other', ''),
+                  set_key('node_tags', {}), set_key('node_tags', [[]])],
+    'way': [set_field('way', 'uid', ''), del_field('way', 'timestamp'),
+            set_field('way', 'id', ' 12 '), set_field('way', 'changeset', 3.0)],
+    'way_nodes': [set_field('way_nodes', 'node_id', 'q'), set_field('way_nodes', 'position', '-1'),
+                  del_field('way_nodes', 'position'), set_key('way_nodes', ['x'])],
+    'relation_members': [set_field('relation_members', 'member_id', ''),
+                         set_field('relation_members', 'role', None)],
+}
+
+def shaped_elements(path):
+    elements = []
+    for element in ET.parse(path).getroot():
+        el = data.shape_element(element)
+        if el:
+            elements.append(el)
+    return elements
+
+# The elements of the fixture map, and every mutation of each one that applies to it.
+@pytest.fixture
+def elements(tmp_path):
+    elements = shaped_elements(write_fixture_map(str(tmp_path / 'fixture.osm')))
+    mutated = []
+    for el in elements:
+        for key, changes in MUTATIONS.items():
+            if key not in el or (isinstance(el[key], list) and not el[key]):
+                continue
+            for change in changes:
+                el_copy = copy.deepcopy(el)
+                change(el_copy)
+                mutated.append(el_copy)
+    return elements + mutated
+
+def test_compiled_validator_matches_cerberus(elements):
+    cerberus = pytest.importorskip('cerberus')
+    validator = cerberus.Validator()
+    compiled = validation.compile_schema(SCHEMA)
+    rejected = 0
+    for el in elements:
+        valid = validator.validate(el, SCHEMA)
+        errors = compiled(el)
+        assert (errors is None) == valid, (el, errors, validator.errors)
+        if not valid:
+            assert sorted(errors) == sorted(validator.errors), el
+            rejected += 1
+    assert 0 < rejected < len(elements)
+
+def test_row_validator_matches_cerberus(tmp_path):
+    cerberus = pytest.importorskip('cerberus')
+    validator = cerberus.Validator()
+    valid_rows = validation.compile_rows({key: fields for _, fields, key in data.OUTPUTS},
+                                         SCHEMA)
+    root = ET.parse(write_fixture_map(str(tmp_path / 'fixture.osm'))).getroot()
+    for element in root:
+        # An element whose rows are valid is valid, one whose rows are not valid is checked
+        # as dicts by process_map().
+        if valid_rows(data.shape_element_rows(element)):
+            assert validator.validate(data.shape_element(element), SCHEMA)
+    # A node missing an attribute or with a non-numeric one fails the fast check.
+    node = root.find('node')
+    del node.attrib['uid']
+    assert not valid_rows(data.shape_element_rows(node))
+    node.attrib['uid'] = 'x'
+    assert not valid_rows(data.shape_element_rows(node))
+
+BAD_MAP = '''<?xml version="1.0" encoding="UTF-8"?>
+<osm>
+ <node id="1" lat="1" lon="2" version="1" timestamp="t" changeset="1" uid="1" user="a"/>
+ <node id="2" lat="x" lon="2" version="1" timestamp="t" changeset="1" uid="1" user="a"/>
+ <node id="3" lat="1" lon="2" version="1" timestamp="t" changeset="1" user="a"/>
+ <node id="4" lat="1" lon="2" version="1" timestamp="t" changeset="1" uid="1" user=""/>
+ <way id="5" version="1" timestamp="t" changeset="1" uid="1" user="a"><nd ref="q"/></way>
+ <way id="6" version="1" timestamp="t" changeset="1" uid="1" user="a"><nd ref="1"/></way>
+</osm>
+'''
+
+def test_reject_file(tmp_path, monkeypatch):
+    osm_file = tmp_path / 'bad.osm'
+    osm_file.write_text(BAD_MAP)
+    monkeypatch.chdir(tmp_path)
+    reject_path = str(tmp_path / 'rejected.jsonl')
+    assert data.process_map(str(osm_file), validate=True, reject_path=reject_path) == 3
+
+    with open(reject_path) as f:
+        rejects = [json.loads(line) for line in f]
+    assert [list(reject['element'].values())[0]['id'] for reject in rejects] == ['2', '3', '5']
+    assert 'lat' in rejects[0]['errors']['node'][0]
+    assert rejects[1]['errors'] == {'node': [{'uid': ['required field']}]}
+    assert 'node_id' in rejects[2]['errors']['way_nodes'][0]['0'][0]
+
+    # The valid elements are written, the rejected ones are not; an empty user is valid.
+    with open(data.NODES_PATH) as f:
+        assert [line.split(',')[0] for line in f][1:] == ['1', '4']
+    with open(data.WAYS_PATH) as f:
+        assert [line.split(',')[0] for line in f][1:] == ['6']
+
+def test_invalid_element_raises(tmp_path, monkeypatch):
+    osm_file = tmp_path / 'bad.osm'
+    osm_file.write_text(BAD_MAP)
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(validation.ValidationError):
+        data.process_map(str(osm_file), validate=True)
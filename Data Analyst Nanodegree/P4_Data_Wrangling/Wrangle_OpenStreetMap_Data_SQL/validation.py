@@ -0,0 +1,251 @@
+# Fast validation of the shaped elements against schema.py.
+
+# cerberus reads the rules of the schema again for every element it validates, which makes
+# process_map() about 10 times slower. compile_schema() reads the rules once and builds:
+# - a checking function for each field, which returns the errors found, and
+# - for each element type, the source code of a function doing all the checks of a valid
+#   element in a row (coerce the numbers, compare the types of the strings), compiled
+#   with exec(). It only says whether the element is valid.
+# Valid elements only go through the second one. The first one is used to find the errors
+# of the invalid ones. Both support the rules used in schema.py (type, required, coerce and
+# schema) with the same meaning as in cerberus: a value must be coercible and the coerced
+# value must have the right type. The element itself is not changed.
+# compile_rows() builds the same fast path for the csv rows of data.shape_element_rows(),
+# tuples with the values in the order of the *_FIELDS lists, so a valid element is checked
+# without being shaped as dicts too.
+
+import json
+import pprint
+import schema
+
+SCHEMA = schema.schema
+
+class ValidationError(Exception):
+    pass
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def is_float(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_string(value):
+    return isinstance(value, str)
+
+def is_dict(value):
+    return isinstance(value, dict)
+
+def is_list(value):
+    return isinstance(value, (list, tuple))
+
+TYPE_CHECKS = {'integer': is_integer, 'float': is_float, 'string': is_string,
+               'dict': is_dict, 'list': is_list}
+
+# Build the function checking one value against the rules of a field. It returns None if
+# the value is valid, otherwise the errors found, in the format cerberus uses.
+def compile_field(rules):
+    coerce = rules.get('coerce')
+    type_check = TYPE_CHECKS[rules['type']]
+    type_error = "must be of {} type".format(rules['type'])
+    check_items = None
+    if 'schema' in rules:
+        if rules['type'] == 'dict':
+            check_items = compile_dict(rules['schema'])
+        else:
+            check_items = compile_list(rules['schema'])
+
+    def check_field(value):
+        if coerce is not None:
+            try:
+                value = coerce(value)
+            except (TypeError, ValueError) as e:
+                return ["field cannot be coerced: {}".format(e)]
+        if not type_check(value):
+            return [type_error]
+        if check_items is not None:
+            errors = check_items(value)
+            if errors:
+                return [errors]
+        return None
+
+    return check_field
+
+# Build the function checking a dict against the rules of its fields.
+def compile_dict(fields):
+    checks = [(name, compile_field(rules)) for name, rules in fields.items()]
+    required = [name for name, rules in fields.items() if rules.get('required')]
+    known = frozenset(fields)
+
+    def check_dict(document):
+        errors = {}
+        for name, check_field in checks:
+            if name in document:
+                field_errors = check_field(document[name])
+                if field_errors:
+                    errors[name] = field_errors
+        for name in required:
+            if name not in document:
+                errors[name] = ['required field']
+        if not known.issuperset(document):
+            for name in document:
+                if name not in known:
+                    errors[name] = ['unknown field']
+        return errors
+
+    return check_dict
+
+# Build the function checking every item of a list against the same rules.
+def compile_list(rules):
+    check_item = compile_field(rules)
+
+    def check_list(items):
+        errors = {}
+        for i, item in enumerate(items):
+            item_errors = check_item(item)
+            if item_errors:
+                errors[i] = item_errors
+        return errors
+
+    return check_list
+
+# Fast path: return the lines of code checking the value named 'var' against 'rules', or
+# None if the rules are not supported. The lines return False when the value is invalid and
+# raise KeyError, TypeError or ValueError for a missing or uncoercible field.
+def fast_field_lines(var, rules, indent, depth=0):
+    pad = ' ' * indent
+    coerce = rules.get('coerce')
+    if coerce is not None:
+        if coerce not in (int, float) or rules['type'] not in ('integer', 'float'):
+            return None
+        # int() and float() return an int and a float, which have the right type.
+        return ['{}{}({})'.format(pad, coerce.__name__, var)]
+    if rules['type'] == 'string':
+        return ['{}if type({}) is not str: return False'.format(pad, var)]
+    if rules['type'] == 'integer':
+        return ['{}if type({}) is not int: return False'.format(pad, var)]
+    if rules['type'] == 'float':
+        return ['{}if type({}) not in (int, float): return False'.format(pad, var)]
+    if rules['type'] == 'dict' and 'schema' in rules:
+        return fast_dict_lines(var, rules['schema'], indent, depth + 1)
+    if rules['type'] == 'list' and 'schema' in rules:
+        item = 'item{}'.format(depth)
+        lines = fast_field_lines(item, rules['schema'], indent + 4, depth + 1)
+        if lines is None:
+            return None
+        return ['{}if type({}) is not list: return False'.format(pad, var),
+                '{}for {} in {}:'.format(pad, item, var)] + lines
+    return None
+
+def fast_dict_lines(var, fields, indent, depth):
+    pad = ' ' * indent
+    # With all the fields required, a dict of the same length has no unknown fields.
+    if not all(rules.get('required') for rules in fields.values()):
+        return None
+    lines = ['{}if type({}) is not dict or len({}) != {}: return False'.format(
+        pad, var, var, len(fields))]
+    for name, rules in fields.items():
+        field_lines = fast_field_lines('{}[{!r}]'.format(var, name), rules, indent, depth)
+        if field_lines is None:
+            return None
+        lines += field_lines
+    return lines
+
+# Build the fast path for each top level field of the schema.
+def compile_fast(schema):
+    checks = {}
+    for name, rules in schema.items():
+        lines = fast_field_lines('value', rules, 4)
+        if lines is None:
+            return None
+        source = '\n'.join(['def check(value):'] + lines + ['    return True'])
+        namespace = {}
+        exec(source, namespace)
+        checks[name] = namespace['check']
+    return checks
+
+# Return a function which returns None if a shaped element matches the schema, otherwise
+# a dict of its errors.
+def compile_schema(schema=SCHEMA):
+    check_element = compile_dict(schema)
+    fast_checks = compile_fast(schema)
+
+    def validate(element):
+        if fast_checks is not None:
+            try:
+                for name, value in element.items():
+                    if not fast_checks[name](value):
+                        break
+                else:
+                    return None
+            except (KeyError, TypeError, ValueError):
+                pass
+        return check_element(element) or None
+
+    return validate
+
+# Fast path for the rows of an element: return the lines of code unpacking the tuple named
+# 'var' into one variable per field, in the order of 'names', and checking them against the
+# rules of the dict fields (a tuple of another length raises ValueError). A missing attribute
+# of the element is '' in its row, so with non_empty=True an empty string is not taken as
+# valid: the element is checked again as a dict, where it is a missing field.
+def fast_row_lines(var, names, fields, indent, depth, non_empty=False):
+    pad = ' ' * indent
+    if sorted(names) != sorted(fields) or \
+       not all(rules.get('required') for rules in fields.values()):
+        return None
+    values = ['v{}_{}'.format(depth, i) for i in range(len(names))]
+    lines = ['{}{}, = {}'.format(pad, ', '.join(values), var)]
+    for value, name in zip(values, names):
+        rules = fields[name]
+        if rules['type'] == 'string' and non_empty:
+            lines.append('{}if type({}) is not str or not {}: return False'.format(
+                pad, value, value))
+            continue
+        field_lines = fast_field_lines(value, rules, indent, depth)
+        if field_lines is None:
+            return None
+        lines += field_lines
+    return lines
+
+# Return a function which returns True if the rows of a shaped element are valid, and False
+# if the element has to be checked as a dict by compile_schema() (invalid or not). 'fields'
+# maps each top level field of the schema to the names of its fields in row order. Return
+# None if the rules of the schema can't be checked this way.
+def compile_rows(fields, schema=SCHEMA):
+    checks = {}
+    for name, rules in schema.items():
+        if rules['type'] == 'dict' and 'schema' in rules:
+            lines = fast_row_lines('value', fields[name], rules['schema'], 4, 1,
+                                   non_empty=True)
+        elif rules['type'] == 'list' and rules.get('schema', {}).get('type') == 'dict':
+            lines = fast_row_lines('item', fields[name], rules['schema']['schema'], 8, 2)
+            if lines is not None:
+                lines = ['    for item in value:'] + lines
+        else:
+            lines = None
+        if lines is None:
+            return None
+        source = '\n'.join(['def check(value):'] + lines + ['    return True'])
+        namespace = {}
+        exec(source, namespace)
+        checks[name] = namespace['check']
+
+    def valid_rows(element):
+        try:
+            for name, value in element.items():
+                if not checks[name](value):
+                    return False
+        except (KeyError, TypeError, ValueError):
+            return False
+        return True
+
+    return valid_rows
+
+def error_message(errors):
+    field, field_errors = next(iter(errors.items()))
+    message_string = "\nElement of type '{0}' has the following errors:\n{1}"
+    return message_string.format(field, pprint.pformat(field_errors))
+
+# Write a rejected element and its errors as one json line.
+def write_reject(reject_file, element, errors):
+    reject_file.write(json.dumps({'errors': errors, 'element': element}, default=str) + '\n')
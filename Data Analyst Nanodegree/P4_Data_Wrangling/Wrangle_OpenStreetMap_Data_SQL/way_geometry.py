@@ -0,0 +1,220 @@
+# Materialise the geometry of the ways: the coordinates of their nodes, in order, and their
+# bounding box, one row per way.
+
+# ways_nodes only has the node ids of a way, so any spatial question about the ways has to
+# join ways_nodes with nodes for every way. This second pass over the osm file writes the
+# geometry of every way once, to ways_geometry.csv or to the ways_geometry table:
+#
+#   id, coords, min_lat, min_lon, max_lat, max_lon, missing
+#
+# - coords is a json list of [lat, lon] pairs, in the order of the way's nodes
+# - missing is the number of nodes of the way which are not in the file: the ways crossing
+#   the border of an extract have some of their nodes outside of it. The bounding box is
+#   the one of the nodes found and is empty when there is none.
+#
+# The coordinates of the nodes are not kept in a dict, which takes ~ 200 bytes per node,
+# but in two files of a fixed record size, the node ids sorted and their (lat, lon), which
+# are read through a memory map (see NodeLookup). Only the pages holding the nodes of the
+# ways are read, so the pass works the same on extracts much larger than the memory. The
+# files take 24 bytes per node; they are written to a new temporary directory and removed
+# once the geometry of the last way is written.
+#
+#   python way_geometry.py san-jose_california.osm
+
+import csv
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from array import array
+from itertools import chain
+from iterative_parsing import get_element
+
+WAYS_GEOMETRY_PATH = "ways_geometry.csv"
+NODE_LOOKUP_NAME = "node_coords"
+
+WAY_GEOMETRY_FIELDS = ['id', 'coords', 'min_lat', 'min_lon', 'max_lat', 'max_lon', 'missing']
+
+GEOMETRY_TABLE_SQL = ('CREATE TABLE IF NOT EXISTS ways_geometry (id integer, coords text, '
+                      'min_lat real, min_lon real, max_lat real, max_lon real, missing integer);')
+
+# Number of ways looked up at once.
+BATCH_SIZE = 10000
+
+# Number of nodes kept in memory before they are appended to the lookup files.
+CHUNK_SIZE = 1000000
+
+class NodeLookupBuilder(object):
+
+    # Append (id, lat, lon) to the files of a NodeLookup, in chunks. osm files list the
+    # nodes sorted by id, otherwise the files are sorted in finish().
+    def __init__(self, path):
+        self.path = path
+        self.ids_file = open(path + '.ids', 'wb')
+        self.coords_file = open(path + '.coords', 'wb')
+        self.ids, self.coords = array('q'), array('d')
+        self.last_id = None
+        self.is_sorted = True
+
+    def add(self, node_id, lat, lon):
+        if self.last_id is not None and node_id < self.last_id:
+            self.is_sorted = False
+        self.last_id = node_id
+        self.ids.append(node_id)
+        self.coords.append(lat)
+        self.coords.append(lon)
+        if len(self.ids) >= CHUNK_SIZE:
+            self.write_chunk()
+
+    def write_chunk(self):
+        self.ids.tofile(self.ids_file)
+        self.coords.tofile(self.coords_file)
+        self.ids, self.coords = array('q'), array('d')
+
+    def finish(self):
+        self.write_chunk()
+        self.close()
+        if not self.is_sorted:
+            sort_node_lookup(self.path)
+        return NodeLookup(self.path)
+
+    def close(self):
+        self.ids_file.close()
+        self.coords_file.close()
+
+    # Remove the files, e.g. once the lookup is no longer needed.
+    def remove(self):
+        self.close()
+        for suffix in ('.ids', '.coords'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+# Sort the files of a NodeLookup by node id. This needs the order of the nodes in memory,
+# 8 bytes per node.
+def sort_node_lookup(path):
+    ids = np.memmap(path + '.ids', dtype=np.int64, mode='r+')
+    coords = np.memmap(path + '.coords', dtype=np.float64, mode='r+').reshape(-1, 2)
+    order = np.argsort(ids, kind='stable')
+    ids[:] = ids[order]
+    coords[:] = coords[order]
+    ids.flush()
+    coords.flush()
+
+class NodeLookup(object):
+
+    # The sorted node ids and their (lat, lon), memory mapped.
+    def __init__(self, path):
+        if os.path.getsize(path + '.ids'):
+            self.ids = np.memmap(path + '.ids', dtype=np.int64, mode='r')
+            self.coords = np.memmap(path + '.coords', dtype=np.float64, mode='r').reshape(-1, 2)
+        else:
+            # np.memmap can't map an empty file.
+            self.ids = np.zeros(0, dtype=np.int64)
+            self.coords = np.zeros((0, 2), dtype=np.float64)
+
+    # Return the lat and lon of every node id of 'refs', NaN for the ids which are missing.
+    def lookup(self, refs):
+        refs = np.asarray(refs, dtype=np.int64)
+        lat = np.full(len(refs), np.nan)
+        lon = np.full(len(refs), np.nan)
+        if len(self.ids):
+            found = np.searchsorted(self.ids, refs)
+            found[found == len(self.ids)] = 0
+            hit = self.ids[found] == refs
+            coords = self.coords[found[hit]]
+            lat[hit] = coords[:, 0]
+            lon[hit] = coords[:, 1]
+        return lat, lon
+
+# The ways_geometry row of a way, from the lat and lon of its nodes in order, with NaN or
+# None for the missing ones.
+def geometry_row(way_id, lats, lons):
+    coords = [[lat, lon] for lat, lon in zip(lats, lons)
+              if lat is not None and lat == lat and lon is not None and lon == lon]
+    missing = len(lats) - len(coords)
+    if not coords:
+        return (way_id, '[]', None, None, None, None, missing)
+    return (way_id, json.dumps(coords, separators=(',', ':')),
+            min(lat for lat, _ in coords), min(lon for _, lon in coords),
+            max(lat for lat, _ in coords), max(lon for _, lon in coords), missing)
+
+# Look up the nodes of a batch of (way id, node ids) at once and return their rows.
+def batch_rows(lookup, batch):
+    refs = np.fromiter(chain.from_iterable(refs for _, refs in batch), dtype=np.int64)
+    lat, lon = lookup.lookup(refs)
+    lat, lon = lat.tolist(), lon.tolist()
+    rows = []
+    start = 0
+    for way_id, way_refs in batch:
+        end = start + len(way_refs)
+        rows.append(geometry_row(way_id, lat[start:end], lon[start:end]))
+        start = end
+    return rows
+
+# Yield the ways_geometry row of every way of an osm file. The nodes, which come first in
+# an osm file, are written to the lookup files; the lookup is ready at the first way. The
+# files are lookup_path + '.ids' and '.coords', by default in a new temporary directory,
+# and are removed at the end, also when the file can't be read or the rows are not all used.
+def iter_way_geometry(file_in, lookup_path=None, batch_size=BATCH_SIZE):
+    directory = None
+    if lookup_path is None:
+        directory = tempfile.mkdtemp(prefix=NODE_LOOKUP_NAME)
+        lookup_path = os.path.join(directory, NODE_LOOKUP_NAME)
+    builder = NodeLookupBuilder(lookup_path)
+    try:
+        lookup = None
+        batch = []
+        for element in get_element(file_in, tags=('node', 'way')):
+            if element.tag == 'node':
+                if lookup is not None:
+                    raise ValueError("node {} comes after the ways, the nodes of an osm file "
+                                     "must come first".format(element.attrib['id']))
+                attrib = element.attrib
+                builder.add(int(attrib['id']), float(attrib['lat']), float(attrib['lon']))
+            else:
+                if lookup is None:
+                    lookup = builder.finish()
+                batch.append((int(element.attrib['id']),
+                              [int(nd.attrib['ref']) for nd in element.iter('nd')]))
+                if len(batch) >= batch_size:
+                    for row in batch_rows(lookup, batch):
+                        yield row
+                    batch = []
+        if lookup is None:
+            lookup = builder.finish()
+        for row in batch_rows(lookup, batch):
+            yield row
+    finally:
+        # A memory mapped file can be removed on unix, the map stays valid until it is
+        # dropped; the lookup is dropped first anyway, for the systems where it can't.
+        lookup = None
+        builder.remove()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+def write_way_geometry(file_in, path=WAYS_GEOMETRY_PATH, lookup_path=None):
+    with open(path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\r\n')
+        writer.writerow(WAY_GEOMETRY_FIELDS)
+        writer.writerows(iter_way_geometry(file_in, lookup_path))
+
+# Rebuild the ways_geometry rows of some ways from the nodes and ways_nodes tables, e.g.
+# after their nodes have been changed (see apply_osc.py).
+def refresh_way_geometry(conn, way_ids):
+    for way_id in way_ids:
+        conn.execute('DELETE FROM ways_geometry WHERE id = ?;', (way_id,))
+        if conn.execute('SELECT 1 FROM ways WHERE id = ?;', (way_id,)).fetchone():
+            nodes = conn.execute('SELECT nodes.lat, nodes.lon FROM ways_nodes LEFT JOIN nodes '
+                                 'ON nodes.id = ways_nodes.node_id WHERE ways_nodes.id = ? '
+                                 'ORDER BY ways_nodes.position;', (way_id,)).fetchall()
+            lats = [lat for lat, _ in nodes]
+            lons = [lon for _, lon in nodes]
+            conn.execute('INSERT INTO ways_geometry ({}) VALUES ({});'.format(
+                ', '.join(WAY_GEOMETRY_FIELDS), ', '.join('?' * len(WAY_GEOMETRY_FIELDS))),
+                geometry_row(way_id, lats, lons))
+
+
+if __name__ == '__main__':
+    import sys
+    write_way_geometry(sys.argv[1])
@@ -0,0 +1,225 @@
+# Output writers of process_map().
+
+# Each table of the map (nodes, nodes_tags, ways, ways_nodes, ways_tags) is written by one
+# writer, with writerow() / writerows() taking the dictionaries built by shape_element():
+# - 'csv' writes the csv files imported by create_db_from_csv.py. It also takes the rows of
+#   shape_element_rows() as tuples, with write_tuple() / write_tuples(), which saves building
+#   and looking up a dictionary per row.
+# - 'parquet' and 'arrow' write typed, compressed columnar files (Parquet or Arrow IPC),
+#   with the columns in the order of the *_FIELDS lists and the types of schema.py, in row
+#   groups of a fixed size. pandas and pyarrow can then read only the columns they need:
+#
+#     pd.read_parquet('nodes.parquet', columns=['lat', 'lon'])
+#
+# The columnar formats need pyarrow, which is only imported when they are used.
+
+import codecs
+import csv
+import io
+import os
+import queue
+import shutil
+import threading
+import schema
+
+FORMATS = ('csv', 'parquet', 'arrow')
+
+ROW_GROUP_SIZE = 100000
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+class UnicodeDictWriter(csv.DictWriter, object):
+
+    # Extend csv.DictWriter to handle Unicode input
+    def writerow(self, row):
+        super(UnicodeDictWriter, self).writerow({
+            k: v for k, v in row.items()
+        })
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+# Return the path of a table in the given format, e.g. nodes.csv -> nodes.parquet.
+def output_path(path, output_format):
+    return os.path.splitext(path)[0] + '.' + output_format
+
+# The rules of schema.py for the fields of a table. 'key' is the key of its rows in the
+# shaped element ('node', 'node_tags', ...).
+def field_rules(key):
+    rules = schema.schema[key]
+    if rules['type'] == 'list':
+        rules = rules['schema']
+    return rules['schema']
+
+# The csv rows are formatted into a buffer which is written to the file in blocks of about
+# BUFFER_SIZE characters. With a writer thread the blocks are written by a background thread,
+# at most QUEUE_BLOCKS of them waiting, while the next rows are shaped.
+BUFFER_SIZE = 1024 * 1024
+QUEUE_BLOCKS = 8
+
+class CsvTableWriter(object):
+
+    # With append=True the rows are added at the end of an existing file.
+    # writerow() / writerows() take the dictionaries of shape_element(), write_tuple() /
+    # write_tuples() the tuples of shape_element_rows(), with the values in the order of
+    # 'fields'. Both give the same bytes as csv.DictWriter: a missing value is written as ''.
+    def __init__(self, path, fields, key, header=True, append=False, thread=False,
+                 buffer_size=BUFFER_SIZE):
+        self.f = codecs.open(path, 'a' if append else 'w')
+        self.fields = fields
+        self.buffer_size = buffer_size
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.queue = None
+        if thread:
+            self.queue = queue.Queue(QUEUE_BLOCKS)
+            self.error = None
+            self.thread = threading.Thread(target=self.write_blocks)
+            self.thread.daemon = True
+            self.thread.start()
+        if header:
+            self.writer.writerow(fields)
+
+    def writerow(self, row):
+        self.writer.writerow([row.get(field, '') for field in self.fields])
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def writerows(self, rows):
+        fields = self.fields
+        self.writer.writerows([row.get(field, '') for field in fields] for row in rows)
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def write_tuple(self, row):
+        self.writer.writerow(row)
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def write_tuples(self, rows):
+        self.writer.writerows(rows)
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    # Hand the buffered rows to the file, or to the writer thread.
+    def flush(self):
+        block = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        if not block:
+            return
+        if self.queue is None:
+            self.f.write(block)
+        else:
+            if self.error is not None:
+                raise self.error
+            self.queue.put(block)
+
+    def write_blocks(self):
+        while True:
+            block = self.queue.get()
+            if block is None:
+                return
+            if self.error is None:
+                try:
+                    self.f.write(block)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        self.flush()
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+        self.f.close()
+        if self.queue is not None and self.error is not None:
+            raise self.error
+
+class ColumnarTableWriter(object):
+
+    # Arrow types of the schema.py types.
+    ARROW_TYPES = {'integer': 'int64', 'float': 'float64', 'string': 'string'}
+
+    def __init__(self, path, fields, key, output_format, row_group_size=ROW_GROUP_SIZE,
+                 compression='zstd'):
+        import pyarrow as pa
+        self.pa = pa
+        self.fields = fields
+        self.row_group_size = row_group_size
+        rules = field_rules(key)
+        self.coerce = [rules[field].get('coerce') for field in fields]
+        self.schema = pa.schema([(field, self.ARROW_TYPES[rules[field]['type']])
+                                 for field in fields])
+        self.columns = [[] for _ in fields]
+        if output_format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.schema, compression=compression)
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            self.writer = pa.ipc.new_file(path, self.schema, options=options)
+
+    # The numbers are converted like the schema coerces them when validating. Missing values
+    # and empty numbers are stored as nulls.
+    def writerow(self, row):
+        for column, field, coerce in zip(self.columns, self.fields, self.coerce):
+            value = row.get(field)
+            if coerce is not None and value is not None:
+                value = coerce(value) if value != '' else None
+            column.append(value)
+        if len(self.columns[0]) >= self.row_group_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        if self.columns[0]:
+            batch = self.pa.record_batch(self.columns, schema=self.schema)
+            self.writer.write_batch(batch)
+            self.columns = [[] for _ in self.fields]
+
+    def write_table(self, table):
+        self.flush()
+        for batch in table.to_batches(max_chunksize=self.row_group_size):
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def open_writer(output_format, path, fields, key, header=True, append=False, thread=False):
+    if output_format == 'csv':
+        return CsvTableWriter(path, fields, key, header, append, thread)
+    if append:
+        raise ValueError("only the csv files can be appended to")
+    if output_format in FORMATS:
+        return ColumnarTableWriter(path, fields, key, output_format)
+    raise ValueError("unknown output format: {}".format(output_format))
+
+def read_table(output_format, path):
+    import pyarrow as pa
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_table(path)
+    with pa.OSFile(path, 'rb') as source:
+        return pa.ipc.open_file(source).read_all()
+
+# Merge the part files written by the workers of the parallel mode into 'path', in order,
+# and remove them. The csv parts have no header, so they are simply appended.
+def merge_parts(output_format, path, fields, key, part_paths):
+    if output_format == 'csv':
+        with codecs.open(path, 'w') as f:
+            UnicodeDictWriter(f, fields).writeheader()
+        with open(path, 'ab') as f:
+            for part_path in part_paths:
+                with open(part_path, 'rb') as part:
+                    shutil.copyfileobj(part, f, COPY_BUFFER_SIZE)
+                os.remove(part_path)
+    else:
+        writer = open_writer(output_format, path, fields, key)
+        for part_path in part_paths:
+            writer.write_table(read_table(output_format, part_path))
+            os.remove(part_path)
+        writer.close()
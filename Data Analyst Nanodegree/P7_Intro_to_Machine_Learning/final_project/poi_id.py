@@ -17,8 +17,10 @@ import sys
 import pickle
 sys.path.append("./tools/")
 
-from feature_format import featureFormat, targetFeatureSplit
+from feature_format import targetFeatureSplit
+from feature_cache import cachedFeatureFormat
 from tester import dump_classifier_and_data
+from step_cache import StepCache, hitRates
 
 ### Task 1: Select what features you'll use.
 ### features_list is a list of strings, each of which is a feature name.
@@ -78,9 +80,13 @@ for name in data_dict:
 my_dataset = data_dict
 
 ### Extract features and labels from dataset for local testing
-data = featureFormat(my_dataset, features_list, sort_keys = True)
+data = cachedFeatureFormat(my_dataset, features_list, sort_keys = True)
 labels, features = targetFeatureSplit(data)
 
+# Labels as an array: a list of numpy floats is slow to hash for the feature selection cache
+import numpy as np
+labels = np.array(labels)
+
 # Scale features.
 from sklearn.preprocessing import MinMaxScaler
 scaler = MinMaxScaler()
@@ -113,6 +119,7 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.ensemble import AdaBoostClassifier
 from sklearn.pipeline import Pipeline
 from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import ParameterGrid
 from sklearn.model_selection import StratifiedShuffleSplit
 from sklearn.metrics import classification_report
 from time import time
@@ -130,23 +137,73 @@ abc = AdaBoostClassifier()
 classifiers = {"GaussianNB": nb, "SVM": svc, "Decision Tree": dtc, 
                "KNN": knc, "Random Forest": rfc, "AdaBoost": abc}
 
+# Cache of the SelectKBest fits, by k and fold, shared by all the pipelines: the scores
+# and selected columns of a fold do not depend on the classifier after them.
+step_cache = StepCache()
+
+# The search strategy of optimize_clf: "grid" scores every combination of parameters
+# on all the cross-validation splits, "halving" first prunes them by successive halving.
+SEARCH = "grid"
+
+# Successive halving, with the cross-validation splits as the budget: the dataset is too
+# small to score the combinations on a share of it, so all of them are scored on the first
+# few splits, the best third of those on three times as many splits, and so on, up to
+# n_splits / 3 splits. A 30% test split holds about 3 POIs, so a round scores on at least
+# min_splits splits, and keeps all the combinations tied with the last one kept, so that
+# the order of the parameter lists never decides between them. The rounds prune on f1
+# only, and return the remaining combinations, as a grid for GridSearchCV, with their
+# fit time.
+def halving_candidates(pipeline, parameters, n_splits, factor=3, min_splits=3):
+    candidates = list(ParameterGrid(parameters))
+    budgets = []
+    splits = n_splits // factor
+    while splits >= min_splits:
+        budgets.insert(0, splits)
+        splits //= factor
+    fit_time = 0
+    for splits in budgets:
+        if len(candidates) <= factor:
+            break
+        # The first splits of the cross-validator of optimize_clf
+        sss = StratifiedShuffleSplit(n_splits=splits, test_size=0.3, random_state=42)
+        gs = GridSearchCV(pipeline, param_grid=[{key: [value] for key, value in params.items()}
+                                                for params in candidates],
+                          scoring='f1', cv=sss, refit=False, n_jobs=-1)
+        gs.fit(features_train, labels_train)
+        results = gs.cv_results_
+        fit_time += splits * (results['mean_fit_time'] + results['mean_score_time']).sum()
+        # Keep the best 1 / factor, rounded up, and the ones tied with the last of them;
+        # failed fits score nan and come last
+        scores = np.nan_to_num(results['mean_test_score'], nan=-np.inf)
+        cutoff = np.sort(scores)[::-1][-(-len(candidates) // factor) - 1]
+        candidates = [params for params, score in zip(results['params'], scores)
+                      if score >= cutoff]
+    return [{key: [value] for key, value in params.items()} for params in candidates], fit_time
+
 # Create a function that combines pipeline and grid search and returns the best clf with the best parameters
-def optimize_clf(clf, parameters, n_splits):
+def optimize_clf(clf, parameters, n_splits, search=SEARCH):
     t0 = time()
     # Add pipeline steps into a list
     steps = [('feature_selection', select),
              ('clf', clf)]
     
     # Create the pipeline
-    pipeline = Pipeline(steps)
+    pipeline = Pipeline(steps, memory=step_cache)
+    counts = step_cache.counts()
     
     # Create Stratified ShuffleSplit cross-validator.
     # Provides train/test indices to split data in train/test sets.
     sss = StratifiedShuffleSplit(n_splits=n_splits, test_size=0.3, random_state=42)
     
+    # Prune the grid to the combinations worth scoring on all the splits
+    n_candidates = len(ParameterGrid(parameters))
+    pruning_time = 0
+    if search == "halving":
+        parameters, pruning_time = halving_candidates(pipeline, parameters, n_splits)
+
     # Create grid search
     gs = GridSearchCV(pipeline, param_grid=parameters, scoring=('f1', 'recall'),
-                      cv=sss, refit='f1')
+                      cv=sss, refit='f1', n_jobs=-1)
                 
     # Fit pipeline on features_train and labels_train
     gs.fit(features_train, labels_train)
@@ -165,6 +222,16 @@ def optimize_clf(clf, parameters, n_splits):
     print("Best parameters:")
     print(best_params)
     print("Time passed: ", round(time() - t0, 3), "s")
+    print("Feature selection cache:", hitRates(step_cache.counts() - counts))
+    if search == "halving":
+        # Compare the fit time with the one of the full grid, estimated from the mean fit
+        # time of the combinations scored on all the splits
+        fit_times = gs.cv_results_['mean_fit_time'] + gs.cv_results_['mean_score_time']
+        fit_time = pruning_time + n_splits * fit_times.sum()
+        grid_time = n_splits * n_candidates * fit_times.mean()
+        print("Fit time: {:.3f} s for {} of {} combinations on all the splits, "
+              "full grid estimate: {:.3f} s, saved: {:.3f} s".format(
+                  fit_time, len(parameters), n_candidates, grid_time, grid_time - fit_time))
     # Return the best estimator
     return gs.best_estimator_
 
@@ -190,6 +257,9 @@ for name, clf in classifiers.items():
                       'clf__n_estimators':[45, 50, 55]}]
     optimize_clf(clf, parameters, n_splits=10)
 
+print("##########################################################################################################")
+print("Feature selection cache of the sweep:", hitRates(step_cache.counts()))
+
 ### Fine tune the selected algorithm
 print("##########################################################################################################")
 print("Decision Trees")
@@ -201,6 +271,10 @@ parameters = [{'feature_selection__k':[1, 2, 3, 4, 5],
               }]
 
 clf = optimize_clf(dtc, parameters, n_splits=10)
+# The cache is only for the sweep: the dumped classifier is a plain Pipeline, so tester.py
+# doesn't write to the cache or pickle it
+clf.set_params(memory=None)
+step_cache.close()
 
 # Access the SelectKBest features selected
 # Create a new list that contains the features selected by SelectKBest
@@ -212,7 +286,6 @@ features_selected = [features_list[i+1] for i in clf.named_steps['feature_select
 # That step contains the feature importances
 importances = clf.named_steps['clf'].feature_importances_
 
-import numpy as np
 indices = np.argsort(importances)[::-1]
 
 # Use features_selected, the features selected by SelectKBest, and not features_list
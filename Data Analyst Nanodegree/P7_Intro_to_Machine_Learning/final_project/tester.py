@@ -11,54 +11,64 @@
 
 import pickle
 import sys
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import clone
 from sklearn.metrics import precision_score
 from sklearn.metrics import recall_score
-from sklearn.cross_validation import StratifiedShuffleSplit
+from sklearn.model_selection import StratifiedShuffleSplit
 sys.path.append("./tools/")
-from feature_format import featureFormat, targetFeatureSplit
+from feature_format import targetFeatureSplit
+from feature_cache import cachedFeatureFormat, fileHash
 
 PERF_FORMAT_STRING = "\
 \tAccuracy: {:>0.{display_precision}f}\tPrecision: {:>0.{display_precision}f}\t\
 Recall: {:>0.{display_precision}f}\tF1: {:>0.{display_precision}f}\tF2: {:>0.{display_precision}f}"
 RESULTS_FORMAT_STRING = "\tTotal predictions: {:4d}\tTrue positives: {:4d}\tFalse positives: {:4d}\tFalse negatives: {:4d}\tTrue negatives: {:4d}"
 
-def test_classifier(clf, dataset, feature_list, folds = 1000):
-    data = featureFormat(dataset, feature_list, sort_keys = True)
+### fit a copy of the classifier on one fold and count its test predictions:
+### (true positives, false positives, false negatives, true negatives, valid),
+### only up to the first prediction which is not 0 or 1 (valid is False then)
+def fold_counts(clf, features, labels, train_idx, test_idx):
+    clf = clone(clf)
+    clf.fit(features[train_idx], labels[train_idx])
+    predictions = np.asarray(clf.predict(features[test_idx]))
+    truth = labels[test_idx]
+    invalid = ~(((predictions == 0) | (predictions == 1)) & ((truth == 0) | (truth == 1)))
+    valid = not invalid.any()
+    if not valid:
+        first = np.argmax(invalid)
+        predictions, truth = predictions[:first], truth[:first]
+    positive = predictions == 1
+    poi = truth == 1
+    return (int(np.sum(positive & poi)), int(np.sum(positive & ~poi)),
+            int(np.sum(~positive & poi)), int(np.sum(~positive & ~poi)), valid)
+
+def test_classifier(clf, dataset, feature_list, folds = 1000, n_jobs = -1, dataset_hash = None):
+    data = cachedFeatureFormat(dataset, feature_list, sort_keys = True,
+                               dataset_hash = dataset_hash)
     labels, features = targetFeatureSplit(data)
-    cv = StratifiedShuffleSplit(labels, folds, random_state = 42)
+    labels = np.asarray(labels)
+    features = np.asarray(features)
+    cv = StratifiedShuffleSplit(n_splits = folds, random_state = 42)
+    ### the folds are fitted in parallel, each on its own copy of clf,
+    ### and their counts added up in fold order
+    counts = Parallel(n_jobs = n_jobs)(
+        delayed(fold_counts)(clf, features, labels, train_idx, test_idx)
+        for train_idx, test_idx in cv.split(features, labels))
     true_negatives = 0
     false_negatives = 0
     true_positives = 0
     false_positives = 0
-    for train_idx, test_idx in cv: 
-        features_train = []
-        features_test  = []
-        labels_train   = []
-        labels_test    = []
-        for ii in train_idx:
-            features_train.append( features[ii] )
-            labels_train.append( labels[ii] )
-        for jj in test_idx:
-            features_test.append( features[jj] )
-            labels_test.append( labels[jj] )
-        
-        ### fit the classifier using training set, and test on test set
-        clf.fit(features_train, labels_train)
-        predictions = clf.predict(features_test)
-        for prediction, truth in zip(predictions, labels_test):
-            if prediction == 0 and truth == 0:
-                true_negatives += 1
-            elif prediction == 0 and truth == 1:
-                false_negatives += 1
-            elif prediction == 1 and truth == 0:
-                false_positives += 1
-            elif prediction == 1 and truth == 1:
-                true_positives += 1
-            else:
-                print("Warning: Found a predicted label not == 0 or 1.")
-                print("All predictions should take value 0 or 1.")
-                print("Evaluating performance for processed predictions:")
-                break
+    for tp, fp, fn, tn, valid in counts:
+        true_positives += tp
+        false_positives += fp
+        false_negatives += fn
+        true_negatives += tn
+        if not valid:
+            print("Warning: Found a predicted label not == 0 or 1.")
+            print("All predictions should take value 0 or 1.")
+            print("Evaluating performance for processed predictions:")
     try:
         total_predictions = true_negatives + false_negatives + false_positives + true_positives
         accuracy = 1.0*(true_positives + true_negatives)/total_predictions
@@ -91,8 +101,10 @@ def load_classifier_and_data():
 def main():
     ### load up student's classifier, dataset, and feature_list
     clf, dataset, feature_list = load_classifier_and_data()
-    ### Run testing script
-    test_classifier(clf, dataset, feature_list)
+    ### Run testing script; the features cached for the dataset are
+    ### found by its file, without hashing its content
+    test_classifier(clf, dataset, feature_list,
+                    dataset_hash = fileHash(DATASET_PICKLE_FILENAME))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,335 @@
+#!/usr/bin/python
+
+"""
+    A cache of the feature matrices built by featureFormat.
+
+    poi_id.py, tester.py and the mini-projects convert the same
+    dataset dictionary again and again, with overlapping feature
+    lists. cachedFeatureFormat takes the same arguments as
+    featureFormat and returns the same array, but the float value
+    of every (person, feature) is only computed once per dataset:
+
+    data = cachedFeatureFormat( data_dictionary, feature_list, sort_keys = True )
+
+    The cache is keyed by a hash of the content of the dictionary,
+    so a changed dataset (e.g. a new final_project_dataset.pkl, or
+    a new feature computed in poi_id.py) gets its own entry and the
+    old one is never used for it. Hashing a large dictionary costs
+    about as much as featureFormat itself, so the hash is computed
+    once per dictionary object and remembered: a dictionary changed
+    after it was first passed in needs forgetDataset() first. A
+    dataset loaded from a pickle can be keyed by the file instead,
+    with dataset_hash=fileHash(path) (see tester.py).
+
+    Each entry is a directory holding the union of all the features
+    asked for so far, the rows in the order of the sorted keys:
+
+        matrix-*.npy  (n x m) float values, "NaN" strings stored as nan
+        nan-*.npy     (n x m) True where the value was the "NaN" string
+        index.pkl     the person names (rows), feature names (columns)
+                      and the names of the two arrays
+
+    The arrays are stored column by column and memory-mapped, so a
+    request only reads the columns of its features. A request for
+    all the rows in sorted order (sort_keys = True) and for features
+    next to each other in the entry (e.g. the same feature list as
+    the call which added them), with nothing to replace or remove,
+    gets a read-only view of the memory-mapped matrix, without a
+    copy. Any other request gets a copy. A feature which
+    is missing for some person, or which can't be converted to
+    float, is left to featureFormat, which reports it.
+
+    The entries are kept in CACHE_DIR, the feature_cache directory
+    of the system temporary directory (e.g. /tmp/feature_cache).
+    An entry not used for MAX_AGE seconds is removed the next time
+    a new one is created, and clearCache() removes them all.
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from feature_format import featureFormat
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "feature_cache")
+
+# entries not used for 30 days are removed
+MAX_AGE = 30 * 24 * 3600
+
+# files of an entry which its index doesn't name, left by a writer
+# which stopped before writing its index, are removed after an hour
+STALE_AGE = 3600
+
+# FeatureCache entries already opened by this process, by dataset hash.
+_entries = {}
+
+# the hash of the dictionaries hashed by this process, by id; the
+# dictionary is kept with it, so its id is not reused
+_hashes = {}
+
+
+def datasetHash( dictionary ):
+    """ hash of the content of a dataset dictionary (its pickle, so
+        a dictionary loaded again from the same file has the same
+        hash)
+    """
+    return hashlib.sha1( pickle.dumps(dictionary, protocol=2) ).hexdigest()
+
+
+def cachedDatasetHash( dictionary ):
+    """ datasetHash of the dictionary, computed the first time only """
+    known = _hashes.get(id(dictionary))
+    if known is None or known[0] is not dictionary:
+        known = _hashes[id(dictionary)] = (dictionary, datasetHash(dictionary))
+    return known[1]
+
+
+def forgetDataset( dictionary ):
+    """ hash the dictionary again on its next use, e.g. after it
+        was changed
+    """
+    _hashes.pop(id(dictionary), None)
+
+
+def fileHash( path ):
+    """ key of a dataset loaded from the pickle at path, from the
+        path, size and modification time of the file
+    """
+    stat = os.stat(path)
+    return hashlib.sha1( repr((os.path.abspath(path), stat.st_size,
+                               stat.st_mtime)).encode("utf-8") ).hexdigest()
+
+
+def clearCache( cache_dir=CACHE_DIR, max_age=None ):
+    """ remove the entries of cache_dir, or with max_age only the
+        ones not used for max_age seconds
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not os.path.isdir(path):
+            continue
+        if max_age is not None and now - os.path.getmtime(path) < max_age:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        for key in [key for key, cache in _entries.items() if cache.path == path]:
+            del _entries[key]
+
+
+def _convert( values ):
+    """ float values and "NaN" mask of one feature, or None if a
+        value can't be converted
+    """
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    nan = column == "NaN"
+    column[nan] = np.nan
+    try:
+        return column.astype(float), nan.astype(bool)
+    except (TypeError, ValueError):
+        return None
+
+
+class FeatureCache(object):
+    """ the cached feature matrix of one dataset, in a directory
+        of cache_dir named after the hash of the dataset
+    """
+
+    def __init__(self, dictionary, cache_dir=CACHE_DIR, dataset_hash=None):
+        self.path = os.path.join(cache_dir, dataset_hash or datasetHash(dictionary))
+        try:
+            self.keys = sorted(dictionary.keys())
+        except TypeError:
+            self.keys = list(dictionary.keys())
+        self.features = []
+        # features which are missing or can't be converted to float
+        self.invalid = set()
+        self.matrix = np.zeros((len(self.keys), 0))
+        self.nan = np.zeros((len(self.keys), 0), dtype=bool)
+        if os.path.exists(os.path.join(self.path, "index.pkl")):
+            self._load()
+            # the age of an entry is the time since it was last used
+            os.utime(self.path, None)
+        else:
+            clearCache(cache_dir, MAX_AGE)
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+        self.columns = {feature: j for j, feature in enumerate(self.features)}
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, "index.pkl"), "rb") as f:
+                index = pickle.load(f)
+            matrix = np.load(os.path.join(self.path, index["matrix"]), mmap_mode="r")
+            nan = np.load(os.path.join(self.path, index["nan"]), mmap_mode="r")
+        except (IOError, OSError, KeyError, ValueError, pickle.UnpicklingError):
+            # an entry of an older version, or a damaged one: computed again
+            return
+        if matrix.shape != (len(index["keys"]), len(index["features"])) or \
+           nan.shape != matrix.shape:
+            return
+        self.keys = index["keys"]
+        self.features = index["features"]
+        self.invalid = set(index["invalid"])
+        self.matrix = matrix
+        self.nan = nan
+
+    def _save(self):
+        os.makedirs(self.path, exist_ok=True)
+        # the arrays are written to new files of this writer, then the
+        # index naming them replaces the old one, so a reader always
+        # finds the arrays of the index it reads, even with several
+        # processes adding features to the entry at the same time
+        names = {}
+        for name, array in (("matrix", self.matrix), ("nan", self.nan)):
+            names[name] = self._write(name + "-", ".npy",
+                                      lambda f: np.save(f, np.asfortranarray(array)))
+        index = self._write("index.pkl", ".tmp", lambda f: pickle.dump(
+            {"keys": self.keys, "features": self.features,
+             "invalid": sorted(self.invalid), "matrix": names["matrix"],
+             "nan": names["nan"]}, f))
+        # mapped before the index is replaced: the next writer removes
+        # the arrays of this index, and a mapped file stays readable
+        self.matrix = np.load(os.path.join(self.path, names["matrix"]), mmap_mode="r")
+        self.nan = np.load(os.path.join(self.path, names["nan"]), mmap_mode="r")
+        replaced = self._array_names()
+        os.replace(os.path.join(self.path, index), os.path.join(self.path, "index.pkl"))
+        self._remove(replaced, names.values())
+
+    def _array_names(self):
+        """ names of the arrays of the current index of the entry """
+        try:
+            with open(os.path.join(self.path, "index.pkl"), "rb") as f:
+                index = pickle.load(f)
+            return [index["matrix"], index["nan"]]
+        except (IOError, OSError, KeyError, ValueError, pickle.UnpicklingError):
+            return []
+
+    def _write(self, prefix, suffix, write):
+        """ name of a new file of the entry, written by write(f) """
+        fd, path = tempfile.mkstemp(dir=self.path, prefix=prefix, suffix=suffix)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+        except BaseException:
+            os.remove(path)
+            raise
+        return os.path.basename(path)
+
+    def _remove(self, replaced, names):
+        """ remove the arrays of the replaced index, and stale files """
+        now = time.time()
+        for name in os.listdir(self.path):
+            if name == "index.pkl" or name in names:
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                if name in replaced or now - os.path.getmtime(path) > STALE_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def add_features(self, dictionary, features):
+        """ compute the columns of the features not cached yet """
+        new = [feature for feature in features
+               if feature not in self.columns and feature not in self.invalid]
+        if not new:
+            return
+        records = [dictionary[key] for key in self.keys]
+        columns = []
+        nans = []
+        for feature in new:
+            try:
+                converted = _convert([record[feature] for record in records])
+            except KeyError:
+                converted = None
+            if converted is None:
+                self.invalid.add(feature)
+                continue
+            columns.append(converted[0])
+            nans.append(converted[1])
+            self.features.append(feature)
+        if columns:
+            self.matrix = np.hstack([np.asarray(self.matrix), np.column_stack(columns)])
+            self.nan = np.hstack([np.asarray(self.nan), np.column_stack(nans)])
+            self.columns = {feature: j for j, feature in enumerate(self.features)}
+        self._save()
+
+    def select(self, keys, features, remove_NaN=True):
+        """ (n x k) array of the features for the given keys, in
+            order, or None if one of them is not in the cache; a
+            read-only view of the matrix when that is possible
+        """
+        try:
+            columns = [self.columns[feature] for feature in features]
+            if keys == self.keys:
+                rows = slice(None)
+            else:
+                rows = np.array([self.rows[key] for key in keys], dtype=np.intp)
+        except KeyError:
+            return None
+        if columns and columns == list(range(columns[0], columns[0] + len(columns))):
+            columns = slice(columns[0], columns[0] + len(columns))
+        elif not isinstance(rows, slice):
+            # a single copy of the requested rows and columns
+            rows, columns = np.ix_(rows, columns)
+        # basic slices of the memory-mapped (column major) arrays are
+        # views, only the pages of their columns are read
+        data = np.asarray(self.matrix[rows, columns])
+        if remove_NaN:
+            nan = self.nan[rows, columns]
+            if nan.any():
+                if np.may_share_memory(data, self.matrix):
+                    data = np.array(data)
+                data[nan] = 0
+        return data
+
+
+def cachedFeatureFormat( dictionary, features, remove_NaN=True, remove_all_zeroes=True, remove_any_zeroes=False, sort_keys = False, cache_dir=CACHE_DIR, dataset_hash=None):
+    """ same as featureFormat, reading the values from the cache
+        of the dataset in cache_dir, keyed by dataset_hash if given
+    """
+    if isinstance(sort_keys, str):
+        keys = pickle.load(open(sort_keys, "rb"))
+    elif sort_keys:
+        keys = sorted(dictionary.keys())
+    else:
+        keys = list(dictionary.keys())
+
+    data = None
+    if len(keys) > 0 and len(features) > 0:
+        if dataset_hash is None:
+            dataset_hash = cachedDatasetHash(dictionary)
+        cache = _entries.get((cache_dir, dataset_hash))
+        if cache is None:
+            cache = _entries[(cache_dir, dataset_hash)] = \
+                FeatureCache(dictionary, cache_dir, dataset_hash)
+        cache.add_features(dictionary, features)
+        data = cache.select(keys, features, remove_NaN)
+    if data is None:
+        ### a missing feature or data point: featureFormat reports it
+        return featureFormat(dictionary, features, remove_NaN, remove_all_zeroes,
+                             remove_any_zeroes, sort_keys)
+
+    # exclude 'poi' class as criteria.
+    if features[0] == 'poi':
+        test = data[:, 1:]
+    else:
+        test = data
+    keep = np.ones(len(data), dtype=bool)
+    if remove_all_zeroes:
+        keep &= (test != 0).any(axis=1)
+    if remove_any_zeroes:
+        keep &= ~(test == 0).any(axis=1)
+
+    if not keep.all():
+        data = data[keep]
+    if len(data) == 0:
+        return np.array([])
+    return data
@@ -49,8 +49,6 @@ def featureFormat( dictionary, features, remove_NaN=True, remove_all_zeroes=True
     """
 
 
-    return_list = []
-
     # Key order - first branch is for Python 3 compatibility on mini-projects,
     # second branch is for compatibility on final project.
     if isinstance(sort_keys, str):
@@ -59,47 +57,57 @@ def featureFormat( dictionary, features, remove_NaN=True, remove_all_zeroes=True
     elif sort_keys:
         keys = sorted(dictionary.keys())
     else:
-        keys = dictionary.keys()
-
-    for key in keys:
-        tmp_list = []
-        for feature in features:
-            try:
-                dictionary[key][feature]
-            except KeyError:
-                print("error: key ", feature, " not present")
-                return
-            value = dictionary[key][feature]
-            if value=="NaN" and remove_NaN:
-                value = 0
-            tmp_list.append( float(value) )
-
-        # Logic for deciding whether or not to add the data point.
-        append = True
-        # exclude 'poi' class as criteria.
-        if features[0] == 'poi':
-            test_list = tmp_list[1:]
-        else:
-            test_list = tmp_list
-        ### if all features are zero and you want to remove
-        ### data points that are all zero, do that here
-        if remove_all_zeroes:
-            append = False
-            for item in test_list:
-                if item != 0 and item != "NaN":
-                    append = True
-                    break
-        ### if any features for a given data point are zero
-        ### and you want to remove data points with any zeroes,
-        ### handle that here
-        if remove_any_zeroes:
-            if 0 in test_list or "NaN" in test_list:
-                append = False
-        ### Append the data point if flagged for addition.
-        if append:
-            return_list.append( np.array(tmp_list) )
-
-    return np.array(return_list)
+        keys = list(dictionary.keys())
+
+    if len(keys) == 0:
+        return np.array([])
+
+    ### one list of values per feature, gathered in a single pass
+    try:
+        records = [dictionary[key] for key in keys]
+        columns = [[record[feature] for record in records] for feature in features]
+    except KeyError:
+        ### report the first missing feature, in the order of the data points
+        for key in keys:
+            for feature in features:
+                try:
+                    dictionary[key][feature]
+                except KeyError:
+                    print("error: key ", feature, " not present")
+                    return
+        raise
+
+    ### (n x k) array of the values, "NaN" strings mapped to 0 in bulk
+    ### before the conversion to float
+    values = np.empty((len(records), len(features)), dtype=object)
+    for j, column in enumerate(columns):
+        values[:, j] = column
+    if remove_NaN:
+        values[values == "NaN"] = 0
+    data = values.astype(float)
+
+    # Logic for deciding whether or not to add the data point.
+    # exclude 'poi' class as criteria.
+    if features[0] == 'poi':
+        test = data[:, 1:]
+    else:
+        test = data
+    keep = np.ones(len(data), dtype=bool)
+    ### if all features are zero and you want to remove
+    ### data points that are all zero, do that here
+    ### (NaN counts as non-zero)
+    if remove_all_zeroes:
+        keep &= (test != 0).any(axis=1)
+    ### if any features for a given data point are zero
+    ### and you want to remove data points with any zeroes,
+    ### handle that here
+    if remove_any_zeroes:
+        keep &= ~(test == 0).any(axis=1)
+
+    data = data[keep]
+    if len(data) == 0:
+        return np.array([])
+    return data
 
 
 def targetFeatureSplit( data ):
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+"""
+    A cache of the fitted transformers of a Pipeline, shared by all
+    the grid searches of poi_id.py.
+
+    Every fit of a Pipeline(steps, memory=StepCache()) fits its
+    transformers (SelectKBest) on the training rows of one fold,
+    even though neither the scores nor the selected columns depend
+    on the classifier after them. A StepCache is passed as the
+    memory of the Pipeline, which then looks up every transformer
+    fit by its parameters and the rows it is fitted on (so by step
+    parameters and fold):
+
+    pipeline = Pipeline(steps, memory=StepCache())
+
+    A fit is looked up in memory first, in the process that runs it
+    (a grid search with n_jobs=-1 runs its fits in worker processes,
+    which keep their memory between searches), then on disk in
+    cache_dir, shared by all the processes and kept between runs.
+    Each lookup is logged in a file of this StepCache in cache_dir,
+    so counts() adds up the memory hits, disk hits and misses of all
+    the processes working for it, and of no other run.
+
+    close() removes the log and trims the fits on disk to BYTES_LIMIT,
+    the least recently used first:
+
+    step_cache = StepCache()
+    ...
+    step_cache.close()
+"""
+
+import glob
+import os
+import tempfile
+import time
+from collections import Counter
+
+import joblib
+from joblib.func_inspect import filter_args
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "step_cache")
+
+# size of the fits kept on disk by close()
+BYTES_LIMIT = "100M"
+
+# logs of runs which didn't close() their StepCache are removed after a day
+STALE_AGE = 24 * 3600
+
+# the fits looked up in memory, by cache_dir and hash of the call
+_entries = {}
+
+# the letter logged for each kind of lookup
+MEMORY_HIT = "h"
+DISK_HIT = "d"
+MISS = "m"
+
+
+class StepCache(object):
+    """ memory and disk cache of the transformer fits of a Pipeline,
+        with the interface of joblib.Memory it uses
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, log=None):
+        self.cache_dir = cache_dir
+        self.memory = joblib.Memory(cache_dir, verbose=0)
+        if log is None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._remove_stale_logs()
+            log = os.path.join(cache_dir, "lookups-{}-{}.log".format(
+                os.getpid(), int(time.time() * 1000)))
+        self.log = log
+
+    def cache(self, func, ignore=None):
+        return CachedStep(self, func, ignore or [])
+
+    def counts(self):
+        """ Counter of the lookups logged so far, by kind """
+        if not os.path.exists(self.log):
+            return Counter()
+        with open(self.log) as f:
+            return Counter(f.read())
+
+    def record(self, kind):
+        # one appended byte per lookup, so the lookups of processes
+        # running at the same time are all kept
+        with open(self.log, "a") as f:
+            f.write(kind)
+
+    def close(self, bytes_limit=BYTES_LIMIT):
+        """ remove the log, and trim the fits on disk to bytes_limit """
+        if os.path.exists(self.log):
+            os.remove(self.log)
+        self.memory.reduce_size(bytes_limit=bytes_limit)
+
+    def _remove_stale_logs(self):
+        now = time.time()
+        for log in glob.glob(os.path.join(self.cache_dir, "lookups-*.log")):
+            try:
+                if now - os.path.getmtime(log) > STALE_AGE:
+                    os.remove(log)
+            except OSError:
+                pass
+
+    def __getstate__(self):
+        # the worker processes log to the file of this StepCache
+        return {"cache_dir": self.cache_dir, "log": self.log}
+
+    def __setstate__(self, state):
+        self.__init__(state["cache_dir"], state["log"])
+
+
+class CachedStep(object):
+    """ a function cached by a StepCache """
+
+    def __init__(self, step_cache, func, ignore):
+        self.step_cache = step_cache
+        self.func = func
+        self.ignore = ignore
+        self.cached = step_cache.memory.cache(func, ignore=ignore)
+
+    def __call__(self, *args, **kwargs):
+        entries = _entries.setdefault(self.step_cache.cache_dir, {})
+        key = (self.func.__module__, self.func.__name__,
+               joblib.hash(filter_args(self.func, self.ignore, args, kwargs)))
+        if key in entries:
+            self.step_cache.record(MEMORY_HIT)
+            return entries[key]
+        if self.cached.check_call_in_cache(*args, **kwargs):
+            self.step_cache.record(DISK_HIT)
+        else:
+            self.step_cache.record(MISS)
+        entries[key] = result = self.cached(*args, **kwargs)
+        return result
+
+
+def hitRates( counts ):
+    """ text of the hit rates of a Counter of lookups """
+    total = sum(counts[kind] for kind in (MEMORY_HIT, DISK_HIT, MISS))
+    if total == 0:
+        return "no lookups"
+    return "{} lookups, {:.1%} memory hits, {:.1%} disk hits, {:.1%} misses".format(
+        total, 1.0 * counts[MEMORY_HIT] / total, 1.0 * counts[DISK_HIT] / total,
+        1.0 * counts[MISS] / total)
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+
+"""
+    Tests of the vectorised featureFormat against the original
+    implementation, kept below as featureFormatOriginal, on
+    synthetic dataset dictionaries. All the copies of
+    feature_format.py in the mini-project directories are tested.
+
+    python -m pytest test_feature_format.py
+"""
+
+import glob
+import importlib.util
+import itertools
+import os
+import pickle
+import random
+
+import numpy as np
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# final_project/tools and the mini-project directories next to final_project
+COPIES = [os.path.join(HERE, "feature_format.py")] + sorted(
+    glob.glob(os.path.join(HERE, "..", "..", "*", "feature_format.py")))
+
+
+def featureFormatOriginal( dictionary, features, remove_NaN=True, remove_all_zeroes=True, remove_any_zeroes=False, sort_keys = False):
+    """ featureFormat as it was before it was vectorised """
+    return_list = []
+
+    if isinstance(sort_keys, str):
+        keys = pickle.load(open(sort_keys, "rb"))
+    elif sort_keys:
+        keys = sorted(dictionary.keys())
+    else:
+        keys = dictionary.keys()
+
+    for key in keys:
+        tmp_list = []
+        for feature in features:
+            try:
+                dictionary[key][feature]
+            except KeyError:
+                print("error: key ", feature, " not present")
+                return
+            value = dictionary[key][feature]
+            if value=="NaN" and remove_NaN:
+                value = 0
+            tmp_list.append( float(value) )
+
+        append = True
+        if features[0] == 'poi':
+            test_list = tmp_list[1:]
+        else:
+            test_list = tmp_list
+        if remove_all_zeroes:
+            append = False
+            for item in test_list:
+                if item != 0 and item != "NaN":
+                    append = True
+                    break
+        if remove_any_zeroes:
+            if 0 in test_list or "NaN" in test_list:
+                append = False
+        if append:
+            return_list.append( np.array(tmp_list) )
+
+    return np.array(return_list)
+
+
+def loadCopy( path ):
+    """ the feature_format module at path """
+    spec = importlib.util.spec_from_file_location("feature_format_copy", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+FEATURES = ["poi", "salary", "bonus", "expenses", "to_messages", "from_poi"]
+
+VALUES = ["NaN", "NaN", 0, 0.0, 0, 1, 2.5, -3, 1e6, True, False, "7"]
+
+
+def syntheticDataset( seed, n=60 ):
+    """ dataset dictionary of n people with random feature values,
+        a lot of them "NaN" or zero
+    """
+    r = random.Random(seed)
+    dataset = {}
+    for i in range(n):
+        record = {feature: r.choice(VALUES) for feature in FEATURES}
+        if r.random() < 0.1:
+            ### a person with no value at all
+            record = {feature: r.choice(["NaN", 0]) for feature in FEATURES}
+        dataset["PERSON %03d" % r.randrange(1000)] = record
+    return dataset
+
+
+def assertSameResult( expected, result ):
+    if expected is None:
+        assert result is None
+        return
+    assert result.shape == expected.shape
+    assert result.dtype == expected.dtype
+    np.testing.assert_array_equal(result, expected)
+
+
+OPTIONS = list(itertools.product([True, False], repeat=4))
+
+
+@pytest.mark.parametrize("path", COPIES)
+@pytest.mark.parametrize("remove_NaN, remove_all_zeroes, remove_any_zeroes, sort_keys", OPTIONS)
+def test_same_as_original( path, remove_NaN, remove_all_zeroes, remove_any_zeroes, sort_keys ):
+    featureFormat = loadCopy(path).featureFormat
+    for seed in range(20):
+        dataset = syntheticDataset(seed)
+        r = random.Random(seed)
+        for features in (FEATURES, FEATURES[1:], r.sample(FEATURES, 3), ["poi", "bonus"]):
+            args = (dataset, features, remove_NaN, remove_all_zeroes, remove_any_zeroes,
+                    sort_keys)
+            assertSameResult(featureFormatOriginal(*args), featureFormat(*args))
+
+
+@pytest.mark.parametrize("path", COPIES)
+def test_edge_cases( path, capsys, tmp_path ):
+    featureFormat = loadCopy(path).featureFormat
+    dataset = syntheticDataset(0)
+
+    ### no data point left
+    zeroes = {"A": {"poi": 1, "salary": 0}, "B": {"poi": 0, "salary": "NaN"}}
+    assertSameResult(featureFormatOriginal(zeroes, ["poi", "salary"]),
+                     featureFormat(zeroes, ["poi", "salary"]))
+    assert featureFormat(zeroes, ["poi", "salary"]).shape == (0,)
+
+    ### a missing feature is reported the same way
+    missing = dict(dataset)
+    missing["LAST"] = {feature: 1 for feature in FEATURES[:-1]}
+    capsys.readouterr()
+    expected = featureFormatOriginal(missing, FEATURES)
+    expected_output = capsys.readouterr().out
+    assert featureFormat(missing, FEATURES) is expected is None
+    assert capsys.readouterr().out == expected_output
+
+    ### a value which can't be converted raises the same error
+    broken = dict(dataset)
+    broken["LAST"] = dict(dataset[sorted(dataset)[0]], salary="x")
+    with pytest.raises(ValueError):
+        featureFormatOriginal(broken, FEATURES, sort_keys=True)
+    with pytest.raises(ValueError):
+        featureFormat(broken, FEATURES, sort_keys=True)
+
+    ### keys in the order of a pickle file
+    keys_file = str(tmp_path / "keys.pkl")
+    keys = sorted(dataset, reverse=True)[::2]
+    with open(keys_file, "wb") as f:
+        pickle.dump(keys, f)
+    assertSameResult(featureFormatOriginal(dataset, FEATURES, sort_keys=keys_file),
+                     featureFormat(dataset, FEATURES, sort_keys=keys_file))